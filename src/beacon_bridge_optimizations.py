@@ -1,19 +1,90 @@
 #!/usr/bin/env python
 # coding: utf-8
 import numpy as np
+import copy
 import os
 import pickle
 import hashlib
-from functools import wraps
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent import futures
+from functools import partial, wraps
 from scipy import optimize
 import inspect
+from cache_store import CacheStore, jsonable
+
+# Entries kept in memory per cached function (0 disables the memory tier).
+memory_cache_size = 256
+
+
+def _freeze(obj):
+    # hashable stand-in for the call arguments, used as the memory key
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(o) for o in obj)
+    if isinstance(obj, np.ndarray):
+        return ('ndarray', obj.shape, _freeze(obj.tolist()))
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in obj.items()))
+    return obj
+
+
+_stores = {}
+
+
+def get_cache_store(cache_dir='cache'):
+    '''The shared CacheStore (one SQLite file) for cache_dir.'''
+    if cache_dir not in _stores:
+        _stores[cache_dir] = CacheStore(os.path.join(cache_dir, 'cache.sqlite'))
+    return _stores[cache_dir]
+
 
 def file_cache(func, cache_dir='cache'):
+    '''Two-tier cache: an in-process LRU of up to memory_cache_size results
+    in front of the indexed on-disk CacheStore. Memory hits never touch the
+    filesystem. Keys include the Pockels cell model fingerprint, so a
+    recharacterization never serves stale results. wrapper.cache_info()
+    returns the hit/miss/eviction counters, wrapper.cache_clear()
+    empties the memory tier and wrapper.cache_contains(*args, **kwargs)
+    tells whether a call would be a hit.'''
     os.makedirs(cache_dir, exist_ok=True)
 
     sig = inspect.signature(func)
     valid_args = set(sig.parameters)
 
+    memory = OrderedDict()
+    lock = threading.Lock()
+    stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+    def remember(key, result):
+        # the memory tier keeps its own copy, and hands out copies, so
+        # callers can modify the arrays they get back
+        result = copy.deepcopy(result)
+        with lock:
+            memory[key] = result
+            memory.move_to_end(key)
+            while len(memory) > memory_cache_size:
+                memory.popitem(last=False)
+                stats['evictions'] += 1
+
+    def load_from_disk(model_id, key_hash):
+        return get_cache_store(cache_dir).get(func.__name__,
+                                              f'{model_id}:{key_hash}')
+
+    def memory_key(model_id, args, actual_kwargs):
+        try:
+            mem_key = (model_id, _freeze(args), _freeze(actual_kwargs))
+            hash(mem_key)
+        except TypeError:
+            return None
+        return mem_key
+
+    def disk_key(args, actual_kwargs):
+        # Generate unique hash from function arguments
+        key_data = pickle.dumps((args, actual_kwargs))
+        return hashlib.md5(key_data).hexdigest()
+
     @wraps(func)
     def wrapper(*args, **kwargs):
         # Explicitly remove control keywords BEFORE key computation and function call
@@ -23,26 +94,67 @@ def file_cache(func, cache_dir='cache'):
         # These kwargs are only those accepted by the wrapped function
         actual_kwargs = {k: v for k, v in kwargs.items() if k in valid_args}
 
-        # Generate unique hash from function arguments
-        key_data = pickle.dumps((args, actual_kwargs))
-        key_hash = hashlib.md5(key_data).hexdigest()
-        cache_path = os.path.join(cache_dir, f'{func.__name__}_{key_hash}.pkl')
+        model_id = pockels_model_id
+        mem_key = memory_key(model_id, args, actual_kwargs)
+        if use_cache and mem_key is not None:
+            with lock:
+                hit = mem_key in memory
+                if hit:
+                    memory.move_to_end(mem_key)
+                    stats['hits'] += 1
+                    result = memory[mem_key]
+            if hit:
+                return copy.deepcopy(result)
 
-        if use_cache and os.path.exists(cache_path):
-            with open(cache_path, 'rb') as f:
-                print(f"[cache] Loaded from {cache_path}")
-                return pickle.load(f)
+        key_hash = disk_key(args, actual_kwargs)
+        if mem_key is None:
+            mem_key = (model_id, key_hash)
+
+        if use_cache:
+            found, result = load_from_disk(model_id, key_hash)
+            if found:
+                with lock:
+                    stats['disk_hits'] += 1
+                remember(mem_key, result)
+                return result
 
         # Compute and possibly cache
+        with lock:
+            stats['misses'] += 1
         result = func(*args, **actual_kwargs)
 
-        if (not use_cache and update_cache) or (use_cache and not os.path.exists(cache_path)):
-            with open(cache_path, 'wb') as f:
-                pickle.dump(result, f)
-                print(f"[cache] Saved to {cache_path}")
+        if use_cache or update_cache:
+            # the arguments are kept so entries can be re-solved later
+            get_cache_store(cache_dir).put(
+                func.__name__, f'{model_id}:{key_hash}', result,
+                args=json.dumps([jsonable(args), jsonable(actual_kwargs)]))
+            print(f"[cache] Saved {func.__name__} {model_id}:{key_hash}")
+            remember(mem_key, result)
 
         return result
 
+    def cache_contains(*args, **kwargs):
+        '''Whether a call with these arguments would be a cache hit.'''
+        actual_kwargs = {k: v for k, v in kwargs.items() if k in valid_args}
+        model_id = pockels_model_id
+        key_hash = disk_key(args, actual_kwargs)
+        mem_key = memory_key(model_id, args, actual_kwargs) or (model_id, key_hash)
+        with lock:
+            if mem_key in memory:
+                return True
+        return load_from_disk(model_id, key_hash)[0]
+
+    def cache_info():
+        with lock:
+            return dict(stats, size=len(memory), maxsize=memory_cache_size)
+
+    def cache_clear():
+        with lock:
+            memory.clear()
+
+    wrapper.cache_info = cache_info
+    wrapper.cache_clear = cache_clear
+    wrapper.cache_contains = cache_contains
     return wrapper
 
 
@@ -69,9 +181,64 @@ pc_rot_alice = -toRad*45.66
 pc_rot_bob = -toRad*45.64
 
 opt_tol_a = opt_tol_b = 5e-8
+
+# Multistart settings for the numerical bridge optimization
+multistart_starts = 16     # seeded starting points per optimization
+multistart_budget = 30.    # wall-clock budget in seconds
+multistart_workers = None  # process pool size, None = os.cpu_count(), 0 = serial
+multistart_seed = 0
+
+# hwp_1, qwp_1, hwp_2 and Pockels cell voltage (in quarter-wave units)
+bell_bounds = [(-90., 90.), (-90., 90.), (-90., 90.), (0., 2.)]
 '''__________________________end constants___________________'''''
 
 
+def _parse_jones(matrix):
+    # the config stores entries as strings like "1. + 0.j"
+    return np.array([[complex(str(v).replace(' ', '')) for v in row]
+                     for row in matrix])
+
+
+def model_fingerprint(jones_alice, jones_bob, rot_alice, rot_bob):
+    '''Short hash of the parts of the Pockels cell model that change the
+    optimized angles. The quarter-wave voltages only scale the printed
+    driver settings, so they are left out.'''
+    values = np.concatenate([np.asarray(jones_alice).ravel().view(float),
+                             np.asarray(jones_bob).ravel().view(float),
+                             [rot_alice, rot_bob]])
+    return hashlib.sha256(np.round(values, 12).tobytes()).hexdigest()[:16]
+
+
+pockels_model_id = model_fingerprint(
+    jones_avg_alice_static, jones_avg_bob_static, pc_rot_alice, pc_rot_bob)
+
+
+def set_pockels_model(pockels_cell):
+    '''Use the pockels_cell section of the config as the Pockels cell model.
+    Cache keys and solution tables are segregated by model fingerprint, so
+    results computed under a previous characterization are kept but never
+    served for the new one. Returns the model fingerprint.'''
+    global jones_avg_alice_static, jones_avg_bob_static
+    global pc_rot_alice, pc_rot_bob, quarter_wave_alice, quarter_wave_bob
+    global pockels_model_id, _bridge_table, _bell_table
+    alice, bob = pockels_cell['alice'], pockels_cell['bob']
+    quarter_wave_alice = float(alice['quarter_wave_voltage'])
+    quarter_wave_bob = float(bob['quarter_wave_voltage'])
+    jones_alice = _parse_jones(alice['jones_avg_static'])
+    jones_bob = _parse_jones(bob['jones_avg_static'])
+    rot_alice = toRad*float(alice['pc_rot'])
+    rot_bob = toRad*float(bob['pc_rot'])
+    model_id = model_fingerprint(jones_alice, jones_bob, rot_alice, rot_bob)
+    if model_id == pockels_model_id:
+        return model_id
+    jones_avg_alice_static, jones_avg_bob_static = jones_alice, jones_bob
+    pc_rot_alice, pc_rot_bob = rot_alice, rot_bob
+    pockels_model_id = model_id
+    _bridge_table = _bell_table = None
+    print(f"[model] Pockels cell model {model_id}")
+    return model_id
+
+
 '''___Standard functions___'''
 
 
@@ -105,182 +272,931 @@ def hwp(theta, imperf=0.):
 
 
 '''_________end standard functions_________'''
+
+
+'''___Batched (vectorized) Jones functions___
+These build stacks of 2x2 matrices with shape (N, 2, 2) from closed-form
+element formulas so that many parameter vectors can be evaluated in a
+single numpy pass.'''
+
+
+def rot_batch(theta):
+    theta = np.asarray(theta, dtype=float)
+    c, s = np.cos(theta), np.sin(theta)
+    r = np.empty(theta.shape + (2, 2))
+    r[..., 0, 0] = c
+    r[..., 0, 1] = s
+    r[..., 1, 0] = -s
+    r[..., 1, 1] = c
+    return r
+
+
+# Stack of half-waveplate matrices, same convention as hwp()
+def hwp_batch(theta, imperf=0.):
+    theta = np.asarray(theta, dtype=float)
+    c2, s2 = np.cos(2*theta), np.sin(2*theta)
+    phase = np.exp(-1j*np.pi/2*(1 + imperf))
+    jones = np.empty(theta.shape + (2, 2), dtype=complex)
+    jones[..., 0, 0] = phase*c2
+    jones[..., 0, 1] = phase*s2
+    jones[..., 1, 0] = phase*s2
+    jones[..., 1, 1] = -phase*c2
+    return jones
+
+
+# Stack of quarter-waveplate matrices, same convention as qwp()
+def qwp_batch(theta, imperf=0.):
+    theta = np.asarray(theta, dtype=float)
+    c2, s2 = np.cos(2*theta), np.sin(2*theta)
+    phase = np.exp(-1j*np.pi/4*(1 + imperf))
+    jones = np.empty(theta.shape + (2, 2), dtype=complex)
+    jones[..., 0, 0] = phase*((1 - 1j) + (1 + 1j)*c2)/2
+    jones[..., 0, 1] = phase*(1 + 1j)*s2/2
+    jones[..., 1, 0] = phase*(1 + 1j)*s2/2
+    jones[..., 1, 1] = phase*((1 - 1j) - (1 + 1j)*c2)/2
+    return jones
+
+
+# Stack of Pockels cell matrices rot(pc_rot) @ diag(1, e^{-i pi V/2}) @ rot(-pc_rot)
+def pc_batch(volt, pc_rot):
+    volt = np.asarray(volt, dtype=float)
+    c, s = np.cos(pc_rot), np.sin(pc_rot)
+    retard = np.exp(-1j*np.pi/2*volt)
+    jones = np.empty(volt.shape + (2, 2), dtype=complex)
+    jones[..., 0, 0] = c*c + s*s*retard
+    jones[..., 0, 1] = c*s*(retard - 1)
+    jones[..., 1, 0] = c*s*(retard - 1)
+    jones[..., 1, 1] = s*s + c*c*retard
+    return jones
+
+
+# Derivatives of the stacks above with respect to theta (radians) or voltage
+def dhwp_batch(theta, imperf=0.):
+    theta = np.asarray(theta, dtype=float)
+    c2, s2 = np.cos(2*theta), np.sin(2*theta)
+    phase = 2*np.exp(-1j*np.pi/2*(1 + imperf))
+    jones = np.empty(theta.shape + (2, 2), dtype=complex)
+    jones[..., 0, 0] = -phase*s2
+    jones[..., 0, 1] = phase*c2
+    jones[..., 1, 0] = phase*c2
+    jones[..., 1, 1] = phase*s2
+    return jones
+
+
+def dqwp_batch(theta, imperf=0.):
+    theta = np.asarray(theta, dtype=float)
+    c2, s2 = np.cos(2*theta), np.sin(2*theta)
+    phase = np.exp(-1j*np.pi/4*(1 + imperf))*(1 + 1j)
+    jones = np.empty(theta.shape + (2, 2), dtype=complex)
+    jones[..., 0, 0] = -phase*s2
+    jones[..., 0, 1] = phase*c2
+    jones[..., 1, 0] = phase*c2
+    jones[..., 1, 1] = phase*s2
+    return jones
+
+
+def dpc_batch(volt, pc_rot):
+    volt = np.asarray(volt, dtype=float)
+    c, s = np.cos(pc_rot), np.sin(pc_rot)
+    dretard = -1j*np.pi/2*np.exp(-1j*np.pi/2*volt)
+    jones = np.empty(volt.shape + (2, 2), dtype=complex)
+    jones[..., 0, 0] = s*s*dretard
+    jones[..., 0, 1] = c*s*dretard
+    jones[..., 1, 0] = c*s*dretard
+    jones[..., 1, 1] = c*c*dretard
+    return jones
+
+
+def _orth(x): return np.array([x[1], -1*x[0]])  # orthogonal of a 2d vector
+
+
+def bridge_overlaps_batch(parameters, pc_static_jones,
+                          theor_angles, pc_rot, off_state_only=False,
+                          with_grad=False):
+    '''Overlaps minimized by what_angles for a stack of parameter vectors.
+    parameters is an (N, 3) array (off_state_only) or (N, 4) array of
+    [hwp_1, qwp_1, hwp_2, voltage]. Returns an (N, 1) complex array for the
+    off state, or (N, 2) for the on state (Alice-like and Bob-like arms).
+    If with_grad is True, also returns the (N, K, P) derivatives of the
+    overlaps with respect to the parameters (angles in degrees).'''
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=float))
+    h1 = hwp_batch(parameters[:, 0]*toRad)
+    q1 = qwp_batch(parameters[:, 1]*toRad)
+    h2 = hwp_batch(parameters[:, 2]*toRad)
+    pc_static_jones = np.asarray(pc_static_jones)
+
+    if off_state_only:
+        # hwp->qwp->PC->hwp->Hpol
+        col = hwp(theor_angles[0]*toRad) @ [1, 0]
+        row = h2[:, 1, :] @ pc_static_jones
+        h1_col = h1 @ col
+        vec = np.einsum('nij,nj->ni', q1, h1_col)
+        overlaps = np.einsum('ni,ni->n', row, vec)[:, None]
+        if not with_grad:
+            return overlaps
+        dh1_col = dhwp_batch(parameters[:, 0]*toRad) @ col
+        dq1 = dqwp_batch(parameters[:, 1]*toRad)
+        dh2_row = dhwp_batch(parameters[:, 2]*toRad)[:, 1, :] @ pc_static_jones
+        grad = np.stack([
+            np.einsum('ni,nij,nj->n', row, q1, dh1_col),
+            np.einsum('ni,nij,nj->n', row, dq1, h1_col),
+            np.einsum('ni,ni->n', dh2_row, vec),
+        ], axis=1)*toRad
+        return overlaps, grad[:, None, :]
+
+    # hwp->qwp->PC->hwp->Vpol, for the static and the switched Pockels cell
+    theor_orth = np.array([_orth(hwp(theor_angles[0]*toRad) @ [0, 1]),
+                           _orth(hwp(theor_angles[1]*toRad) @ [0, 1])])
+    pc_on = pc_batch(parameters[:, 3], pc_rot)
+    # (N, K, 2, 2) Pockels cell stack: K=0 static, K=1 switched
+    pcs = np.stack([np.broadcast_to(pc_static_jones, pc_on.shape), pc_on],
+                   axis=1)
+    back = h2[:, :, 1]
+    rows = np.einsum('ki,nij->nkj', theor_orth, h1 @ q1)
+    pc_back = np.einsum('nkij,nj->nki', pcs, back)
+    overlaps = np.einsum('nki,nki->nk', rows, pc_back)
+    if not with_grad:
+        return overlaps
+    dh1_rows = np.einsum('ki,nij,njl->nkl', theor_orth,
+                         dhwp_batch(parameters[:, 0]*toRad), q1)
+    dq1_rows = np.einsum('ki,nij,njl->nkl', theor_orth, h1,
+                         dqwp_batch(parameters[:, 1]*toRad))
+    dback = dhwp_batch(parameters[:, 2]*toRad)[:, :, 1]
+    dvolt = np.zeros_like(overlaps)
+    dvolt[:, 1] = np.einsum('ni,nij,nj->n', rows[:, 1],
+                            dpc_batch(parameters[:, 3], pc_rot), back)
+    grad = np.stack([
+        np.einsum('nki,nki->nk', dh1_rows, pc_back)*toRad,
+        np.einsum('nki,nki->nk', dq1_rows, pc_back)*toRad,
+        np.einsum('nki,nkij,nj->nk', rows, pcs, dback)*toRad,
+        dvolt,
+    ], axis=2)
+    return overlaps, grad
+
+
+def what_angles_batch(parameters, pc_static_jones,
+                      theor_angles, pc_rot, off_state_only=False):
+    '''Vectorized what_angles: evaluates an (N, 3) or (N, 4) array of
+    parameter vectors and returns the N costs.'''
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=float))
+    overlaps = np.abs(bridge_overlaps_batch(parameters, pc_static_jones,
+                                            theor_angles, pc_rot,
+                                            off_state_only))
+    if off_state_only:
+        cost = overlaps[:, 0]*5e-1
+    else:
+        cost = overlaps.sum(axis=1)
+    out_of_bounds = np.any(np.abs(parameters) > 90., axis=1)
+    cost[out_of_bounds] = 1e10
+    return cost
+
+
 def what_angles(parameters, pc_static_jones,
                 theor_angles, pc_rot, off_state_only=False):
     # WARNING: This does not work for circular polarizations!
-    # There are some assumptions that optimize this for the bell-ch 
+    # There are some assumptions that optimize this for the bell-ch
     # inequality, which only measures in linear polarizations.
-    hwp_1 = parameters[0]*toRad
-    qwp_1 = parameters[1]*toRad
-    hwp_2 = parameters[2]*toRad
-    
-    for param in parameters:
-        if np.abs(param) > 90.:
-            # print("Angle out of bounds")
-            return 1e10
-            
-    if off_state_only is False:
-        volt = parameters[3]
-    Vpol = np.outer([0, 1], [0, 1])
-    Hpol = np.outer([1, 0], [1, 0])
-    def orth(x): return np.array([x[1], -1*x[0]])  # orthogonal of a 2d vector
-
-    # a HWP preceeding a V polarizer
-    #print(off_state_only, theor_angles)
-    #sys.stop()
-    
-    if off_state_only is True:
-    # hwp->qwp->PC->hwp->Hpol
-        a_1 =  ([0, 1] @ hwp(hwp_2) @ pc_static_jones @ 
-                qwp(qwp_1) @ hwp(hwp_1) @ hwp(theor_angles[0]*toRad) @ [1, 0])
+    # Off state: the bridge (hwp->qwp->PC->hwp) should map the input
+    # orthogonal to hwp(ang) @ [0,1], so minimize the overlap with Hpol.
+    # On state: the bridge should act like hwp(ang) @ [0,1], so minimize
+    # the overlap with the orthogonal of theor_a (and theor_b for the
+    # switched Pockels cell).
+    return what_angles_batch(parameters, pc_static_jones, theor_angles,
+                             pc_rot, off_state_only)[0]
+
+
+def what_angles_sq_batch(parameters, pc_static_jones,
+                         theor_angles, pc_rot, off_state_only=False):
+    '''Smooth version of what_angles_batch: the sum of the squared overlaps,
+    together with its exact (N, P) gradient. Unlike the absolute value,
+    the squared overlap is differentiable at the optimum.'''
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=float))
+    overlaps, doverlaps = bridge_overlaps_batch(
+        parameters, pc_static_jones, theor_angles, pc_rot, off_state_only,
+        with_grad=True)
+    cost = np.sum(np.abs(overlaps)**2, axis=1)
+    grad = 2*np.einsum('nk,nkp->np', overlaps.conj(), doverlaps).real
+    out_of_bounds = np.any(np.abs(parameters) > 90., axis=1)
+    cost[out_of_bounds] = 1e10
+    grad[out_of_bounds] = 0.
+    return cost, grad
+
+
+def what_angles_sq(parameters, pc_static_jones,
+                   theor_angles, pc_rot, off_state_only=False):
+    '''Squared-overlap cost and its gradient for a single parameter vector,
+    for use as optimize.minimize(..., jac=True).'''
+    cost, grad = what_angles_sq_batch(parameters, pc_static_jones,
+                                      theor_angles, pc_rot, off_state_only)
+    return cost[0], grad[0]
+
+
+class _OutOfTime(Exception):
+    pass
+
+
+def minimize_bridge(guess, pc_static_jones, theor_angles, pc_rot,
+                    off_state_only=False, bounds=None, deadline=None):
+    '''Run BFGS on the smooth squared-overlap cost with its analytic
+    gradient, or L-BFGS-B if bounds are given. res.fun is reported in
+    what_angles units so the opt_tol thresholds keep their meaning.
+    With a deadline (in time.time() seconds) the solve raises _OutOfTime
+    at the first cost evaluation after it.'''
+    args = (pc_static_jones, theor_angles, pc_rot, off_state_only)
+    cost = what_angles_sq
+    if deadline is not None:
+        def cost(x, *cost_args):
+            if time.time() > deadline:
+                raise _OutOfTime
+            return what_angles_sq(x, *cost_args)
+    if bounds is None:
+        res = optimize.minimize(cost, guess, args=args, jac=True,
+                                method='BFGS', options={'gtol': 1e-14})
     else:
-        theor_a = hwp(theor_angles[0]*toRad) @ [0, 1]
-        theor_a_orth = orth(theor_a)
-        a_1 = hwp(hwp_1) @ qwp(qwp_1) @ pc_static_jones @ hwp(hwp_2) @ [0, 1]
+        res = optimize.minimize(cost, guess, args=args, jac=True,
+                                method='L-BFGS-B', bounds=bounds,
+                                options={'ftol': 1e-20, 'gtol': 1e-14,
+                                         'maxiter': 1000})
+    res.fun = what_angles(res.x, *args)
+    return res
 
-    if off_state_only is False:
-        theor_b = hwp(theor_angles[1]*toRad)@[0, 1]
-        theor_b_orth = orth(theor_b)
 
-        b_1 = (hwp(hwp_1) @ qwp(qwp_1) @ rot(pc_rot) @ [[1, 0], [0, np.exp(-1j*np.pi/2 * volt)]] 
-               @ rot(-pc_rot) @  hwp(hwp_2) @ [0, 1])  # hwp->qwp->PC->hwp->Vpol
+def polish_bridge(guess, pc_static_jones, theor_angles, pc_rot,
+                  off_state_only=False, n_iter=8):
+    '''Gauss-Newton on the complex overlaps, using their exact Jacobian.
+    Converges quadratically from a nearby guess, so a handful of
+    iterations is enough to refine an interpolated or cached solution.'''
+    args = (pc_static_jones, theor_angles, pc_rot, off_state_only)
+    x = np.array(guess, dtype=float)
+    for nit in range(1, n_iter + 1):
+        overlaps, doverlaps = bridge_overlaps_batch(x, *args, with_grad=True)
+        resid = np.concatenate([overlaps[0].real, overlaps[0].imag])
+        jac = np.concatenate([doverlaps[0].real, doverlaps[0].imag])
+        step = np.linalg.lstsq(jac, -resid, rcond=None)[0]
+        x = x + step
+        if np.max(np.abs(step)) < 1e-12:
+            break
+    x[:3] = wrap_angle(x[:3])
+    return optimize.OptimizeResult(x=x, fun=what_angles(x, *args),
+                                   nit=nit, nfev=nit)
 
+
+class BridgeOptimizationError(Exception):
+    pass
+
+
+def multistart_guesses(n_starts, off_state_only=False, seed=0, bounds=None):
+    '''Deterministic starting points, drawn like the old random guesses,
+    or uniformly over the box if bounds are given.'''
+    rng = np.random.default_rng(seed)
+    if bounds is not None:
+        low, high = np.array(bounds, dtype=float).T
+        return low + (high - low)*rng.random((n_starts, len(low)))
     if off_state_only is False:
-        # in this case, you want to maximize overlap with theor_a
-        # this is because the bridge should act like hwp(ang) @ [0,1]
-        return (np.abs(np.dot(theor_a_orth, a_1)) +
-                np.abs(np.dot(theor_b_orth, b_1)))
+        return (np.array([1.0, 0.0, 0.0, 0.1]) +
+                np.hstack([10*rng.random((n_starts, 3)),
+                           np.zeros((n_starts, 1))]))
+    return (np.array([1.0, 0.0, 0.0]) + 10*rng.random((n_starts, 3)) -
+            10*rng.random((n_starts, 3)))
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# The module state that makes up the Pockels cell model
+_MODEL_STATE = ('jones_avg_alice_static', 'jones_avg_bob_static',
+                'pc_rot_alice', 'pc_rot_bob', 'quarter_wave_alice',
+                'quarter_wave_bob', 'pockels_model_id')
+
+
+def _get_pool(n_workers):
+    # One long-lived pool per size so repeated optimizations skip the
+    # process start-up cost. The workers do not depend on the model they
+    # were started with: tasks that read it carry it (see _with_model).
+    with _pools_lock:
+        if n_workers not in _pools:
+            _pools[n_workers] = futures.ProcessPoolExecutor(
+                max_workers=n_workers)
+        return _pools[n_workers]
+
+
+def _model_state():
+    '''The current Pockels cell model, to send along with pool tasks.'''
+    return {name: globals()[name] for name in _MODEL_STATE}
+
+
+def _with_model(model, func, *args):
+    '''Run func(*args) under the Pockels cell model from _model_state(),
+    in a pool worker that may have been forked under another model or
+    spawned with the built-in one.'''
+    global _bridge_table, _bell_table
+    if model['pockels_model_id'] != pockels_model_id:
+        _bridge_table = _bell_table = None
+    globals().update(model)
+    return func(*args)
+
+
+def _timed_start(guess, args, bounds, deadline):
+    '''One multistart start, or None if the deadline passes before or
+    while it runs.'''
+    try:
+        return minimize_bridge(guess, *args, bounds=bounds, deadline=deadline)
+    except _OutOfTime:
+        return None
+
+
+def multistart_bridge(pc_static_jones, theor_angles, pc_rot,
+                      off_state_only=False, opt_tol=opt_tol_a*1e-1,
+                      n_starts=None, time_budget=None, n_workers=None,
+                      seed=None, bounds=None):
+    '''Run minimize_bridge from a fixed batch of seeded starting points,
+    concurrently in a process pool, and return the best result.
+
+    If bounds are given the starts are spread over the box and each one is
+    a bounded L-BFGS-B solve. Starts that have not finished within
+    time_budget seconds are dropped; each start checks the deadline
+    itself, so a running solve stops at its next cost evaluation.
+    The returned OptimizeResult also carries n_starts (starts completed)
+    and nfev (cost evaluations summed over those starts). Raises
+    BridgeOptimizationError if no start reaches opt_tol.'''
+    n_starts = multistart_starts if n_starts is None else n_starts
+    time_budget = multistart_budget if time_budget is None else time_budget
+    n_workers = multistart_workers if n_workers is None else n_workers
+    seed = multistart_seed if seed is None else seed
+
+    args = (np.asarray(pc_static_jones), list(theor_angles), pc_rot,
+            off_state_only)
+    guesses = multistart_guesses(n_starts, off_state_only, seed, bounds)
+    # wall clock, as the deadline is checked in the worker processes
+    deadline = time.time() + time_budget
+    if n_workers == 0:
+        results = [_timed_start(guess, args, bounds, deadline)
+                   for guess in guesses]
+    else:
+        pool = _get_pool(n_workers)
+        jobs = [pool.submit(_timed_start, guess, args, bounds, deadline)
+                for guess in guesses]
+        # running starts give up at the deadline, queued ones at once
+        done, not_done = futures.wait(jobs, timeout=time_budget + 1.0)
+        for job in not_done:
+            job.cancel()
+        # keep submission order so ties resolve the same way every time
+        results = [job.result() for job in jobs
+                   if job in done and not job.cancelled()]
+    results = [res for res in results if res is not None]
+
+    nfev = sum(res.nfev for res in results)
+    if not results:
+        raise BridgeOptimizationError(
+            f"No start finished within {time_budget} s")
+    best = min(results, key=lambda res: res.fun)
+    best.n_starts = len(results)
+    best.nfev = nfev
+    print(f"[multistart] {best.n_starts}/{n_starts} starts, {nfev} "
+          f"evaluations, best cost {best.fun:.3g}")
+    if best.fun >= opt_tol:
+        raise BridgeOptimizationError(
+            f"No start met opt_tol={opt_tol:.3g} (best cost {best.fun:.3g} "
+            f"after {best.n_starts} starts and {nfev} evaluations)")
+    return best
+
+
+def wrap_angle(ang):
+    '''Map waveplate angles (degrees) into [-90, 90). hwp() and qwp() are
+    periodic in 180 degrees, so this does not change the Jones matrix.'''
+    return (np.asarray(ang, dtype=float) + 90.) % 180. - 90.
+
+
+def solve_bridge_off_state(hwp_ang, pc_static_jones, out_ang=0.):
+    '''Closed-form off-state bridge: angles [hwp_1, qwp_1, hwp_2] (degrees)
+    such that hwp->qwp->PC->hwp maps hwp(hwp_ang) @ [1, 0] onto V, i.e.
+    what_angles(..., off_state_only=True) vanishes.
+
+    The last hwp sends linear light at 2*hwp_2 to H, so the static Pockels
+    cell has to output that linear state. Pulling it back through the
+    Pockels cell gives an elliptical state w; the qwp aligned with the
+    ellipse axes turns w into linear light, and the first hwp rotates the
+    input onto it. out_ang picks hwp_2 from the family of solutions.'''
+    phi = 2*out_ang*toRad
+    w = np.linalg.solve(np.asarray(pc_static_jones),
+                        [np.cos(phi), np.sin(phi)])
+    # orientation of the polarization ellipse of w from its Stokes parameters
+    s1 = np.abs(w[0])**2 - np.abs(w[1])**2
+    s2 = 2*np.real(w[0]*np.conj(w[1]))
+    qwp_1 = 0.5*np.arctan2(s2, s1)
+    u = np.linalg.solve(qwp(qwp_1), w)
+    u = u*np.exp(-1j*np.angle(u[np.argmax(np.abs(u))]))
+    beta = np.arctan2(u[1].real, u[0].real)
+    hwp_1 = hwp_ang*toRad + beta/2
+    return wrap_angle(np.array([hwp_1, qwp_1, phi/2])/toRad)
+
+
+'''___Precomputed on-state bridge table___
+Solutions of set_bridge_to_hwp(..., off_state_only=False) on a fine grid
+of hwp angles, built offline with build_bridge_table() and stored as one
+small .npz. The grid is solved by continuation (each point warm-started
+from its neighbour), so every column is a single smooth branch and can
+be interpolated directly.'''
+
+bridge_table_file = os.path.join('cache', 'bridge_table_{model}.npz')
+bridge_table_polish_iter = 8
+_bridge_table = None
+
+# Shifts of [hwp_1, qwp_1, hwp_2, voltage] that leave the cost unchanged
+# (a hwp turned by 90 degrees only flips the global sign)
+_bridge_periods = np.array([90., 180., 90., 4.])
+
+
+def table_path(template, fname=None, model=None):
+    '''Solution tables are stored per Pockels cell model (by default the
+    current one).'''
+    fname = template if fname is None else fname
+    return fname.format(model=pockels_model_id if model is None else model)
+
+
+def _solve_bridge_branch(hwp_grid, pc_static_jones, pc_rot, seed=None):
+    # seed is an optional previous solution of the same grid, tried first
+    params = np.empty((len(hwp_grid), 4))
+    res = None
+    if seed is not None:
+        res = polish_bridge(seed[0], pc_static_jones, [hwp_grid[0], 0], pc_rot)
+    if res is None or res.fun >= opt_tol_a * 1e-1:
+        # offline, so spend more starts on the point that seeds the branch
+        res = multistart_bridge(pc_static_jones, [hwp_grid[0], 0], pc_rot,
+                                opt_tol=opt_tol_a * 1e-1,
+                                n_starts=4*multistart_starts)
+    params[0] = res.x
+    for i, hwp_ang in enumerate(hwp_grid[1:], start=1):
+        prev = params[i - 1]
+        args = (pc_static_jones, [hwp_ang, 0], pc_rot)
+        res = polish_bridge(prev if seed is None else seed[i], *args)
+        if res.fun >= opt_tol_a * 1e-1 and seed is not None:
+            res = polish_bridge(prev, *args)
+        if res.fun >= opt_tol_a * 1e-1:
+            guess = np.hstack([wrap_angle(prev[:3]), prev[3]])
+            res = minimize_bridge(guess, *args)
+        if res.fun >= opt_tol_a * 1e-1:
+            res = multistart_bridge(*args, opt_tol=opt_tol_a * 1e-1)
+        # store the solution on the branch of the previous grid point
+        shift = res.x - prev
+        params[i] = prev + (shift + _bridge_periods/2) % _bridge_periods \
+            - _bridge_periods/2
+    return params
+
+
+def build_bridge_table(step=0.25, fname=None, seed=None):
+    '''Solve the on-state bridge for Alice and Bob on a grid of hwp angles
+    over [-90, 90] and save it to fname. seed is an optional table (same
+    grid) whose solutions are used as warm starts.'''
+    fname = table_path(bridge_table_file, fname)
+    hwp_grid = np.linspace(-90., 90., int(round(180./step)) + 1)
+    if seed is not None and not np.array_equal(seed['hwp_angs'], hwp_grid):
+        seed = None
+    alice = _solve_bridge_branch(hwp_grid, jones_avg_alice_static,
+                                 pc_rot_alice,
+                                 None if seed is None else seed['alice'])
+    bob = _solve_bridge_branch(hwp_grid, jones_avg_bob_static, pc_rot_bob,
+                               None if seed is None else seed['bob'])
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    np.savez(fname, hwp_angs=hwp_grid, alice=alice, bob=bob)
+    return load_bridge_table(fname)
+
+
+def load_bridge_table(fname=None):
+    '''Load the bridge table into memory. Returns None if there is none.'''
+    global _bridge_table
+    fname = table_path(bridge_table_file, fname)
+    if not os.path.exists(fname):
+        _bridge_table = None
+        return None
+    with np.load(fname) as data:
+        _bridge_table = {key: data[key] for key in data.files}
+    return _bridge_table
+
+
+def lookup_bridge(hwp_ang, alice=True):
+    '''On-state bridge parameters [hwp_1, qwp_1, hwp_2, voltage] for
+    hwp_ang from the interpolated table, polished with a few warm-started
+    Gauss-Newton iterations (BFGS if that is not enough). Returns None if
+    there is no table or the result misses the tolerance.'''
+    table = _bridge_table if _bridge_table is not None else load_bridge_table()
+    if table is None:
+        return None
+    if alice:
+        column, jones, pc_rot = table['alice'], jones_avg_alice_static, pc_rot_alice
     else:
-        # in this case, you want to maximize overlap with theor_a_orth
-        # this is because you're going in the opposite direction in constructing a_1
-        # should act orthogonal to hwp(ang) @ [0,1]
-        return (np.abs( a_1))*5e-1
+        column, jones, pc_rot = table['bob'], jones_avg_bob_static, pc_rot_bob
+    # the target hwp is 180 degree periodic, like the table angles
+    target = wrap_angle(hwp_ang) if abs(hwp_ang) > 90. else hwp_ang
+    guess = np.array([np.interp(target, table['hwp_angs'], column[:, k])
+                      for k in range(4)])
+    res = polish_bridge(guess, jones, [hwp_ang, 0], pc_rot,
+                        n_iter=bridge_table_polish_iter)
+    if res.fun >= opt_tol_a * 1e-1:
+        guess[:3] = wrap_angle(guess[:3])
+        res = minimize_bridge(guess, jones, [hwp_ang, 0], pc_rot)
+    if res.fun >= opt_tol_a * 1e-1:
+        return None
+    return res
+
 
 @file_cache
-def set_bridge_to_hwp(hwp_ang, alice=True, off_state_only=False):
+def set_bridge_to_hwp(hwp_ang, alice=True, off_state_only=False,
+                      n_starts=None, time_budget=None, n_workers=None):
     '''given a hwp angle 'x', computes the angles for the
     the bridge to mimic a hwp at angle 'x' preceeding
-    a V polarizer.'''
+    a V polarizer. n_starts, time_budget and n_workers override the
+    multistart defaults for the on-state optimization.'''
     # optimized = False
-    
-    def optimize_bridge(jones_avg_static, pc_rot):
-        optimized = False
-        while not optimized:
-            if off_state_only is False:
-                guess = np.array([1.0, 0.0, 0.0, 0.1]) +\
-                    np.hstack([10*np.random.random(3), [0]])
-            else:
-                guess = np.array([1.0, 0.0, 0.0]) + 10*np.random.random(3) - 10*np.random.random(3)
-            res =\
-                optimize.minimize(what_angles, guess,
-                                  args=(jones_avg_static, [hwp_ang, 0],
-                                        pc_rot, off_state_only))
-            #print(res.fun)
-            if res.fun < opt_tol_a * 1e-1:
-                optimized = True
+
+    def solve_off_state(jones_avg_static, pc_rot):
+        # The off state has an analytic solution; only polish it numerically
+        # if rounding left it outside the tolerance.
+        args = (jones_avg_static, [hwp_ang, 0], pc_rot, True)
+        x = solve_bridge_off_state(hwp_ang, jones_avg_static)
+        res = optimize.OptimizeResult(x=x, fun=what_angles(x, *args),
+                                      success=True, nfev=1)
+        if res.fun >= opt_tol_a * 1e-1:
+            res = minimize_bridge(x, *args)
+            if res.fun >= opt_tol_a * 1e-1:
+                raise BridgeOptimizationError(
+                    f"Off-state bridge for hwp angle {hwp_ang} did not "
+                    f"converge (cost {res.fun:.3g})")
         return res
 
+    def optimize_bridge(jones_avg_static, pc_rot):
+        if off_state_only is True:
+            return solve_off_state(jones_avg_static, pc_rot)
+        res = lookup_bridge(hwp_ang, alice)
+        if res is not None:
+            return res
+        return multistart_bridge(jones_avg_static, [hwp_ang, 0], pc_rot,
+                                 off_state_only, opt_tol=opt_tol_a * 1e-1,
+                                 n_starts=n_starts, time_budget=time_budget,
+                                 n_workers=n_workers)
+
     if alice:
         res = optimize_bridge(jones_avg_alice_static, pc_rot_alice)
-        # while not optimized:
-        #     if off_state_only is False:
-        #         guess = np.array([1.0, 0.0, 0.0, 0.1]) +\
-        #             np.hstack([10*np.random.random(3), [0]])
-        #     else:
-        #         guess = np.array([1.0, 0.0, 0.0]) #+ 10*np.random.random(3) - 10*np.random.random(3)
-        #     res =\
-        #         optimize.minimize(what_angles, guess,
-        #                           args=(jones_avg_alice_static, [hwp_ang, 0],
-        #                                 pc_rot_alice, off_state_only))
-        #     #print(res.fun)
-        #     if res.fun < opt_tol_a * 1e-1:
-        #         optimized = True
     else:
         res = optimize_bridge(jones_avg_bob_static, pc_rot_bob)
-        # while not optimized:
-        #     if off_state_only is False:
-        #         guess = np.array([1.0, 0.0, 0.0, 0.1]) +\
-        #             np.hstack([10*np.random.random(3), [0]])
-        #     else:
-        #         guess = np.array([1.0, 0.0, 0.0]) + 10*np.random.random(3)
-        #     res =\
-        #         optimize.minimize(what_angles, guess,
-        #                           args=(jones_avg_bob_static, [hwp_ang, 0],
-        #                                 pc_rot_bob, off_state_only))
-        #     if res.fun < opt_tol_b * 1e-1:
-        #         optimized = True
 
     return res.x[:3]
 
-@file_cache
-def angles_bell_test(hwp_angs):
+'''___Bell-angle solution table___
+Bell-test solutions (Alice and Bob [hwp_1, qwp_1, hwp_2, voltage]) for
+many (angle_1, angle_2) pairs, filled in by sweep_bell_angles() and kept
+as one small .npz.'''
+
+bell_table_file = os.path.join('cache', 'bell_angle_table_{model}.npz')
+_bell_table = None
 
-    hwp_angs_alice = hwp_angs  # [-2.73387745,14.00312409]
+
+def load_bell_table(fname=None):
+    '''Load the Bell-angle table into memory. Returns None if there is none.'''
+    global _bell_table
+    fname = table_path(bell_table_file, fname)
+    if not os.path.exists(fname):
+        _bell_table = None
+        return None
+    with np.load(fname) as data:
+        _bell_table = {key: data[key] for key in data.files}
+    return _bell_table
+
+
+def lookup_bell_table(hwp_angs, max_distance=1e-9):
+    '''Stored (alice, bob) solutions for the table entry nearest to
+    hwp_angs, or None if there is none within max_distance degrees.'''
+    table = _bell_table if _bell_table is not None else load_bell_table()
+    if table is None or len(table['angles']) == 0:
+        return None
+    distance = np.max(np.abs(table['angles'] - np.asarray(hwp_angs)), axis=1)
+    i = np.argmin(distance)
+    if distance[i] > max_distance:
+        return None
+    return table['alice'][i], table['bob'][i]
+
+
+def _solve_bell_party(jones, hwp_angs, pc_rot, opt_tol, guess=None,
+                      **multistart_kwargs):
+    # warm start from a neighbouring solution before falling back to the
+    # full multistart
+    if guess is not None:
+        res = minimize_bridge(guess, jones, hwp_angs, pc_rot,
+                              bounds=bell_bounds)
+        if res.fun < opt_tol:
+            return res
+    return multistart_bridge(jones, hwp_angs, pc_rot, opt_tol=opt_tol,
+                             bounds=bell_bounds, **multistart_kwargs)
+
+
+def solve_bell_angles(hwp_angs, n_starts=None, time_budget=None,
+                      n_workers=None, guesses=None):
+    '''Solve the Alice and Bob Bell-test problems and return both
+    OptimizeResults. The (alice, bob) guesses, or else the nearest entry of
+    the Bell-angle table, are tried as a warm start first. With
+    n_workers=0 everything runs serially in this process, otherwise the
+    two parties run concurrently.'''
+    hwp_angs_alice = list(hwp_angs)  # [-2.73387745,14.00312409]
     hwp_angs_bob = [-i for i in hwp_angs_alice]  # [2.73387745,-14.00312409]
+    if guesses is None:
+        guesses = lookup_bell_table(hwp_angs, max_distance=np.inf)
+    guess_a, guess_b = guesses if guesses is not None else (None, None)
+    kwargs = dict(n_starts=n_starts, time_budget=time_budget,
+                  n_workers=n_workers)
+    problems = [
+        (jones_avg_alice_static, hwp_angs_alice, pc_rot_alice, opt_tol_a,
+         guess_a),
+        (jones_avg_bob_static, hwp_angs_bob, pc_rot_bob, opt_tol_b, guess_b),
+    ]
+    if n_workers == 0:
+        return tuple(_solve_bell_party(*problem, **kwargs)
+                     for problem in problems)
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+        jobs = [executor.submit(_solve_bell_party, *problem, **kwargs)
+                for problem in problems]
+        return tuple(job.result() for job in jobs)
 
-    optimized_a = False
-    optimized_b = False
-    redo_a = False
-    redo_b = False
-    while not optimized_a:
-        guess_a = np.array([1.0, 0.0, 0.0, 0.1]) +\
-            np.hstack([10*np.random.random(3), [0]])
-        res_a = \
-            optimize.minimize(what_angles, guess_a,
-                              args=(jones_avg_alice_static, hwp_angs_alice,
-                                    pc_rot_alice))
-        if res_a.x[3] < 0:  # negative pockels voltage or more than 1/2
-            guess_a[1] += 90  # flip qwp 90 degrees to get a positive voltage
-            redo_a = True
-        elif res_a.x[3] > 2:
-            redo_a = True
-            guess_a[2] -= 45  # try to flip a hwp to try and get a lower voltage
-            guess_a[1] += 90
-        if redo_a:
-            redo_a = False
-            res_a = \
-                optimize.minimize(what_angles, guess_a,
-                                  args=(jones_avg_alice_static, hwp_angs_alice,
-                                        pc_rot_alice))
-            if res_a.x[3] < 0 or  res_a.x[3] > 2:
-                res_a.fun += 2*opt_tol_a 
-           
-        if res_a.fun < opt_tol_a:
-            optimized_a = True
 
-    print("Set the Alice PC driver to: ", res_a.x[3]*quarter_wave_alice,
-          " turns")
+def _sweep_point(hwp_angs, n_starts, guesses=None):
+    try:
+        res_a, res_b = solve_bell_angles(hwp_angs, n_starts=n_starts,
+                                         n_workers=0, guesses=guesses)
+    except BridgeOptimizationError as e:
+        print(f"[sweep] {hwp_angs}: {e}")
+        return None
+    return res_a.x, res_b.x, [res_a.fun, res_b.fun]
+
+
+def sweep_bell_angles(angle_pairs, fname=None, n_starts=None,
+                      n_workers=None, guesses=None):
+    '''Solve the Bell-test problem for every (angle_1, angle_2) pair in a
+    process pool and merge the solutions into the Bell-angle table.
+    guesses optionally holds an (alice, bob) warm start per pair.
+    Returns a summary with the number solved and the pairs that failed.'''
+    fname = table_path(bell_table_file, fname)
+    n_workers = multistart_workers if n_workers is None else n_workers
+    angle_pairs = [[float(a), float(b)] for a, b in angle_pairs]
+    guesses = [None]*len(angle_pairs) if guesses is None else guesses
+    if n_workers == 0:
+        results = [_sweep_point(pair, n_starts, guess)
+                   for pair, guess in zip(angle_pairs, guesses)]
+    else:
+        results = list(_get_pool(n_workers).map(
+            partial(_with_model, _model_state(), _sweep_point),
+            angle_pairs, [n_starts]*len(angle_pairs), guesses))
+
+    table = load_bell_table(fname)
+    entries = {}
+    if table is not None:
+        for i, pair in enumerate(table['angles']):
+            entries[tuple(pair)] = (table['alice'][i], table['bob'][i],
+                                    table['cost'][i])
+    failed = []
+    for pair, result in zip(angle_pairs, results):
+        if result is None:
+            failed.append(pair)
+        else:
+            entries[tuple(pair)] = result
+    keys = sorted(entries)
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    tmp_fname = fname + '.tmp.npz'
+    np.savez(tmp_fname, angles=np.array(keys).reshape(-1, 2),
+             alice=np.array([entries[k][0] for k in keys]).reshape(-1, 4),
+             bob=np.array([entries[k][1] for k in keys]).reshape(-1, 4),
+             cost=np.array([entries[k][2] for k in keys]).reshape(-1, 2))
+    os.replace(tmp_fname, fname)
+    load_bell_table(fname)
+    return {'solved': len(angle_pairs) - len(failed), 'failed': failed,
+            'entries': len(keys), 'file': fname}
 
-    while not optimized_b:
-        guess_b = np.array([1.0, 0.0, 0.0, 0.1]) +\
-            np.hstack([10*np.random.random(3), [0]])
-
-        res_b = \
-            optimize.minimize(what_angles, guess_b,
-                              args=(jones_avg_bob_static, hwp_angs_bob,
-                                    pc_rot_bob))
-        if res_b.x[3] < 0:  # negative pockels voltage
-            # flip qwp 90 degrees to get a positive voltage
-            guess_b[1] += 90
-            redo_b = True
-        elif res_b.x[3] > 2:
-            guess_b[2] -= 45  # flip a hwp to try and get a lower voltage
-            guess_b[1] += 90
-            redo_b = True
-        if redo_b:
-            redo_b = False
-            res_b = \
-                optimize.minimize(what_angles, guess_b,
-                                  args=(jones_avg_bob_static, hwp_angs_bob,
-                                        pc_rot_bob))
-            if res_b.x[3] < 0 or  res_b.x[3] > 2:
-                res_b.fun += 2*opt_tol_b
-
-        if res_b.fun < opt_tol_b:
-            optimized_b = True
 
+@file_cache
+def angles_bell_test(hwp_angs, n_starts=None, time_budget=None):
+    '''Bridge angles and Pockels cell voltages for the Bell test. The
+    voltage range and angle limits are bounds of the optimization, so no
+    result has to be rejected and re-run. The Alice and Bob problems are
+    solved concurrently, each within time_budget seconds.'''
+    res_a, res_b = solve_bell_angles(hwp_angs, n_starts=n_starts,
+                                     time_budget=time_budget)
+
+    print("Set the Alice PC driver to: ", res_a.x[3]*quarter_wave_alice,
+          " turns")
     print("Set the Bob PC driver to:  ", res_b.x[3]*quarter_wave_bob,
           " turns")
     print(res_a.fun, res_b.fun)
 
     return (res_a.x[:3], res_b.x[:3])
+
+
+def prewarm(bridge_settings=(), bell_angles=(), n_workers=None,
+            progress=None, bridge_table=False):
+    '''Solve everything the server will ask for that is not cached yet:
+    the off-state bridge for each (hwp_ang, alice) in bridge_settings and
+    the Bell-test problem for each [angle_1, angle_2] in bell_angles (in
+    the process pool, into the Bell-angle table). With bridge_table=True
+    the bridge table of the current model is built first if there is
+    none. progress(done, total) is called as items finish. Returns the
+    numbers of items that were already cached, solved and failed.'''
+    if bridge_table and load_bridge_table() is None:
+        print(f"[prewarm] Building the bridge table for model {pockels_model_id}")
+        build_bridge_table()
+    bridge_todo = [(float(h), bool(alice)) for h, alice in bridge_settings
+                   if not set_bridge_to_hwp.cache_contains(
+                       float(h), alice=bool(alice), off_state_only=True)]
+    bell_todo = [[float(a), float(b)] for a, b in bell_angles
+                 if lookup_bell_table([a, b]) is None and
+                 not angles_bell_test.cache_contains([a, b])]
+    total = len(bridge_settings) + len(bell_angles)
+    summary = {'cached': total - len(bridge_todo) - len(bell_todo),
+               'solved': 0, 'failed': 0}
+
+    def report():
+        if progress is not None:
+            progress(summary['cached'] + summary['solved'] + summary['failed'],
+                     total)
+
+    report()
+    for hwp_ang, alice in bridge_todo:
+        try:
+            set_bridge_to_hwp(hwp_ang, alice=alice, off_state_only=True)
+            summary['solved'] += 1
+        except BridgeOptimizationError as e:
+            print(f"[prewarm] {e}")
+            summary['failed'] += 1
+        report()
+    if bell_todo:
+        sweep = sweep_bell_angles(bell_todo, n_workers=n_workers)
+        summary['solved'] += sweep['solved']
+        summary['failed'] += len(sweep['failed'])
+        report()
+    return summary
+
+
+'''___Cache migration after a Pockels cell recharacterization___'''
+
+
+def _voltage_seed(angles, pc_static_jones, theor_angles, pc_rot, n=401):
+    # cached results only keep the three angles, so scan the voltage
+    # (periodic in 4 quarter-wave units) for the best starting value
+    volts = np.linspace(0., 4., n)
+    params = np.column_stack([np.tile(angles[:3], (n, 1)), volts])
+    cost = what_angles_batch(params, pc_static_jones, theor_angles, pc_rot)
+    return np.hstack([angles[:3], volts[np.argmin(cost)]])
+
+
+def _party_model(alice):
+    if alice:
+        return jones_avg_alice_static, pc_rot_alice, opt_tol_a
+    return jones_avg_bob_static, pc_rot_bob, opt_tol_b
+
+
+def _resolve_bridge(old_angles, hwp_ang, alice=True, off_state_only=False,
+                    n_starts=None, time_budget=None):
+    if off_state_only is True:
+        # closed form, nothing to seed
+        return set_bridge_to_hwp.__wrapped__(hwp_ang, alice, True)
+    jones, pc_rot, _ = _party_model(alice)
+    args = (jones, [hwp_ang, 0], pc_rot)
+    res = minimize_bridge(_voltage_seed(old_angles, *args), *args)
+    if res.fun < opt_tol_a * 1e-1:
+        return res.x[:3]
+    # this runs in a pool worker, which must not use the pool itself
+    return set_bridge_to_hwp.__wrapped__(hwp_ang, alice, False,
+                                         n_starts=n_starts,
+                                         time_budget=time_budget,
+                                         n_workers=0)
+
+
+def _resolve_bell(old_angles, hwp_angs, n_starts=None, time_budget=None):
+    hwp_angs = list(hwp_angs)
+    results = []
+    for alice, old, theor in ((True, old_angles[0], hwp_angs),
+                              (False, old_angles[1], [-i for i in hwp_angs])):
+        jones, pc_rot, opt_tol = _party_model(alice)
+        guess = _voltage_seed(np.asarray(old), jones, theor, pc_rot)
+        guess[3] = np.clip(guess[3], *bell_bounds[3])
+        res = _solve_bell_party(jones, theor, pc_rot, opt_tol, guess=guess,
+                                n_starts=n_starts, time_budget=time_budget,
+                                n_workers=0)
+        results.append(res.x[:3])
+    return tuple(results)
+
+
+_resolvers = {'set_bridge_to_hwp': _resolve_bridge,
+              'angles_bell_test': _resolve_bell}
+
+
+def _migrate_entry(func, args, kwargs, old_value):
+    try:
+        new_value = _resolvers[func](old_value, *args, **kwargs)
+    except BridgeOptimizationError as e:
+        return None, str(e)
+    return new_value, None
+
+
+def _angle_shift(old, new):
+    # largest change of any waveplate angle, modulo the 180 degree period
+    return float(np.max(np.abs(wrap_angle(np.subtract(new, old)))))
+
+
+def migrate_cache(from_model=None, cache_dir='cache', n_workers=None):
+    '''Re-solve every cached bridge and Bell-angle result, and the solution
+    tables, computed under the Pockels cell model from_model (by default
+    the most recently used other model) for the current model, seeding
+    each one from its old solution. The work runs
+    as a batch in the process pool. Returns a report of the entries that
+    were migrated (with how far the angles moved, in degrees), failed to
+    converge, or could not be migrated because their arguments were not
+    recorded.'''
+    n_workers = multistart_workers if n_workers is None else n_workers
+    to_model = pockels_model_id
+    if from_model is None:
+        others = [m for m in cache_models(cache_dir) if m != to_model]
+        from_model = others[0] if others else to_model
+    report = {'from_model': from_model, 'to_model': to_model,
+              'migrated': [], 'failed': [], 'skipped': []}
+    if from_model == to_model:
+        return report
+    store = get_cache_store(cache_dir)
+    jobs = []
+    for func, key, args_json, created in store.entries(model=from_model):
+        found, old_value = store.get(func, key)
+        if func not in _resolvers or not found or not args_json:
+            report['skipped'].append({'func': func, 'key': key})
+            continue
+        args, kwargs = json.loads(args_json)
+        jobs.append((func, key, args_json, args, kwargs, old_value))
+
+    job_args = [(func, args, kwargs, old) for func, _, _, args, kwargs, old in jobs]
+    if n_workers == 0:
+        results = [_migrate_entry(*a) for a in job_args]
+    else:
+        results = list(_get_pool(n_workers).map(
+            partial(_with_model, _model_state(), _migrate_entry),
+            *zip(*job_args))) if jobs else []
+
+    for (func, key, args_json, args, kwargs, old_value), (new_value, error) \
+            in zip(jobs, results):
+        entry = {'func': func, 'args': args, 'kwargs': kwargs}
+        if error is not None:
+            report['failed'].append(dict(entry, error=error))
+            continue
+        new_key = f"{to_model}:{key.split(':', 1)[1]}"
+        store.put(func, new_key, new_value, args=args_json)
+        report['migrated'].append(dict(entry,
+                                       moved=_angle_shift(old_value, new_value)))
+
+    old_bell = load_bell_table(table_path(bell_table_file, model=from_model))
+    if old_bell is not None and len(old_bell['angles']):
+        guesses = list(zip(old_bell['alice'], old_bell['bob']))
+        load_bell_table()
+        summary = sweep_bell_angles(old_bell['angles'], n_workers=n_workers,
+                                    guesses=guesses)
+        report['bell_table'] = summary
+    else:
+        load_bell_table()
+
+    old_bridge = load_bridge_table(table_path(bridge_table_file,
+                                              model=from_model))
+    if old_bridge is not None:
+        step = float(np.diff(old_bridge['hwp_angs'][:2])[0])
+        new_bridge = build_bridge_table(step, seed=old_bridge)
+        report['bridge_table'] = {
+            'moved': max(_angle_shift(old_bridge[party][:, :3],
+                                      new_bridge[party][:, :3])
+                         for party in ('alice', 'bob'))}
+    else:
+        load_bridge_table()
+    print(f"[migrate] {len(report['migrated'])} migrated, "
+          f"{len(report['failed'])} failed, {len(report['skipped'])} skipped")
+    return report
+
+
+def cache_models(cache_dir='cache'):
+    '''Pockels cell model fingerprints in the cache, most recent first.'''
+    models = []
+    for func, key, args, created in reversed(
+            get_cache_store(cache_dir).entries()):
+        model = key.split(':', 1)[0] if ':' in key else None
+        if model is not None and model not in models:
+            models.append(model)
+    return models
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Precompute the on-state bridge table.')
+    parser.add_argument('--step', type=float, default=0.25,
+                        help='grid step in degrees')
+    parser.add_argument('--out', default=bridge_table_file)
+    parser.add_argument('--config', help='take the Pockels cell model from '
+                        'the pockels_cell section of this config file')
+    cli_args = parser.parse_args()
+    if cli_args.config is not None:
+        import yaml
+        with open(cli_args.config) as f:
+            set_pockels_model(yaml.safe_load(f)['pockels_cell'])
+    out = table_path(cli_args.out)
+    table = build_bridge_table(cli_args.step, out)
+    print(f"Saved {len(table['hwp_angs'])} grid points to {out}")
@@ -0,0 +1,112 @@
+"""
+Micro-benchmark of decoding monitor stream entries: the generic decoder
+(every field through JSON) against the per-channel schemas of redis_read,
+with and without restricting the decoded fields.
+
+A sample of a live stream can be recorded to a file and replayed later;
+without a sample file, synthetic entries with exactly the fields of
+redis_read.SCHEMAS are used. Payloads a live stream carries beyond those
+only show up in a recorded sample.
+
+Usage:
+    python bench_redis_decode.py --record HOST [--port 6379] [--count 1000] sample.json
+    python bench_redis_decode.py [sample.json] [--repeat 20]
+"""
+
+import argparse
+import json
+import timeit
+
+import redis_read as r_read
+
+
+def record(host, port, count, fname):
+    """Save the last count raw entries of the counts and violation streams."""
+    r = r_read.connect_to_redis(host, port)
+    sample = {}
+    for channel in (r_read.CHANNELCOUNTS, r_read.CHANNELVIOLATION):
+        entries = r.xrevrange(channel, count=count)[::-1]
+        sample[channel] = [
+            (id.decode(), {k.decode("latin-1"): v.decode("latin-1")
+                           for k, v in fields.items()})
+            for id, fields in entries
+        ]
+    with open(fname, "w") as f:
+        json.dump(sample, f)
+
+
+def load(fname):
+    """{channel: XREAD-style reply} of a recorded sample."""
+    with open(fname) as f:
+        sample = json.load(f)
+    return {
+        channel: (channel.encode(), [
+            (id.encode(), {k.encode("latin-1"): v.encode("latin-1")
+                           for k, v in fields.items()})
+            for id, fields in entries
+        ])
+        for channel, entries in sample.items()
+    }
+
+
+def synthetic(count=1000):
+    counts = {"As": 123456, "Bs": 234567, "C": 34567}
+    entry_counts = {
+        b"isTrim": b"1",
+        b"integrationTime": b"0.2",
+        b"VV": json.dumps(counts).encode(),
+        b"VV_PC": json.dumps(counts).encode(),
+        b"VV_Background": json.dumps(counts).encode(),
+    }
+    entry_violation = {
+        b"isTrim": b"1",
+        b"integrationTime": b"0.2",
+        b"VV": json.dumps([[100000, 1200, 1300, 900]] * 4).encode(),
+    }
+    return {
+        r_read.CHANNELCOUNTS: (r_read.CHANNELCOUNTS.encode(), [
+            (f"{i}-0".encode(), entry_counts) for i in range(count)
+        ]),
+        r_read.CHANNELVIOLATION: (r_read.CHANNELVIOLATION.encode(), [
+            (f"{i}-0".encode(), entry_violation) for i in range(count)
+        ]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("sample", nargs="?")
+    parser.add_argument("--record", metavar="HOST")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record, args.port, args.count, args.sample or "sample.json")
+        return
+    replies = load(args.sample) if args.sample else synthetic(args.count)
+
+    fields = {
+        r_read.CHANNELCOUNTS: ("isTrim", "integrationTime", "VV", "VV_PC",
+                               "VV_Background"),
+        r_read.CHANNELVIOLATION: ("isTrim", "VV"),
+    }
+    for channel, reply in replies.items():
+        schema = r_read.SCHEMAS[channel]
+        n = len(reply[1])
+        cases = {
+            "generic": lambda: r_read.decode_data(reply),
+            "schema": lambda: r_read.decode_data(reply, schema),
+            "schema+fields": lambda: r_read.decode_data(
+                reply, schema, fields[channel]
+            ),
+        }
+        print(f"{channel}: {n} entries")
+        for name, fn in cases.items():
+            best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+            print(f"  {name:14s} {1e6 * best / max(n, 1):8.2f} us/entry")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Indexed on-disk store for the optimizer cache.
+
+All cached results live in a single SQLite database, one row per
+(function, key), instead of one pickle file per entry. Writes are
+transactions, so a crash never leaves a half-written entry behind, and
+every value carries a checksum that is verified on read; a corrupted
+entry is dropped and reported as a miss so that it gets recomputed.
+SQLite's WAL mode lets several worker processes read and write the same
+store concurrently.
+
+Usage:
+    python cache_store.py list [--func NAME] [--model FINGERPRINT]
+    python cache_store.py inspect KEY
+    python cache_store.py export OUT.json [--func NAME] [--model FINGERPRINT]
+    python cache_store.py prune [--func NAME] [--model FINGERPRINT] [--older-than DAYS]
+    python cache_store.py import CACHE_DIR [--model FINGERPRINT]
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_PATH = os.path.join("cache", "cache.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    func TEXT NOT NULL,
+    key TEXT NOT NULL,
+    args TEXT,
+    value BLOB NOT NULL,
+    checksum TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (func, key)
+)
+"""
+
+
+def checksum(blob):
+    return hashlib.sha256(blob).hexdigest()
+
+
+class CacheStore:
+    """
+    A (func, key) -> value store backed by one SQLite file. Connections are
+    opened per thread and per process, so a store object can be shared by
+    a server's worker threads and inherited by forked worker processes.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as con:
+            con.execute(SCHEMA)
+
+    def _connect(self):
+        con = getattr(self._local, "con", None)
+        if con is None or self._local.pid != os.getpid():
+            con = sqlite3.connect(self.path, timeout=self.timeout)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            self._local.con = con
+            self._local.pid = os.getpid()
+        return con
+
+    def get(self, func, key):
+        """Return (True, value), or (False, None) on a miss. Entries whose
+        checksum does not match are deleted and count as a miss."""
+        con = self._connect()
+        row = con.execute(
+            "SELECT value, checksum FROM entries WHERE func=? AND key=?",
+            (func, key),
+        ).fetchone()
+        if row is None:
+            return False, None
+        blob, stored = row
+        if checksum(blob) != stored:
+            print(f"[cache] Corrupted entry {func} {key}, recomputing")
+            self.delete(func, key)
+            return False, None
+        return True, pickle.loads(blob)
+
+    def put(self, func, key, value, args=None):
+        blob = pickle.dumps(value)
+        with self._connect() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (func, key, args, blob, checksum(blob), time.time()),
+            )
+
+    def delete(self, func, key):
+        with self._connect() as con:
+            con.execute(
+                "DELETE FROM entries WHERE func=? AND key=?", (func, key)
+            )
+
+    @staticmethod
+    def _where(func=None, model=None):
+        # keys are "<model fingerprint>:<argument hash>"
+        query = " WHERE 1=1"
+        params = []
+        if func is not None:
+            query += " AND func=?"
+            params.append(func)
+        if model is not None:
+            query += " AND key LIKE ?"
+            params.append(model + ":%")
+        return query, params
+
+    def entries(self, func=None, model=None):
+        """List (func, key, args, created) for every entry, oldest first."""
+        where, params = self._where(func, model)
+        query = "SELECT func, key, args, created FROM entries" + where
+        return self._connect().execute(query + " ORDER BY created", params).fetchall()
+
+    def find(self, key):
+        """All (func, key) pairs whose key contains the given text."""
+        return self._connect().execute(
+            "SELECT func, key FROM entries WHERE key LIKE ?", ("%" + key + "%",)
+        ).fetchall()
+
+    def prune(self, func=None, older_than=None, model=None):
+        """Delete entries, optionally only for func, for one Pockels cell
+        model and/or only those created more than older_than seconds ago.
+        Returns the number removed."""
+        where, params = self._where(func, model)
+        query = "DELETE FROM entries" + where
+        if older_than is not None:
+            query += " AND created < ?"
+            params.append(time.time() - older_than)
+        with self._connect() as con:
+            return con.execute(query, params).rowcount
+
+    def import_pickles(self, cache_dir, model=None):
+        """Import legacy <func>_<md5>.pkl files, filed under the given Pockels
+        cell model fingerprint. Unreadable files are skipped."""
+        n = 0
+        for fname in glob.glob(os.path.join(cache_dir, "*.pkl")):
+            func, _, key = os.path.basename(fname)[:-4].rpartition("_")
+            try:
+                with open(fname, "rb") as f:
+                    value = pickle.load(f)
+            except Exception as e:
+                print(f"[cache] Skipping {fname}: {e}")
+                continue
+            if model is not None:
+                key = f"{model}:{key}"
+            self.put(func, key, value)
+            n += 1
+        return n
+
+
+def jsonable(obj):
+    """Convert numpy values (also nested in lists/tuples) for json."""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, (list, tuple)):
+        return [jsonable(o) for o in obj]
+    if isinstance(obj, dict):
+        return {k: jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the optimizer cache.")
+    parser.add_argument("--db", default=DEFAULT_PATH)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_list = sub.add_parser("list")
+    p_list.add_argument("--func")
+    p_list.add_argument("--model", help="Pockels cell model fingerprint")
+    p_inspect = sub.add_parser("inspect")
+    p_inspect.add_argument("key", help="key or part of a key")
+    p_export = sub.add_parser("export")
+    p_export.add_argument("out")
+    p_export.add_argument("--func")
+    p_export.add_argument("--model")
+    p_prune = sub.add_parser("prune")
+    p_prune.add_argument("--func")
+    p_prune.add_argument("--model")
+    p_prune.add_argument("--older-than", type=float, help="age in days")
+    p_import = sub.add_parser("import")
+    p_import.add_argument("cache_dir")
+    p_import.add_argument("--model", help="fingerprint the pickles were computed with")
+    args = parser.parse_args()
+
+    store = CacheStore(args.db)
+    if args.command == "list":
+        for func, key, call_args, created in store.entries(args.func, args.model):
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created))
+            print(f"{stamp}  {func}  {key}  {call_args or ''}")
+    elif args.command == "inspect":
+        for func, key in store.find(args.key):
+            found, value = store.get(func, key)
+            print(f"{func} {key}: {value if found else '<corrupted>'}")
+    elif args.command == "export":
+        out = []
+        for func, key, call_args, created in store.entries(args.func, args.model):
+            found, value = store.get(func, key)
+            if found:
+                out.append({"func": func, "key": key, "args": call_args,
+                            "created": created, "value": jsonable(value)})
+        with open(args.out, "w") as f:
+            json.dump(out, f, indent=2)
+        print(f"Exported {len(out)} entries to {args.out}")
+    elif args.command == "prune":
+        older_than = None if args.older_than is None else args.older_than*86400
+        print(f"Removed {store.prune(args.func, older_than, args.model)} entries")
+    elif args.command == "import":
+        print(f"Imported {store.import_pickles(args.cache_dir, args.model)} entries")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Background consumers of the monitor streams.
+
+One thread per stream follows it and keeps the trimmed samples in a numpy
+ring buffer, stamped with the local time at which each one was measured.
+Sums over any time window are then a vectorized query on data that has
+already arrived, so calibration steps, get_power, get_counts and
+get_violation share a single consumer per stream instead of each polling
+Redis.
+
+monitor:counts samples give the singles and coincidences (and the
+efficiencies derived from them), monitor:violationstats samples the
+counts per setting pair from which the CH (Eberhard) statistic J follows.
+"""
+
+import threading
+
+import numpy as np
+
+import redis_read as r_read
+
+WINDOWS = ("VV", "VV_PC", "VV_Background")
+COUNTS = ("As", "Bs", "C")
+COLUMNS = [(window, count) for window in WINDOWS for count in COUNTS]
+
+# Layout of the 4x4 VV matrix of monitor:violationstats: one row per
+# setting pair (a, b) in the order 00, 01, 10, 11, and per row the number
+# of trials, Alice's detections, Bob's detections and coincidences.
+SETTINGS = ((0, 0), (0, 1), (1, 0), (1, 1))
+TRIALS, SINGLES_A, SINGLES_B, COINC = range(4)
+
+
+def efficiencies(counts):
+    """Add effA, effB and effAB to a {As, Bs, C} dict, as get_power does."""
+    try:
+        counts["effA"] = counts["C"] / counts["Bs"]
+        counts["effB"] = counts["C"] / counts["As"]
+        counts["effAB"] = counts["C"] / np.sqrt(counts["As"] * counts["Bs"])
+    except ZeroDivisionError:
+        counts["effA"] = counts["effB"] = counts["effAB"] = np.inf
+    return counts
+
+
+def ch_statistic(vv):
+    """
+    CH (Eberhard) statistic of a VV matrix of summed counts,
+        J = P(++|00) - P(+0|01) - P(0+|10) - P(++|11),
+    which is at most 0 for local realistic models, so J > 0 is a
+    violation. sigma is the Poisson uncertainty of J. Returns
+    (J, sigma); both are nan while a setting pair has no trials.
+    """
+    vv = np.asarray(vv, dtype=float)
+    trials = vv[:, TRIALS]
+    if np.any(trials <= 0):
+        return np.nan, np.nan
+    # the counts that enter J, each with its sign
+    terms = np.array([
+        vv[0, COINC],
+        vv[1, SINGLES_A] - vv[1, COINC],
+        vv[2, SINGLES_B] - vv[2, COINC],
+        vv[3, COINC],
+    ])
+    signs = np.array([1.0, -1.0, -1.0, -1.0])
+    J = np.sum(signs * terms / trials)
+    sigma = np.sqrt(np.sum(terms / trials**2))
+    return float(J), float(sigma)
+
+
+class SampleBuffer:
+    """
+    Ring buffer of the last `capacity` samples, each an array of the
+    given shape covering [end - integrationTime, end] in local time.
+    Subclasses turn stream entries into rows (row) and window sums into
+    results (window).
+    """
+
+    shape = ()
+    # the fields of the stream entries that are read
+    fields = ("isTrim", "integrationTime")
+
+    def __init__(self, capacity=36000):
+        self.capacity = capacity
+        self.end = np.full(capacity, np.nan)
+        self.start = np.full(capacity, np.nan)
+        self.values = np.zeros((capacity,) + tuple(self.shape))
+        self.n_samples = 0
+        self.latest = -np.inf
+        self.integration_time = None
+        self._cond = threading.Condition()
+
+    def row(self, sample):
+        raise NotImplementedError
+
+    def append(self, end, integration_time, sample):
+        row = self.row(sample)
+        with self._cond:
+            i = self.n_samples % self.capacity
+            self.end[i] = end
+            self.start[i] = end - integration_time
+            self.values[i] = row
+            self.n_samples += 1
+            self.latest = max(self.latest, end)
+            self.integration_time = integration_time
+            self._cond.notify_all()
+
+    def wait_until(self, t, timeout=None):
+        """Wait until every sample ending by t has arrived, i.e. the next
+        one would end after t."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self.latest + (self.integration_time or 0) > t, timeout
+            )
+
+    def total(self, t0, t1):
+        """Sum of the samples measured entirely within [t0, t1], their
+        number and the time they cover."""
+        with self._cond:
+            mask = (self.start >= t0) & (self.end <= t1)
+            sums = self.values[mask].sum(axis=0)
+            covered = float(np.sum(self.end[mask] - self.start[mask]))
+        return sums, int(np.count_nonzero(mask)), covered
+
+    def status(self):
+        with self._cond:
+            return {
+                "samples": min(self.n_samples, self.capacity),
+                "latest": None if self.n_samples == 0 else self.latest,
+                "integration_time": self.integration_time,
+            }
+
+
+class CountsBuffer(SampleBuffer):
+    """Singles and coincidences of the monitor:counts samples."""
+
+    shape = (len(COLUMNS),)
+    fields = SampleBuffer.fields + WINDOWS
+
+    def row(self, sample):
+        return [sample.get(window, {}).get(count, 0) for window, count in COLUMNS]
+
+    def window(self, t0, t1):
+        """Summed counts over [t0, t1] in the format of
+        redis_read.get_power, plus the number of samples and the time
+        they cover."""
+        sums, n, covered = self.total(t0, t1)
+        ret = {"isTrim": n, "integrationTime": covered, "samples": n,
+               "t0": t0, "t1": t1}
+        for window in WINDOWS:
+            ret[window] = {}
+        for (window, count), value in zip(COLUMNS, sums):
+            ret[window][count] = int(value)
+        for window in WINDOWS:
+            efficiencies(ret[window])
+        return ret
+
+
+class ViolationBuffer(SampleBuffer):
+    """VV matrices of the monitor:violationstats samples."""
+
+    shape = (len(SETTINGS), 4)
+    fields = SampleBuffer.fields + ("VV",)
+
+    def row(self, sample):
+        return np.asarray(sample["VV"], dtype=float)
+
+    def window(self, t0, t1):
+        """Summed VV over [t0, t1] (as redis_read.get_power_pockels
+        returns it) with the CH statistic J, its uncertainty and the
+        number of standard deviations of the violation."""
+        vv, n, covered = self.total(t0, t1)
+        J, sigma = ch_statistic(vv)
+        return {
+            "VV": vv.astype(int).tolist(),
+            "J": J,
+            "sigma": sigma,
+            "violation": J / sigma if sigma > 0 else np.nan,
+            "samples": n,
+            "integrationTime": covered,
+            "t0": t0,
+            "t1": t1,
+        }
+
+
+class StreamSubscriber(threading.Thread):
+    """
+    Follows a stream into a SampleBuffer, reconnecting with exponential
+    backoff (from retry up to max_retry seconds) and resuming after the
+    last entry seen if the connection drops.
+    """
+
+    def __init__(self, host, port, channel, buffer, retry=1.0, max_retry=30.0):
+        super().__init__(name=channel, daemon=True)
+        self.host = host
+        self.port = port
+        self.channel = channel
+        self.retry = retry
+        self.max_retry = max_retry
+        self.buffer = buffer
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        last_id = "$"
+        retry = self.retry
+        while not self._stop_event.is_set():
+            try:
+                r = r_read.connect_to_redis(self.host, self.port)
+                # stream IDs are stamped by the Redis server's clock
+                offset = r_read.redis_clock_offset(r)
+                retry = self.retry
+                for timeStamp, data in r_read.follow_stream(
+                        r, self.channel, last_id, stop=self._stop_event,
+                        fields=self.buffer.fields):
+                    last_id = timeStamp
+                    if data.get("isTrim") != 1:
+                        continue
+                    end = int(timeStamp.split("-")[0]) / 1000 - offset
+                    self.buffer.append(end, data["integrationTime"], data)
+                self.error = None
+            except Exception as e:
+                self.error = str(e)
+                print(f"[monitor] {self.channel} reader failed, retrying in {retry:.0f} s: {e}")
+                self._stop_event.wait(retry)
+                retry = min(2 * retry, self.max_retry)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def window(self, t0, t1, timeout=None):
+        """buffer.window(t0, t1), waiting up to timeout seconds for the
+        samples up to t1 to arrive. Raises TimeoutError if they do not."""
+        if not self.buffer.wait_until(t1, timeout):
+            raise TimeoutError(
+                f"No samples up to {t1:.1f} from {self.channel} "
+                f"({self.error or 'stream idle'})"
+            )
+        return self.buffer.window(t0, t1)
+
+    def status(self):
+        return dict(self.buffer.status(), running=self.is_alive(),
+                    error=self.error)
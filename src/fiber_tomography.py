@@ -0,0 +1,150 @@
+"""
+Fiber polarization estimation from a fixed set of measurements.
+
+A fiber acts on polarization as an SU(2) unitary, i.e. a rotation R of the
+Stokes vector. The compensation plates (a HWP and a QWP in front of the
+fiber) turn the horizontally polarized photon into a probe state p, and
+the coincidences at an analyzer that passes the state s then follow
+
+    counts = a + c . p,    c = (N/2) R^T s
+
+which is linear in the offset a and the vector c. Measuring a few probe
+states at a few analyzer settings therefore gives a and c for every
+analyzer in one least-squares solve, the analyzer directions give R, and
+the compensation follows in closed form: the plates prepare -R^T s for
+the calibration analyzer, which the fiber turns into the state that
+analyzer blocks. The number of integrations is the number of probes
+times the number of analyzers, however far the fiber has drifted.
+"""
+
+import numpy as np
+
+from beacon_bridge_optimizations import hwp_batch, qwp_batch
+
+# Probe states as Stokes vectors (H, D and R along the axes); four
+# affinely independent states determine a and c for each analyzer
+PROBES = {
+    "H": (1.0, 0.0, 0.0),
+    "V": (-1.0, 0.0, 0.0),
+    "D": (0.0, 1.0, 0.0),
+    "R": (0.0, 0.0, 1.0),
+}
+ORDERS = ("hwp_qwp", "qwp_hwp")
+
+
+def stokes(jones):
+    """Normalized Stokes vectors of Jones vectors (..., 2)."""
+    jones = np.asarray(jones, dtype=complex)
+    ex, ey = jones[..., 0], jones[..., 1]
+    cross = np.conj(ex) * ey
+    s = np.stack([
+        np.abs(ex) ** 2 - np.abs(ey) ** 2, 2 * cross.real, 2 * cross.imag
+    ], axis=-1)
+    return s / (np.abs(ex) ** 2 + np.abs(ey) ** 2)[..., None]
+
+
+def linear_stokes(angle):
+    """Stokes vector of linear polarization at angle degrees."""
+    phi = np.deg2rad(2 * np.asarray(angle, dtype=float))
+    return np.stack([np.cos(phi), np.sin(phi), np.zeros_like(phi)], axis=-1)
+
+
+def analyzer_stokes(hwp_angle):
+    """State passed by an analyzer HWP at hwp_angle degrees in front of a
+    polarizer: linear at twice the angle. (If the polarizer passes the
+    orthogonal state instead, every analyzer flips, which leaves the
+    compensation unchanged.)"""
+    return linear_stokes(2 * np.asarray(hwp_angle, dtype=float))
+
+
+def compensator_output(hwp_angle, qwp_angle, order="hwp_qwp"):
+    """Stokes vectors of H after the compensation plates at the given
+    angles (degrees, arrays broadcast), in the order the light passes."""
+    h = hwp_batch(np.deg2rad(hwp_angle))
+    q = qwp_batch(np.deg2rad(qwp_angle))
+    jones = q @ h if order == "hwp_qwp" else h @ q
+    return stokes(jones[..., :, 0])
+
+
+def prepare_angles(target, order="hwp_qwp"):
+    """
+    HWP and QWP angles in degrees that turn H into the polarization with
+    Stokes vector target, in closed form: a QWP at the azimuth psi of the
+    target ellipse after a HWP setting the linear polarization at psi +/-
+    chi (chi the ellipticity angle), or a QWP at +/-chi followed by a HWP
+    reflecting the azimuth onto psi. Of the two signs the one that
+    reproduces the target with the Jones matrices is returned.
+    """
+    t = np.asarray(target, dtype=float)
+    t = t / np.linalg.norm(t)
+    psi = 0.5 * np.degrees(np.arctan2(t[1], t[0]))
+    chi = 0.5 * np.degrees(np.arcsin(np.clip(t[2], -1.0, 1.0)))
+    signs = np.array([1.0, -1.0])
+    if order == "hwp_qwp":
+        hwp_angle = (psi + signs * chi) / 2
+        qwp_angle = np.full(2, psi)
+    elif order == "qwp_hwp":
+        qwp_angle = signs * chi
+        hwp_angle = (psi + qwp_angle) / 2
+    else:
+        raise ValueError(f"Invalid plate order: {order}. Must be one of {ORDERS}")
+    error = np.linalg.norm(compensator_output(hwp_angle, qwp_angle, order) - t, axis=-1)
+    i = int(np.argmin(error))
+    return float(hwp_angle[i]), float(qwp_angle[i])
+
+
+def estimate(probes, analyzers, counts):
+    """
+    Fit counts (K probes x J analyzers) for probe Stokes vectors (K, 3)
+    and analyzer Stokes vectors (J, 3). Returns a dict with the offset a
+    and vector c of every analyzer, the visibilities |c|/a, the residuals,
+    and the fiber rotation R (the nearest rotation with R^T s_j along c_j;
+    fully determined only by two or more non-parallel analyzers).
+    """
+    probes = np.asarray(probes, dtype=float)
+    analyzers = np.atleast_2d(np.asarray(analyzers, dtype=float))
+    counts = np.asarray(counts, dtype=float).reshape(len(probes), len(analyzers))
+    A = np.hstack([np.ones((len(probes), 1)), probes])
+    coeffs = np.linalg.lstsq(A, counts, rcond=None)[0]
+    offset, c = coeffs[0], coeffs[1:].T
+    amplitude = np.linalg.norm(c, axis=1)
+    directions = c / np.where(amplitude > 0, amplitude, 1.0)[:, None]
+    # Kabsch: the rotation Q = R^T taking each analyzer onto its direction,
+    # weighted by how well the analyzer resolves it
+    cov = (amplitude[:, None] * directions).T @ analyzers
+    U, _, Vt = np.linalg.svd(cov)
+    d = np.sign(np.linalg.det(U @ Vt)) or 1.0
+    Q = U @ np.diag([1.0, 1.0, d]) @ Vt
+    return {
+        "offset": offset,
+        "c": c,
+        "visibility": amplitude / np.where(offset != 0, offset, np.inf),
+        "residuals": counts - A @ coeffs,
+        "rotation": Q.T,
+        "determined": bool(np.linalg.matrix_rank(analyzers, tol=1e-6) >= 2),
+    }
+
+
+def axis_angle(rotation):
+    """Axis (Stokes) and angle in degrees of a rotation matrix."""
+    angle = np.arccos(np.clip((np.trace(rotation) - 1) / 2, -1.0, 1.0))
+    axis = np.array([
+        rotation[2, 1] - rotation[1, 2],
+        rotation[0, 2] - rotation[2, 0],
+        rotation[1, 0] - rotation[0, 1],
+    ])
+    norm = np.linalg.norm(axis)
+    if norm < 1e-12:
+        # no rotation, or a half turn whose axis is the +1 eigenvector
+        w, v = np.linalg.eigh((rotation + rotation.T) / 2)
+        axis = v[:, np.argmax(w)]
+    else:
+        axis = axis / norm
+    return axis, float(np.degrees(angle))
+
+
+def compensation(result, analyzer, order="hwp_qwp"):
+    """HWP and QWP angles that minimize the counts at the analyzer with
+    Stokes vector analyzer, from the fitted rotation."""
+    target = -result["rotation"].T @ np.asarray(analyzer, dtype=float)
+    return prepare_angles(target, order)
@@ -0,0 +1,191 @@
+"""
+Planning of waveplate moves against the last known motor positions.
+
+Half- and quarter-wave plates act the same at theta and theta + 180 degrees,
+so a target angle can be replaced by the equivalent position closest to
+where the motor already is, and a motor that is already there (within a
+tolerance) does not have to move at all.
+"""
+
+import threading
+import time
+
+DEFAULT_TOLERANCE = 0.01  # degrees
+# how close a motor has to come to its target to count as arrived; looser
+# than DEFAULT_TOLERANCE, as the mounts only repeat to about 0.1 degree
+DEFAULT_SETTLE_TOLERANCE = 0.2  # degrees
+DEFAULT_PERIOD = 180.0  # degrees
+MOUNT_PERIOD = 360.0  # degrees, a full turn of any rotation mount
+DEFAULT_MAX_AGE = 300.0  # seconds
+
+
+def is_waveplate(name):
+    return "HWP" in name or "QWP" in name
+
+
+def nearest_equivalent(target, current, period=DEFAULT_PERIOD, limits=None):
+    """The angle target + k*period closest to current, kept within
+    limits=(low, high) if given (target itself if no equivalent fits)."""
+    k = round((current - target) / period)
+    candidates = [target + (k + dk) * period for dk in (0, -1, 1)]
+    if limits is not None:
+        low, high = limits
+        candidates = [c for c in candidates if low <= c <= high]
+        if not candidates:
+            return target
+    return min(candidates, key=lambda c: abs(c - current))
+
+
+def plan_moves(targets, current, tolerance=DEFAULT_TOLERANCE,
+               period=DEFAULT_PERIOD, limits=None):
+    """
+    Split {name: angle} targets into the moves that are needed, with
+    waveplate targets rewritten to their nearest equivalent, and the
+    names that are already in place. Motors with no known position
+    always move to the target as given.
+    Returns (moves, skipped).
+    """
+    moves = {}
+    skipped = []
+    for name, target in targets.items():
+        target = float(target)
+        pos = current.get(name)
+        if pos is None:
+            moves[name] = target
+            continue
+        if is_waveplate(name):
+            target = nearest_equivalent(target, pos, period, limits)
+        if abs(target - pos) <= tolerance:
+            skipped.append(name)
+        else:
+            moves[name] = target
+    return moves, skipped
+
+
+def settled(previous, current, tolerance=DEFAULT_TOLERANCE):
+    """Whether two consecutive readbacks ({name: position}) agree, i.e.
+    the motors have stopped. A failed readback (None) never counts."""
+    return all(
+        current.get(name) is not None and previous.get(name) is not None
+        and abs(current[name] - previous[name]) <= tolerance
+        for name in current
+    )
+
+
+def at_targets(current, targets, tolerance=DEFAULT_SETTLE_TOLERANCE,
+               period=DEFAULT_PERIOD):
+    """Whether readbacks ({name: position}) are within tolerance of the
+    commanded targets ({name: angle}). Waveplates count at any angle
+    equivalent modulo period, other mounts modulo a full turn, as
+    controllers may read back a different turn than was commanded. A
+    failed readback (None) never counts."""
+    for name, target in targets.items():
+        pos = current.get(name)
+        if pos is None:
+            return False
+        turn = period if is_waveplate(name) else MOUNT_PERIOD
+        target = nearest_equivalent(float(target), pos, turn)
+        if abs(target - pos) > tolerance:
+            return False
+    return True
+
+
+def travel(start, end, period=DEFAULT_PERIOD):
+    """Total rotation in degrees to go from positions start to targets end
+    ({name: angle}); waveplates take the nearest equivalent angle and
+    motors without a known start position are not counted."""
+    total = 0.0
+    for name, target in end.items():
+        pos = start.get(name)
+        if pos is None:
+            continue
+        if is_waveplate(name):
+            target = nearest_equivalent(target, pos, period)
+        total += abs(target - pos)
+    return total
+
+
+def order_for_travel(steps, start=None, period=DEFAULT_PERIOD):
+    """
+    An order of steps (a list of {name: angle}) that keeps the total
+    rotation low: nearest neighbour from the start positions (or from the
+    best first step), improved by reversing segments (2-opt) while that
+    helps. Returns the list of step indices.
+    """
+    n = len(steps)
+    if n < 3 and not start:
+        return list(range(n))
+    cost = [[travel(a, b, period) for b in steps] for a in steps]
+    first = [travel(start, b, period) if start else 0.0 for b in steps]
+
+    def length(order):
+        return first[order[0]] + sum(cost[i][j] for i, j in zip(order, order[1:]))
+
+    def nearest_neighbour(begin):
+        order = [begin]
+        left = set(range(n)) - {begin}
+        while left:
+            nxt = min(left, key=lambda j: cost[order[-1]][j])
+            order.append(nxt)
+            left.remove(nxt)
+        return order
+
+    begins = [min(range(n), key=first.__getitem__)] if start else range(n)
+    order = min((nearest_neighbour(b) for b in begins), key=length)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(n - 1):
+            for j in range(i + 1, n):
+                candidate = order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+                if length(candidate) < length(order) - 1e-9:
+                    order = candidate
+                    improved = True
+    return order
+
+
+class ShadowPositions:
+    """
+    Thread-safe last known positions of every motor, per motor server
+    (any hashable key, e.g. (ip, port)). Entries come from readbacks and
+    expire after max_age seconds, so motors that were moved by someone
+    else are read again eventually.
+    """
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._positions = {}  # server -> {name: (position, time)}
+
+    def get(self, server, names=None):
+        """{name: position} of the fresh entries for a server."""
+        now = time.monotonic()
+        with self._lock:
+            entries = dict(self._positions.get(server, {}))
+        return {
+            name: pos for name, (pos, stamp) in entries.items()
+            if (names is None or name in names) and pos is not None
+            and now - stamp <= self.max_age
+        }
+
+    def update(self, server, positions):
+        """Record readbacks; None (a failed readback) forgets the motor."""
+        now = time.monotonic()
+        with self._lock:
+            entries = self._positions.setdefault(server, {})
+            for name, pos in positions.items():
+                if pos is None:
+                    entries.pop(name, None)
+                else:
+                    entries[name] = (float(pos), now)
+
+    def invalidate(self, server=None, names=None):
+        """Forget positions of a server (or everything), e.g. after homing."""
+        with self._lock:
+            if server is None:
+                self._positions.clear()
+            elif names is None:
+                self._positions.pop(server, None)
+            else:
+                for name in names:
+                    self._positions.get(server, {}).pop(name, None)
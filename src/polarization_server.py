@@ -1,7 +1,7 @@
 import beacon_bridge_optimizations as bc_opt
 from scipy.optimize import minimize
 import time
-from thorlabs_apt_motor_controller import MotorController
+from thorlabs_apt_motor_controller import AsyncMotorHub, MotorPool
 import numpy as np
 import threading
 import yaml as yaml
@@ -9,13 +9,31 @@ from zmqhelper import ZMQServiceBase
 import json
 from datetime import datetime, date
 import redis_read as r_read
+from counts_monitor import CountsBuffer, StreamSubscriber, ViolationBuffer
 import os
+import motion
+import waveplate_fit
+import fiber_tomography
 
 
 class MotorConnectionError(Exception):
     pass
 
 
+# Per-party limits in seconds when fanning out to all motor servers
+MOTOR_QUERY_TIMEOUT = 2.0
+MOTOR_MOVE_TIMEOUT = 60.0
+MOTOR_HOME_TIMEOUT = 300.0
+
+# Buffers of the monitor streams the server follows
+MONITOR_BUFFERS = {
+    r_read.CHANNELCOUNTS: CountsBuffer,
+    r_read.CHANNELVIOLATION: ViolationBuffer,
+}
+# Default windows in seconds, ending now, of get_violation
+VIOLATION_WINDOWS = (10.0, 60.0, 600.0)
+
+
 class PolarizationServer(ZMQServiceBase):
     """
     Bit authentication server for a verifier. The verifier waits for a start signal from a prover and then executes the authentication protocol using only the local computer time.
@@ -53,6 +71,20 @@ class PolarizationServer(ZMQServiceBase):
         )
 
         self.motorInfo = config["motor_servers"]
+        # Motor connections are kept open and shared between requests
+        self.motors = MotorPool()
+        # and requests to all parties at once go out concurrently
+        self.motor_hub = AsyncMotorHub()
+        # Last known motor positions, to skip and shorten moves
+        self.shadow = motion.ShadowPositions()
+        # One shared consumer per monitor stream, started on first use
+        self.monitor_lock = threading.Lock()
+        self.monitors = {}
+
+        # State of the current or last run_sequence
+        self.sequence_lock = threading.Lock()
+        self.sequence_stop = threading.Event()
+        self.sequence_status = {"state": "idle"}
         self.current_path = None
         self.logger.info("")
         self.logger.info(f"Polarization server Started at {self.time_start}")
@@ -61,18 +93,124 @@ class PolarizationServer(ZMQServiceBase):
         # Load last path from logs during startup
         self.load_last_path_from_logs()
 
+        # Take the Pockels cell model and the Redis server from the config
+        self.apply_pockels_model()
+        self.apply_redis_config()
+
+        # Load the precomputed bridge table so lookups never touch the disk
+        if bc_opt.load_bridge_table() is None:
+            self.logger.info("No precomputed bridge table found, prewarm builds it")
+
+        # Solve the configured settings and Bell angles in the background
+        self.prewarm_lock = threading.Lock()
+        self.prewarm_thread = None
+        self.prewarm_wanted = None
+        self.prewarm_status = {"state": "idle", "done": 0, "total": 0}
+        self.start_prewarm()
+
         # self.get_positions()
 
+    def apply_pockels_model(self):
+        """Use the pockels_cell section of the config as the optimizer model.
+        Cached angles are keyed by the model fingerprint, so a new
+        characterization never reuses stale results."""
+        if "pockels_cell" not in self.config:
+            return bc_opt.pockels_model_id
+        old_model = bc_opt.pockels_model_id
+        model_id = bc_opt.set_pockels_model(self.config["pockels_cell"])
+        if model_id != old_model:
+            self.logger.info(f"Pockels cell model changed to {model_id}")
+        return model_id
+
+    def apply_redis_config(self):
+        """Use config_setup.redis_host/redis_port as the server of the
+        process-wide Redis connection pool."""
+        cParams = self.config["config_setup"]
+        r_read.configure(cParams.get("redis_host"), cParams.get("redis_port"))
+
+    def prewarm_jobs(self, config):
+        """The bridge settings and Bell angles the config will ask for."""
+        bridge = []
+        for setting in config["settings"].values():
+            for job in ((setting["AHWP1"], True), (setting["BHWP1"], False)):
+                if job not in bridge:
+                    bridge.append(job)
+        bell = []
+        if "bell_angles" in config:
+            bell.append(list(config["bell_angles"][:2]))
+        return bridge, bell
+
+    def start_prewarm(self):
+        """Prewarm the optimizer cache in a background thread. Runs again
+        whenever the settings, Bell angles or Pockels cell model change."""
+        bridge, bell = self.prewarm_jobs(self.config)
+        wanted = (bc_opt.pockels_model_id, json.dumps([bridge, bell]))
+        with self.prewarm_lock:
+            if wanted == self.prewarm_wanted:
+                return
+            self.prewarm_wanted = wanted
+            self.prewarm_jobs_wanted = (bridge, bell)
+            if self.prewarm_thread is not None and self.prewarm_thread.is_alive():
+                return  # the running prewarm picks up the new jobs
+            self.prewarm_thread = threading.Thread(
+                target=self.run_prewarm, name="prewarm", daemon=True
+            )
+            self.prewarm_thread.start()
+
+    def run_prewarm(self):
+        done = None
+        while True:
+            with self.prewarm_lock:
+                if self.prewarm_wanted == done:
+                    self.prewarm_thread = None
+                    return
+                wanted = self.prewarm_wanted
+                bridge, bell = self.prewarm_jobs_wanted
+
+            def progress(n_done, total):
+                self.prewarm_status.update(done=n_done, total=total)
+
+            self.prewarm_status = {
+                "state": "running",
+                "model": wanted[0],
+                "done": 0,
+                "total": len(bridge) + len(bell),
+            }
+            self.logger.info(
+                f"Prewarming {len(bridge)} bridge settings and "
+                f"{len(bell)} Bell angle pairs"
+            )
+            try:
+                summary = bc_opt.prewarm(
+                    bridge, bell, progress=progress, bridge_table=True
+                )
+            except Exception as e:
+                self.logger.error(f"Prewarm failed: {e}")
+                self.prewarm_status.update(state="failed", error=str(e))
+            else:
+                self.prewarm_status.update(state="done", **summary)
+                self.logger.info(f"Prewarm finished: {summary}")
+            done = wanted
+
     def get_positions(self):
         self.logger.info(f"Getting motor positions: {self.motorInfo}")
-        motorInfo = self.motorInfo
-        for party in motorInfo:
-            ip = motorInfo[party]["ip"]
-            port = motorInfo[party]["port"]
-            mc = self.connect_to_motor(ip, port)
-            angles = mc.getAllPos()
-            self.logger.info(f"Motor positions for {party}: {angles}")
-        return angles
+        return self.get_all_positions()
+
+    def motor_server(self, party):
+        return (self.motorInfo[party]["ip"], self.motorInfo[party]["port"])
+
+    def fan_out(self, fn, timeout, parties=None):
+        """Run fn(client, party) on the async motor client of every party (or
+        of the given parties) at once, so the slowest party sets the
+        latency. Returns {party: result}; a party that failed or did not
+        answer within timeout seconds gets the exception instead."""
+        parties = self.motorInfo if parties is None else parties
+        calls = {}
+        for party in parties:
+            ip = self.motorInfo[party]["ip"]
+            port = self.motorInfo[party]["port"]
+            calls[party] = (ip, port, lambda mc, party=party: fn(mc, party))
+        return self.motor_hub.gather(calls, timeout)
 
     def handle_request(self, message):
         """
@@ -82,6 +220,9 @@ class PolarizationServer(ZMQServiceBase):
         res = {}
         resp = {}
         self.config = load_config_from_file(self.configFName)
+        self.apply_pockels_model()
+        self.apply_redis_config()
+        self.start_prewarm()
         # print("Received message: ", str(message))
 
         try:
@@ -100,12 +241,15 @@ class PolarizationServer(ZMQServiceBase):
 
             elif cmd == "calibrate":
                 party = params["party"].lower()
-                resp = self.optimize_wvplts(party, self.config)
+                mode = params.get("mode", "powell")
+                resp = self.optimize_wvplts(party, self.config, mode)
                 if party == "source":
                     print(
                         f"Finished source calibration with positions: {resp}"
                     )
-                    new_source_HWP_zero = float(resp["source_Power_1"] - 360.0)
+                    # the fit and tomography modes return a report
+                    positions = resp if mode.lower() == "powell" else resp["positions"]
+                    new_source_HWP_zero = float(positions["source_Power_1"] - 360.0)
                     self.config["source"][
                         "source_power_angle"
                     ] = new_source_HWP_zero
@@ -124,6 +268,39 @@ class PolarizationServer(ZMQServiceBase):
                 self.current_path = "Bell angles"
                 self.logger.info(f"Current polarization path set to: Bell angles")
 
+            elif cmd == "run_sequence":
+                resp = self.run_sequence(self.config, **params)
+
+            elif cmd == "sequence_status":
+                resp = dict(self.sequence_status)
+
+            elif cmd == "stop_sequence":
+                self.sequence_stop.set()
+                resp = dict(self.sequence_status)
+                self.logger.info("Stopping the running sequence")
+
+            elif cmd == "get_counts":
+                resp = self.get_counts(**params)
+
+            elif cmd == "get_violation":
+                resp = self.get_violation(**params)
+
+            elif cmd == "sweep_bell_angles":
+                resp = self.sweep_bell_angles(**params)
+                self.logger.info(
+                    f"Bell angle sweep solved {resp['solved']} pairs, "
+                    f"failed: {resp['failed']}"
+                )
+
+            elif cmd == "migrate_cache":
+                resp = self.migrate_cache(**params)
+                self.logger.info(
+                    f"Cache migrated from {resp['from_model']} to "
+                    f"{resp['to_model']}: {len(resp['migrated'])} re-solved, "
+                    f"{len(resp['failed'])} failed, "
+                    f"{len(resp['skipped'])} skipped"
+                )
+
             elif cmd == "set_power":
                 power = float(params["power"])
                 if power < 0.0 or power > 1.0:
@@ -187,9 +364,24 @@ class PolarizationServer(ZMQServiceBase):
                 ]
                 resp["settings"] = self.config["settings"]
                 resp["uptime"] = str(datetime.now() - self.time_start)
+                resp["pockels_model"] = bc_opt.pockels_model_id
+                resp["cache"] = {
+                    "set_bridge_to_hwp": bc_opt.set_bridge_to_hwp.cache_info(),
+                    "angles_bell_test": bc_opt.angles_bell_test.cache_info(),
+                }
+                resp["prewarm"] = dict(self.prewarm_status)
+                resp["sequence"] = {
+                    k: v for k, v in self.sequence_status.items() if k != "steps"
+                }
+                resp["monitors"] = {
+                    channel: sub.status() for channel, sub in self.monitors.items()
+                }
+                resp["redis"] = r_read.health()
+                if resp["redis"]["ok"]:
+                    resp["redis"]["offsets"] = r_read.stream_offsets()
 
             elif cmd == "get_motor_info":
-                resp = self.get_motor_info()
+                resp = self.get_motor_info(**params)
                 self.logger.info("Retrieved motor information for all parties")
 
             elif cmd == "forward" or cmd == "backward" or cmd == "goto":
@@ -204,27 +396,26 @@ class PolarizationServer(ZMQServiceBase):
                     try:
                         ip = self.motorInfo[party]["ip"]
                         port = self.motorInfo[party]["port"]
-                        mc = self.connect_to_motor(ip, port) 
-                        
-                        # Execute the movement command
-                        if cmd == "forward":
-                            move_resp = mc.forward(waveplate, position)
-                        elif cmd == "backward":
-                            move_resp = mc.backward(waveplate, position)
-                        elif cmd == "goto":
-                            move_resp = mc.goto(waveplate, position)
-                        else:
-                            move_resp = f"Invalid command, {cmd}"
-                        
-                        # Get current position after movement
-                        current_pos = mc.getPos(waveplate)
-                        mc.close()
+                        with self.connect_to_motor(ip, port) as mc:
+                            # Execute the movement command
+                            if cmd == "forward":
+                                move_resp = mc.forward(waveplate, position)
+                            elif cmd == "backward":
+                                move_resp = mc.backward(waveplate, position)
+                            elif cmd == "goto":
+                                move_resp = mc.goto(waveplate, position)
+                            else:
+                                move_resp = f"Invalid command, {cmd}"
+
+                            # Get current position after movement
+                            current_pos = mc.getPos(waveplate)
                         
                         # Create structured response
                         try:
                             current_pos_float = float(current_pos) if current_pos != "Motor not connected" else None
                         except (ValueError, TypeError):
                             current_pos_float = None
+                        self.shadow.update((ip, port), {waveplate: current_pos_float})
                             
                         resp = {
                             'party': party,
@@ -346,61 +537,60 @@ class PolarizationServer(ZMQServiceBase):
         self.logger.info("No previous polarization path found in logs, current_path remains None")
 
     def connect_to_motor(self, ip: str, port: int):
-        return MotorController(ip, port)
+        """Borrow a pooled MotorController for the motor server at ip:port,
+        to be used as `with self.connect_to_motor(ip, port) as mc:`."""
+        return self.motors.connection(ip, port)
 
-    def get_motor_info(self):
-        """Get motor server information including waveplate names for each party."""
+    def get_motor_info(self, refresh=False):
+        """Get motor server information including waveplate names for each
+        party. The names are cached; refresh=True reads them again."""
         motor_info = {}
-        
-        for party in self.motorInfo:
-            try:
-                ip = self.motorInfo[party]["ip"]
-                port = self.motorInfo[party]["port"]
-                mc = self.connect_to_motor(ip, port)
-                
-                # Get waveplate names from motor controller's id_dict
-                waveplate_names = list(mc.id_dict.keys())
-                
-                motor_info[party] = {
-                    "names": waveplate_names,
-                    "ip": ip,
-                    "port": port
-                }
-                
-                mc.close()
-                self.logger.info(f"Retrieved motor info for {party}: {len(waveplate_names)} waveplates")
-                
-            except Exception as e:
-                self.logger.error(f"Failed to connect to {party} motor at {ip}:{port}: {e}")
+
+        async def names(mc, party):
+            if refresh:
+                await mc.get_name()
+            return list((await mc.connect()).keys())
+
+        results = self.fan_out(names, MOTOR_QUERY_TIMEOUT)
+        for party, waveplate_names in results.items():
+            ip = self.motorInfo[party]["ip"]
+            port = self.motorInfo[party]["port"]
+            if isinstance(waveplate_names, Exception):
+                e = waveplate_names
+                self.logger.error(f"Failed to connect to {party} motor at {ip}:{port}: {e!r}")
                 motor_info[party] = {
                     "names": [],
                     "ip": ip,
                     "port": port,
-                    "error": str(e)
+                    "error": repr(e)
                 }
+                continue
+            motor_info[party] = {
+                "names": waveplate_names,
+                "ip": ip,
+                "port": port
+            }
+            self.logger.info(f"Retrieved motor info for {party}: {len(waveplate_names)} waveplates")
         
         return motor_info
 
     def get_all_positions(self):
         """Get current positions of all waveplates for all motor servers."""
         all_positions = {}
-        
-        for party in self.motorInfo:
-            try:
+
+        results = self.fan_out(
+            lambda mc, party: mc.get_many(), MOTOR_QUERY_TIMEOUT
+        )
+        for party, positions in results.items():
+            if isinstance(positions, Exception):
                 ip = self.motorInfo[party]["ip"]
                 port = self.motorInfo[party]["port"]
-                mc = self.connect_to_motor(ip, port)
-                
-                # Get all positions from this motor controller
-                positions = mc.getAllPos()
-                all_positions[party] = positions
-                
-                mc.close()
-                self.logger.info(f"Retrieved positions for {party}: {len(positions)} waveplates")
-                
-            except Exception as e:
-                self.logger.error(f"Failed to get positions from {party} motor at {ip}:{port}: {e}")
-                all_positions[party] = {"error": str(e)}
+                self.logger.error(f"Failed to get positions from {party} motor at {ip}:{port}: {positions!r}")
+                all_positions[party] = {"error": repr(positions)}
+                continue
+            all_positions[party] = positions
+            self.shadow.update(self.motor_server(party), positions)
+            self.logger.info(f"Retrieved positions for {party}: {len(positions)} waveplates")
         
         return all_positions
 
@@ -412,13 +602,12 @@ class PolarizationServer(ZMQServiceBase):
         self.logger.debug(
             f"Setting health fail threshold to {self.health_fail_threshold}"
         )
-        mc = self.connect_to_motor(ip, port)
         self.logger.debug("Homing motor at {ip}:{port}")
-        for motor in mc.id_dict:
-            self.logger.debug(f"Homing motor {motor} at {ip}:{port}")
-            mc.home(motor)
-            self.logger.debug(f"Finished homing {motor} at {ip}:{port}")
-            print(f"Homing {motor}")
+        self.shadow.invalidate((ip, port))
+        with self.connect_to_motor(ip, port) as mc:
+            self.logger.debug(f"Homing motors {list(mc.id_dict)} at {ip}:{port}")
+            mc.home_many()
+            self.logger.debug(f"Finished homing motors at {ip}:{port}")
         self.health_fail_threshold = (
             old_health_fail_threshold  # Reset threshold
         )
@@ -428,9 +617,24 @@ class PolarizationServer(ZMQServiceBase):
         return
 
     def homeAll(self):
-        motorInfo = self.motorInfo
-        for party in motorInfo:
-            self.home(motorInfo[party]["ip"], motorInfo[party]["port"])
+        old_health_fail_threshold = self.health_fail_threshold
+        self.health_fail_threshold = (
+            60  # Increase threshold to allow for motor homing
+        )
+        self.shadow.invalidate()
+        try:
+            # home every party at once
+            results = self.fan_out(
+                lambda mc, party: mc.home_many(), MOTOR_HOME_TIMEOUT
+            )
+        finally:
+            self.health_fail_threshold = old_health_fail_threshold
+        for party, resp in results.items():
+            if isinstance(resp, Exception):
+                self.logger.error(f"Failed to home {party} motors: {resp!r}")
+            else:
+                self.logger.debug(f"Finished homing {party} motors")
+        return results
 
     def set_power(self, power, source_pow=0):
         """Set the power of the source. The power is set by rotating the HWP"""
@@ -440,19 +644,176 @@ class PolarizationServer(ZMQServiceBase):
         if power > 1.0 or power < 0.0:
             return "Improper setting. Must be between 0..1."
         theta = np.arcsin(power**0.5) * 180.0 / np.pi / 2.0
-        mc_source = self.connect_to_motor(
+        with self.connect_to_motor(
             motorInfo["source"]["ip"], motorInfo["source"]["port"]
-        )
-        mc_source.goto("source_Power_1", theta + source_pow)
+        ) as mc_source:
+            target = {"source_Power_1": theta + source_pow}
+            mc_source.goto("source_Power_1", target["source_Power_1"])
+            mc_source.wait_settled(
+                targets=target, target_tolerance=self.settle_tolerance()
+            )
+        self.shadow.invalidate(self.motor_server("source"), ["source_Power_1"])
         self.logger.info("Setting power to: ", theta)
         return theta
 
     def set_polarization(
         self, config, setting="1", use_cache=True, update_cache=False
     ):
+        ang = self.polarization_angles(config, setting, use_cache, update_cache)
+        if isinstance(ang, str):
+            return ang  # invalid setting
+        self.setBridgeWPs(ang, config)
+        return ang
+
+    def resolve_sequence(self, config, steps, dwell=0.0, use_cache=True):
+        """Waveplate angles for every step of a sequence, before anything
+        moves. A step is a path name, or a dict with either "path" or
+        "angles" ([angle_1, angle_2, pump_angle], as for
+        set_pc_to_bell_angles) and optionally its own "dwell" in seconds."""
+        plan = []
+        for i, step in enumerate(steps):
+            if not isinstance(step, dict):
+                step = {"path": step}
+            if "path" in step:
+                name = str(step["path"]).lower()
+                ang = self.polarization_angles(config, name, use_cache)
+                if isinstance(ang, str):
+                    raise ValueError(f"Step {i}: {ang}")
+            elif "angles" in step:
+                name = f"Bell angles {list(step['angles'])}"
+                ang = self.ch_waveplate_angles(config, step["angles"], use_cache)
+            else:
+                raise ValueError(f"Step {i} needs a path or angles: {step}")
+            plan.append({
+                "step": i,
+                "name": name,
+                "angles": ang,
+                "dwell": float(step.get("dwell", dwell)),
+            })
+        return plan
+
+    def run_sequence(
+        self,
+        config,
+        steps,
+        dwell=0.0,
+        reorder=False,
+        background=False,
+        use_cache=True,
+    ):
+        """Set a list of paths or Bell angle sets back to back, waiting dwell
+        seconds at each. All angles are resolved before the first move, and
+        with reorder=True the steps are put in the order with the least
+        waveplate travel. Progress is in sequence_status (and info). Returns
+        the per-step timing report, or right away with background=True."""
+        if not self.sequence_lock.acquire(blocking=False):
+            raise RuntimeError("A sequence is already running")
+        try:
+            plan = self.resolve_sequence(config, steps, dwell, use_cache)
+            if reorder and len(plan) > 1:
+                start = {}
+                for party in self.motorInfo:
+                    start.update(self.shadow.get(self.motor_server(party)))
+                order = motion.order_for_travel(
+                    [self.flat_angles(p["angles"]) for p in plan],
+                    start,
+                    config.get("motion", {}).get("period", motion.DEFAULT_PERIOD),
+                )
+                plan = [plan[i] for i in order]
+            self.sequence_stop.clear()
+            self.sequence_status = {
+                "state": "running",
+                "done": 0,
+                "total": len(plan),
+                "current": None,
+                "order": [p["step"] for p in plan],
+                "steps": [],
+            }
+        except Exception:
+            self.sequence_lock.release()
+            raise
+        if background:
+            threading.Thread(
+                target=self.execute_sequence,
+                args=(config, plan),
+                name="sequence",
+                daemon=True,
+            ).start()
+            return dict(self.sequence_status)
+        return self.execute_sequence(config, plan)
+
+    @staticmethod
+    def flat_angles(ang):
+        return {wp: a for party in ang.values() for wp, a in party.items()}
+
+    def execute_sequence(self, config, plan):
+        # runs with self.sequence_lock held, and releases it
+        status = self.sequence_status
+        old_health_fail_threshold = self.health_fail_threshold
+        self.health_fail_threshold = (
+            60  # Increase threshold to allow for the sequence
+        )
+        t_start = time.time()
+        try:
+            for p in plan:
+                if self.sequence_stop.is_set():
+                    status["state"] = "stopped"
+                    break
+                status["current"] = p["name"]
+                t0 = time.time()
+                results = self.setBridgeWPs(p["angles"], config)
+                t_move = time.time() - t0
+                self.current_path = p["name"]
+                time.sleep(p["dwell"])
+                moved = skipped = 0
+                errors = {}
+                for party, resp in results.items():
+                    if isinstance(resp, Exception):
+                        errors[party] = repr(resp)
+                    else:
+                        moved += len(resp[0])
+                        skipped += len(resp[1])
+                status["steps"].append({
+                    "step": p["step"],
+                    "name": p["name"],
+                    "move_time": t_move,
+                    "dwell": time.time() - t0 - t_move,
+                    "moved": moved,
+                    "skipped": skipped,
+                    "errors": errors,
+                })
+                status["done"] += 1
+                self.logger.info(
+                    f"Sequence step {status['done']}/{status['total']}: "
+                    f"{p['name']} (moves {t_move:.2f} s)"
+                )
+            else:
+                status["state"] = "done"
+        except Exception as e:
+            status["state"] = "failed"
+            status["error"] = str(e)
+            self.logger.error(f"Sequence failed: {e}")
+            raise
+        finally:
+            status["current"] = None
+            status["total_time"] = time.time() - t_start
+            self.health_fail_threshold = old_health_fail_threshold
+            self.sequence_lock.release()
+        return dict(status)
+
+    def polarization_angles(
+        self, config, setting="1", use_cache=True, update_cache=False
+    ):
+        """Waveplate angles {party: {waveplate: angle}} for a configured
+        setting (or a setting given as {AHWP1, BHWP1, PHWP}), or an error
+        message if there is no such setting."""
         # global logger
-        setting = str(setting).lower()
-        if setting in config["settings"]:
+        if isinstance(setting, dict):
+            PHWP = setting["PHWP"]
+            AHWP1 = setting["AHWP1"]
+            BHWP1 = setting["BHWP1"]
+        elif str(setting).lower() in config["settings"]:
+            setting = str(setting).lower()
             PHWP = config["settings"][setting]["PHWP"]
             AHWP1 = config["settings"][setting]["AHWP1"]
             BHWP1 = config["settings"][setting]["BHWP1"]
@@ -500,22 +861,37 @@ class PolarizationServer(ZMQServiceBase):
         aSource = {"source_HWP_1": PHWP}
 
         ang = {"alice": aAlice, "bob": aBob, "source": aSource}
-        self.setBridgeWPs(ang, config)
         return ang
 
     def set_ch_waveplates(
         self, config, angles=None, use_cache=True, update_cache=False
     ):
         """given an array of 2 hwp settings and 1 pump waveplate setting,
-        set the appropriate waveplates for a CH violation. Pockels cell
-        characterization is hard coded into the bc_opt file"""
+        set the appropriate waveplates for a CH violation."""
+        ang = self.ch_waveplate_angles(config, angles, use_cache, update_cache)
+        self.setBridgeWPs(ang, config=config)
+        return ang
+
+    def ch_waveplate_angles(
+        self, config, angles=None, use_cache=True, update_cache=False
+    ):
+        """given an array of 2 hwp settings and 1 pump waveplate setting,
+        compute the waveplate angles for a CH violation. The Pockels cell
+        model comes from the pockels_cell section of the config"""
         arr = angles
         PHWP = arr[2]
-        print("Starting optimization with angles: ", arr)
-        self.logger.info(f"Starting optimization with angles: {arr}")
-        angs_a, angs_b = bc_opt.angles_bell_test(
-            [arr[0], arr[1]], use_cache=use_cache, update_cache=update_cache
-        )
+        stored = None
+        if use_cache:
+            stored = bc_opt.lookup_bell_table([arr[0], arr[1]])
+        if stored is not None:
+            angs_a, angs_b = stored[0][:3], stored[1][:3]
+            self.logger.info(f"Using Bell angle table entry for: {arr}")
+        else:
+            print("Starting optimization with angles: ", arr)
+            self.logger.info(f"Starting optimization with angles: {arr}")
+            angs_a, angs_b = bc_opt.angles_bell_test(
+                [arr[0], arr[1]], use_cache=use_cache, update_cache=update_cache
+            )
         # print(f"Finished ch optimization. Alice angles: {angs_a}, Bob angles: {angs_b}")
         aAlice = {}
         aAlice["alice_HWP_1"] = angs_a[0]
@@ -530,46 +906,200 @@ class PolarizationServer(ZMQServiceBase):
         aSource = {"source_HWP_1": PHWP}
 
         ang = {"alice": aAlice, "bob": aBob, "source": aSource}
-        self.setBridgeWPs(ang, config=config)
         return ang
 
-    def setBridgeWPs(self, params, config):
-        motorInfo = self.motorInfo
-        t = []
-        mc = []
+    def sweep_bell_angles(
+        self, angles=None, angle_1=None, angle_2=None, n_starts=None
+    ):
+        """Solve the Bell angle optimization for a list of [angle_1, angle_2]
+        pairs, or for the grid spanned by angle_1 and angle_2 given as
+        [start, stop, num]. The solutions are stored in the Bell angle table
+        that set_pc_to_bell_angles reads before optimizing."""
+        if angles is None:
+            if angle_1 is None or angle_2 is None:
+                raise ValueError(
+                    "Provide either angles or both angle_1 and angle_2"
+                )
+            grid_1 = np.linspace(angle_1[0], angle_1[1], int(angle_1[2]))
+            grid_2 = np.linspace(angle_2[0], angle_2[1], int(angle_2[2]))
+            angles = [[a, b] for a in grid_1 for b in grid_2]
+        old_health_fail_threshold = self.health_fail_threshold
+        self.health_fail_threshold = (
+            60  # Increase threshold to allow for the sweep
+        )
+        self.logger.info(f"Starting Bell angle sweep over {len(angles)} pairs")
+        try:
+            resp = bc_opt.sweep_bell_angles(angles, n_starts=n_starts)
+        finally:
+            self.health_fail_threshold = old_health_fail_threshold
+        return resp
+
+    def migrate_cache(self, from_model=None):
+        """Re-solve the cached angles and solution tables of an earlier
+        Pockels cell model (by default the last one used) for the current
+        model, warm-started from the old solutions."""
+        old_health_fail_threshold = self.health_fail_threshold
+        self.health_fail_threshold = (
+            60  # Increase threshold to allow for the migration
+        )
+        self.logger.info(
+            f"Migrating cache from {from_model or 'the previous model'} "
+            f"to {bc_opt.pockels_model_id}"
+        )
+        try:
+            resp = bc_opt.migrate_cache(from_model)
+        finally:
+            self.health_fail_threshold = old_health_fail_threshold
+        return resp
+
+    def settle_tolerance(self):
+        """Degrees within which a moved motor counts as arrived at its
+        target (settle_tolerance in the motion section of the config)."""
+        return self.config.get("motion", {}).get(
+            "settle_tolerance", motion.DEFAULT_SETTLE_TOLERANCE
+        )
 
-        for party in params.keys():
-            ip = motorInfo[party]["ip"]
-            port = motorInfo[party]["port"]
-            mc.append(self.connect_to_motor(ip, port))
-            try:
-                angles = params[party]
-                for wp in angles:
-                    ang = angles[wp]
-                    mc.append(self.connect_to_motor(ip, port=port))
-                    t.append(
-                        threading.Thread(
-                            target=mc[-1].goto,
-                            args=(
-                                wp,
-                                ang,
-                            ),
-                        )
+    def setBridgeWPs(self, params, config):
+        """Move the waveplates to params {party: {waveplate: angle}}, one
+        batched move per party and all parties at once. Waveplates already
+        within the tolerance are not moved, and waveplate targets are
+        replaced by the equivalent angle (modulo the period) nearest to
+        the current position. Returns once the moved motors have settled.
+        Tolerance, settle tolerance, period, position limits and the
+        age after which the shadow positions are read again come from the
+        optional motion section of the config."""
+        opts = config.get("motion", {})
+        tolerance = opts.get("tolerance", motion.DEFAULT_TOLERANCE)
+        period = opts.get("period", motion.DEFAULT_PERIOD)
+        limits = opts.get("limits")
+        settle_tolerance = opts.get(
+            "settle_tolerance", motion.DEFAULT_SETTLE_TOLERANCE
+        )
+        self.shadow.max_age = opts.get("shadow_max_age", motion.DEFAULT_MAX_AGE)
+
+        async def move(mc, party):
+            server = (mc.ip, mc.port)
+            targets = dict(params[party])
+            current = self.shadow.get(server, targets)
+            unknown = [wp for wp in targets if wp not in current]
+            if unknown:
+                readback = await mc.get_many(unknown)
+                self.shadow.update(server, readback)
+                current.update((wp, pos) for wp, pos in readback.items() if pos is not None)
+            moves, skipped = motion.plan_moves(
+                targets, current, tolerance, period, limits
+            )
+            if moves:
+                self.shadow.invalidate(server, moves)
+                await mc.goto_many(moves)
+                # return only once the motors have stopped
+                self.shadow.update(
+                    server, await mc.wait_settled(
+                        tolerance=tolerance, targets=moves,
+                        target_tolerance=settle_tolerance,
                     )
-                    t[-1].start()
-            except Exception as e:
-                print(f"No {party} angles to set", e)
-                pass
-        for th in t:
-            th.join()
+                )
+            return moves, skipped
+
+        parties = [party for party in params if party in self.motorInfo]
+        results = self.fan_out(move, MOTOR_MOVE_TIMEOUT, parties)
+        for party, resp in results.items():
+            if isinstance(resp, Exception):
+                self.shadow.invalidate(self.motor_server(party))
+                self.logger.error(f"Failed to set {party} waveplates: {resp!r}")
+                print(f"Failed to set {party} waveplates", resp)
+                continue
+            moves, skipped = resp
+            self.logger.debug(f"Moved {party} waveplates {moves}, already in place: {skipped}")
+        return results
+
+    def monitor(self, channel):
+        """The background consumer of a monitor stream (a key of
+        MONITOR_BUFFERS) of the configured Redis server, (re)started if it
+        is not running or the server changed. None if no Redis server is
+        configured."""
+        try:
+            redis_host, redis_port, _ = r_read.server_key()
+        except ValueError:
+            return None
+        with self.monitor_lock:
+            sub = self.monitors.get(channel)
+            if sub is None or not sub.is_alive() or (sub.host, sub.port) != (
+                redis_host, redis_port
+            ):
+                if sub is not None:
+                    sub.stop()
+                self.logger.info(f"Following {channel} on {redis_host}:{redis_port}")
+                sub = StreamSubscriber(
+                    redis_host, redis_port, channel, MONITOR_BUFFERS[channel]()
+                )
+                self.monitors[channel] = sub
+                sub.start()
+        return sub
+
+    def monitor_window(self, channel, duration, since, until, wait):
+        """Window [since, until] (default the last duration seconds) of a
+        monitor stream, from the samples that have already arrived unless
+        wait is set."""
+        sub = self.monitor(channel)
+        if sub is None:
+            raise ValueError("No Redis server configured")
+        until = time.time() if until is None else float(until)
+        since = until - float(duration) if since is None else float(since)
+        if not wait:
+            return sub.buffer.window(since, until)
+        timeout = max(0.0, until - time.time()) + r_read.stream_timeout(
+            sub.buffer.integration_time or 1.0
+        )
+        return sub.window(since, until, timeout=timeout)
+
+    def get_counts(self, duration=1.0, since=None, until=None, wait=False):
+        """Summed singles, coincidences and efficiencies of the samples
+        measured within [since, until] (default the last duration seconds).
+        Answered from the samples that have already arrived unless wait is
+        set, in which case it waits for the samples up to until."""
+        return self.monitor_window(
+            r_read.CHANNELCOUNTS, duration, since, until, wait
+        )
+
+    def get_violation(self, windows=None, since=None, until=None, wait=False):
+        """Summed violation counts with the CH statistic J and its
+        uncertainty, for each of windows (seconds, ending now; default
+        the monitor.violation_windows of the config), or for [since,
+        until] if since is given."""
+        if since is not None:
+            return self.monitor_window(
+                r_read.CHANNELVIOLATION, None, since, until, wait
+            )
+        if windows is None:
+            windows = self.config.get("monitor", {}).get(
+                "violation_windows", VIOLATION_WINDOWS
+            )
+        now = time.time()
+        return {
+            str(w): self.monitor_window(
+                r_read.CHANNELVIOLATION, w, None, now, wait
+            )
+            for w in windows
+        }
 
-    def get_power(self, intTime, COUNTTYPE="effAB", windowtype="no_PC"):
-        time.sleep(0.2 + intTime)
+    def get_power(self, intTime, COUNTTYPE="effAB", windowtype="no_PC", since=None):
+        """Counts over intTime seconds, using only samples measured after
+        `since` (default now), e.g. the time the motors settled. Taken
+        from the shared counts subscriber, as soon as its samples cover
+        the window, falling back to reading the stream directly."""
+        since = time.time() if since is None else since
         COUNTTYPE = COUNTTYPE.lower()
         windowtype = windowtype.lower()
-        redis_host = self.config["config_setup"]["redis_host"]
-        redis_port = self.config["config_setup"]["redis_port"]
-        counts = r_read.get_power(intTime, redis_host, port=redis_port)
+        sub = self.monitor(r_read.CHANNELCOUNTS)
+        integration_time = None if sub is None else sub.buffer.integration_time
+        if integration_time:
+            # one sample more than intTime, as r_read.get_power sums
+            until = since + intTime + integration_time
+            timeout = until - time.time() + r_read.stream_timeout(integration_time)
+            counts = sub.window(since, until, timeout=timeout)
+        else:
+            counts = r_read.get_power(intTime, since=since)
         if windowtype == "no_pc":
             counts = counts["VV"]
         else:
@@ -606,11 +1136,14 @@ class PolarizationServer(ZMQServiceBase):
         self.logger.debug(
             f"Optimizing waveplate positions: {pos} with scale {scale} and start positions {start_pos}"
         )
-        for i, waveplate in enumerate(waveplates):
-            mc_obj.goto(waveplate, pos[i])
+        targets = dict(zip(waveplates, pos))
+        mc_obj.goto_many(targets)
+        settled = mc_obj.wait_settled(
+            targets=targets, target_tolerance=self.settle_tolerance()
+        )
+        since = time.time()
         self.logger.debug(f"Moved waveplates to positions: {pos}")
-        time.sleep(0.5)
-        counts = self.get_power(int_time, count_type, window_type)
+        counts = self.get_power(int_time, count_type, window_type, since=since)
         self.logger.debug(f"Counts received: {counts} for positions: {pos}")
         if counts < best_counts:
             best_pos = []
@@ -619,7 +1152,7 @@ class PolarizationServer(ZMQServiceBase):
             )
             params["best_counts"] = counts
             for waveplate in waveplates:
-                best_pos.append(float(mc_obj.getPos(waveplate)))
+                best_pos.append(float(settled[waveplate]))
             self.logger.debug(f"Best positions updated: {best_pos}")
             params["best_pos"] = np.array(best_pos)
             params["best_counts"] = counts
@@ -629,6 +1162,241 @@ class PolarizationServer(ZMQServiceBase):
         )
         return counts
 
+    def select_waveplates(self, mc_obj, wvplt, custom=False):
+        """The waveplates of a motor server picked by the letters of wvplt
+        (s: source, a: alice, b: bob, h: HWP, q: QWP, 1/2: first/second
+        set, p: power), or wvplt itself if custom."""
+        if custom:
+            return wvplt
+        waveplates = list(mc_obj.id_dict.keys())
+        if "s" not in wvplt:
+            waveplates = [i for i in waveplates if not "source" in i]
+        else:
+            waveplates = [i for i in waveplates if "source" in i]
+        if "a" in wvplt:
+            waveplates = [i for i in waveplates if "alice" in i]
+        if "b" in wvplt:
+            waveplates = [i for i in waveplates if "bob" in i]
+        if "h" in wvplt:
+            waveplates = [i for i in waveplates if "HWP" in i]
+        if "q" in wvplt:
+            waveplates = [i for i in waveplates if "QWP" in i]
+        if "1" in wvplt:
+            waveplates = [i for i in waveplates if "1" in i]
+        if "2" in wvplt:
+            waveplates = [i for i in waveplates if "2" in i]
+        if "p" in wvplt:
+            waveplates = [i for i in waveplates if "Power" in i]
+        return waveplates
+
+    def measure_at(self, mc_obj, positions, count_type, window_type, int_time):
+        """Move waveplates to positions {name: angle} and integrate counts
+        measured after they settled. Returns (counts, settled positions)."""
+        mc_obj.goto_many(positions)
+        settled = mc_obj.wait_settled(
+            targets=positions, target_tolerance=self.settle_tolerance()
+        )
+        since = time.time()
+        counts = self.get_power(int_time, count_type, window_type, since=since)
+        return counts, settled
+
+    def optimize_wvplt_fit(
+        self,
+        arm="Bob",
+        count_type="Coinc",
+        wvplt="",
+        int_time=1,
+        window_type="no_PC",
+        custom=False,
+        max_rounds=3,
+        maximize=False,
+    ):
+        """
+        Calibrate waveplates one at a time by sampling a few angles around
+        the current one, fitting the Malus-law curve of the waveplate and
+        moving to the fitted minimum (or maximum). A waveplate is fitted
+        again in another round, up to max_rounds, only while its fit does
+        not explain the samples or its extremum lies outside the sampled
+        span.
+        Returns (positions, counts, report) with the fit quality of every
+        round and the number of integrations.
+        """
+        motor = arm.lower() if custom else "source"
+        min_r2 = self.config.get("calibration", {}).get(
+            "min_r2", waveplate_fit.DEFAULT_MIN_R2
+        )
+        poisson = count_type.lower() in ("sa", "sb", "coinc")
+        better = (lambda a, b: a > b) if maximize else (lambda a, b: a < b)
+        with self.connect_to_motor(
+            self.motorInfo[motor]["ip"], self.motorInfo[motor]["port"]
+        ) as mc_obj:
+            waveplates = self.select_waveplates(mc_obj, wvplt, custom)
+            self.logger.info(f"Fitting waveplates: {waveplates}")
+            positions = mc_obj.get_many(waveplates)
+            current = {wp: float(positions[wp]) for wp in waveplates}
+            best_counts, best_pos = None, dict(current)
+            fits = {wp: [] for wp in waveplates}
+            evaluations = 0
+            # the scan moves these waveplates outside of the shadow map
+            self.shadow.invalidate(self.motor_server(motor), waveplates)
+
+            pending = list(waveplates)
+            for n_round in range(max_rounds):
+                for wp in list(pending):
+                    kind = waveplate_fit.kind_of(wp)
+                    offsets = waveplate_fit.DEFAULT_OFFSETS[kind]
+                    center = current[wp]
+                    angles, counts = [], []
+                    for angle in center + offsets:
+                        c, settled = self.measure_at(
+                            mc_obj, {wp: float(angle)}, count_type, window_type, int_time
+                        )
+                        evaluations += 1
+                        angles.append(float(settled[wp]))
+                        counts.append(c)
+                        if best_counts is None or better(c, best_counts):
+                            best_counts = c
+                            best_pos = dict(current, **{wp: angles[-1]})
+                    result = waveplate_fit.fit(angles, counts, kind, poisson)
+                    best, predicted = waveplate_fit.extremum(
+                        result, center, maximize
+                    )
+                    good = waveplate_fit.good_fit(
+                        result, offsets, center, best, min_r2
+                    )
+                    if result["r2"] < min_r2:
+                        # the curve is not trusted, take the best sample
+                        i = np.argmax(counts) if maximize else np.argmin(counts)
+                        best, predicted = angles[i], counts[i]
+                    mc_obj.goto_many({wp: best})
+                    # the next waveplate is measured with this one in place
+                    mc_obj.wait_settled(
+                        targets={wp: best},
+                        target_tolerance=self.settle_tolerance(),
+                    )
+                    current[wp] = best
+                    fits[wp].append({
+                        "round": n_round,
+                        "angle": best,
+                        "predicted": predicted,
+                        "r2": result["r2"],
+                        "chi2_red": result.get("chi2_red"),
+                        "good": good,
+                    })
+                    self.logger.debug(f"Fit of {wp}: {fits[wp][-1]}")
+                    if good:
+                        pending.remove(wp)
+                if not pending:
+                    break
+
+            counts, settled = self.measure_at(
+                mc_obj, current, count_type, window_type, int_time
+            )
+            evaluations += 1
+            if best_counts is not None and better(best_counts, counts):
+                # a sample beat the fitted optimum, e.g. from noise
+                mc_obj.goto_many(best_pos)
+                settled = mc_obj.wait_settled(
+                    targets=best_pos, target_tolerance=self.settle_tolerance()
+                )
+                counts = best_counts
+            optimized_positions = {wp: float(settled[wp]) for wp in waveplates}
+            self.shadow.invalidate(self.motor_server(motor), waveplates)
+        report = {
+            "rounds": n_round + 1,
+            "evaluations": evaluations,
+            "fits": fits,
+        }
+        self.logger.info(
+            f"Finished fit calibration with positions: {optimized_positions} "
+            f"and counts: {counts} after {evaluations} integrations"
+        )
+        return optimized_positions, counts, report
+
+    def optimize_wvplt_tomography(self, party, config, int_time=2.0):
+        """
+        Calibrate the fiber compensation HWP and QWP of alice or bob from a
+        fixed set of measurements: at the calibration setting and at an
+        analyzer turned by 22.5 degrees, the plates prepare each probe
+        state of fiber_tomography and the coincidences are integrated. The
+        fiber rotation is fitted from these, and the plates are set in
+        closed form to the state the fiber turns into the one the
+        calibration analyzer blocks. The plates, their order, the analyzer
+        angles and the probes can be set in calibration.tomography of the
+        config. Returns (positions, counts, report).
+        """
+        opts = config.get("calibration", {}).get("tomography", {})
+        party_opts = opts.get(party, {})
+        order = party_opts.get("order", "hwp_qwp")
+        calib = dict(config["settings"][f"{party[0]}_calib"])
+        key = "AHWP1" if party == "alice" else "BHWP1"
+        analyzer_angles = [float(a) for a in party_opts.get(
+            "analyzer_angles", [calib[key], float(calib[key]) + 22.5]
+        )]
+        probe_names = opts.get("probes", list(fiber_tomography.PROBES))
+        probes = np.array([fiber_tomography.PROBES[name] for name in probe_names])
+        probe_angles = [fiber_tomography.prepare_angles(p, order) for p in probes]
+        analyzers = fiber_tomography.analyzer_stokes(analyzer_angles)
+        counts = np.zeros((len(probes), len(analyzers)))
+
+        with self.connect_to_motor(
+            self.motorInfo["source"]["ip"], self.motorInfo["source"]["port"]
+        ) as mc_obj:
+            plates = self.select_waveplates(mc_obj, party[0])
+            hwps = [party_opts["hwp"]] if "hwp" in party_opts else [
+                wp for wp in plates if "HWP" in wp
+            ]
+            qwps = [party_opts["qwp"]] if "qwp" in party_opts else [
+                wp for wp in plates if "QWP" in wp
+            ]
+            if len(hwps) != 1 or len(qwps) != 1:
+                raise ValueError(
+                    f"Fiber tomography needs one HWP and one QWP for {party}, "
+                    f"found {plates}. Set calibration.tomography.{party}.hwp/qwp."
+                )
+            hwp_name, qwp_name = hwps[0], qwps[0]
+            self.logger.info(
+                f"Fiber tomography of {party} with {hwp_name}, {qwp_name}, "
+                f"analyzers at {analyzer_angles} and probes {probe_names}"
+            )
+            # the scan moves these waveplates outside of the shadow map
+            self.shadow.invalidate(self.motor_server("source"), [hwp_name, qwp_name])
+            for j, angle in enumerate(analyzer_angles):
+                self.set_polarization(config, dict(calib, **{key: angle}))
+                for k, (h, q) in enumerate(probe_angles):
+                    counts[k, j], _ = self.measure_at(
+                        mc_obj, {hwp_name: h, qwp_name: q}, "Coinc", "no_PC", int_time
+                    )
+            result = fiber_tomography.estimate(probes, analyzers, counts)
+            h, q = fiber_tomography.compensation(
+                result, fiber_tomography.analyzer_stokes(calib[key]), order
+            )
+            self.set_polarization(config, calib)
+            final_counts, settled = self.measure_at(
+                mc_obj, {hwp_name: h, qwp_name: q}, "Coinc", "no_PC", int_time
+            )
+            self.shadow.invalidate(self.motor_server("source"), [hwp_name, qwp_name])
+
+        axis, angle = fiber_tomography.axis_angle(result["rotation"])
+        positions = {hwp_name: float(settled[hwp_name]), qwp_name: float(settled[qwp_name])}
+        report = {
+            "evaluations": counts.size + 1,
+            "probes": probe_names,
+            "analyzer_angles": analyzer_angles,
+            "probe_counts": counts.tolist(),
+            "visibility": result["visibility"].tolist(),
+            "residual_rms": float(np.sqrt(np.mean(result["residuals"] ** 2))),
+            "rotation": result["rotation"].tolist(),
+            "rotation_axis": axis.tolist(),
+            "rotation_angle": angle,
+            "determined": result["determined"],
+        }
+        self.logger.info(
+            f"Fiber tomography of {party} set {positions} with counts "
+            f"{final_counts}; fiber rotation {angle:.1f} degrees about {axis}"
+        )
+        return positions, final_counts, report
+
     def optimize_wvplt_scipy(
         self,
         arm="Bob",
@@ -649,138 +1417,133 @@ class PolarizationServer(ZMQServiceBase):
         self.logger.debug(
             f"Starting optimization for {arm} with count type {count_type}, waveplates {wvplt}, integration time {int_time}, and window type {window_type}"
         )
-        if arm == "bob":
-            mc_obj = self.connect_to_motor(
-                motorInfo["bob"]["ip"], motorInfo["bob"]["port"]
-            )
-        elif arm == "alice":
-            mc_obj = self.connect_to_motor(
-                motorInfo["alice"]["ip"], motorInfo["alice"]["port"]
+        # the source motor server drives every waveplate unless a custom
+        # list of waveplates on the given arm is optimized
+        motor = arm if custom else "source"
+        with self.connect_to_motor(
+            motorInfo[motor]["ip"], motorInfo[motor]["port"]
+        ) as mc_obj:
+            waveplates = self.select_waveplates(mc_obj, wvplt, custom)
+            self.logger.info(
+                f"The list of waveplates to be optimized is: {waveplates}"
             )
-        elif arm == "source":
-            mc_obj = self.connect_to_motor(
-                motorInfo["source"]["ip"], motorInfo["source"]["port"]
+            best_counts = np.inf
+            start_pos = []
+            positions = mc_obj.get_many(waveplates)
+            for waveplate in waveplates:
+                start_pos.append(float(positions[waveplate]))
+
+            scale = 1  # Amount to scale the step size by
+
+            niter = 30
+            params = {
+                "count_type": count_type,
+                "scale": scale,
+                "start_pos": start_pos,
+                "best_counts": best_counts,
+                "best_pos": start_pos,
+                "mc_obj": mc_obj,
+                "waveplate": waveplates,
+                "int_time": int_time,
+                "window_type": window_type,
+            }
+            options = {"xtol": 0.2, "maxiter": niter, "maxfev": niter}
+            x0 = np.zeros_like(start_pos)
+            self.logger.info(
+                f"Starting optimization with initial positions: {str(start_pos)}"
             )
-        if custom:
-            waveplates = wvplt
-        else:
-            mc_obj = self.connect_to_motor(
-                motorInfo["source"]["ip"], motorInfo["source"]["port"]
+            # the scan moves these waveplates outside of the shadow map
+            self.shadow.invalidate(self.motor_server(motor), waveplates)
+            res = minimize(
+                self.waveplate_optimization_function,
+                x0,
+                params,
+                method="Powell",
+                options=options,
             )
-            waveplates = list(mc_obj.id_dict.keys())
-            if "s" not in wvplt:
-                waveplates = [i for i in waveplates if not "source" in i]
-            else:
-                waveplates = [i for i in waveplates if "source" in i]
-            if "a" in wvplt:
-                waveplates = [i for i in waveplates if "alice" in i]
-            if "b" in wvplt:
-                waveplates = [i for i in waveplates if "bob" in i]
-            if "h" in wvplt:
-                waveplates = [i for i in waveplates if "HWP" in i]
-            if "q" in wvplt:
-                waveplates = [i for i in waveplates if "QWP" in i]
-            if "1" in wvplt:
-                waveplates = [i for i in waveplates if "1" in i]
-            if "2" in wvplt:
-                waveplates = [i for i in waveplates if "2" in i]
-            if "p" in wvplt:
-                waveplates = [i for i in waveplates if "Power" in i]
-
-        self.logger.info(
-            f"The list of waveplates to be optimized is: {waveplates}"
-        )
-        best_counts = np.inf
-        start_pos = []
-        for waveplate in waveplates:
-            start_pos.append(float(mc_obj.getPos(waveplate)))
-
-        scale = 1  # Amount to scale the step size by
-
-        niter = 30
-        params = {
-            "count_type": count_type,
-            "scale": scale,
-            "start_pos": start_pos,
-            "best_counts": best_counts,
-            "best_pos": start_pos,
-            "mc_obj": mc_obj,
-            "waveplate": waveplates,
-            "int_time": int_time,
-            "window_type": window_type,
-        }
-        options = {"xtol": 0.2, "maxiter": niter, "maxfev": niter}
-        x0 = np.zeros_like(start_pos)
-        self.logger.info(
-            f"Starting optimization with initial positions: {str(start_pos)}"
-        )
-        res = minimize(
-            self.waveplate_optimization_function,
-            x0,
-            params,
-            method="Powell",
-            options=options,
-        )
 
-        # print('')
-        print(
-            (
-                "Finished  optimization",
-                params["best_pos"],
-                params["best_counts"],
+            # print('')
+            print(
+                (
+                    "Finished  optimization",
+                    params["best_pos"],
+                    params["best_counts"],
+                )
+            )
+            self.logger.info(
+                f"Finished  optimization with positions: {params['best_pos']} and counts: {params['best_counts']} for {waveplates}"
             )
-        )
-        self.logger.info(
-            f"Finished  optimization with positions: {params['best_pos']} and counts: {params['best_counts']} for {waveplates}"
-        )
 
-        for i, waveplate in enumerate(waveplates):
-            mc_obj.goto(waveplate, params["best_pos"][i])
-        # print(mc_obj.getAllPos(), params['best_counts'])
-        optimized_positions = dict(zip(waveplates, params["best_pos"]))
-        return optimized_positions, params["best_counts"]
+            best_pos = dict(zip(waveplates, params["best_pos"]))
+            mc_obj.goto_many(best_pos)
+            mc_obj.wait_settled(
+                targets=best_pos, target_tolerance=self.settle_tolerance()
+            )
+            # print(mc_obj.getAllPos(), params['best_counts'])
+            self.shadow.invalidate(self.motor_server(motor), waveplates)
+            optimized_positions = dict(zip(waveplates, params["best_pos"]))
+            return optimized_positions, params["best_counts"]
+
+    def optimize_wvplts(self, party, config, mode="powell"):
+        """Calibrate the fiber compensation waveplates of a party with a
+        blind Powell search (mode powell, returns the positions) or by
+        fitting the Malus-law curve of each waveplate (mode fit, returns
+        the positions, counts and fit report) or, for alice and bob, from
+        the fiber rotation estimated by a fixed set of measurements (mode
+        tomography, returns the positions, counts and estimate)."""
+        mode = mode.lower()
+        if mode not in ("powell", "fit", "tomography"):
+            raise ValueError(
+                f"Invalid calibration mode: {mode}. Must be 'powell', 'fit' or 'tomography'."
+            )
+        if mode == "tomography" and party.lower() not in ("alice", "bob"):
+            raise ValueError("Tomography calibrates the alice or bob fiber only.")
+
+        def optimize(wvplt):
+            if mode == "tomography":
+                pos, counts, report = self.optimize_wvplt_tomography(
+                    party, config, 2.0
+                )
+                return dict(report, positions=pos, counts=counts)
+            if mode == "fit":
+                pos, counts, report = self.optimize_wvplt_fit(
+                    "Source", "Coinc", wvplt, 2.0
+                )
+                return dict(report, positions=pos, counts=counts)
+            pos, counts = self.optimize_wvplt_scipy("Source", "Coinc", wvplt, 2.0)
+            return pos
 
-    def optimize_wvplts(self, party, config):
         old_health_fail_threshold = self.health_fail_threshold
         self.health_fail_threshold = (
             60  # Increase threshold to allow for motor
         )
         party = party.lower()
-        twait = 3.0
+        # set_polarization and set_power return once the motors have
+        # settled, and the counts only use samples taken after that
 
         if party == "alice":
             self.set_polarization(config, "a_calib")
             self.logger.debug(
                 f"Setting polarization for Alice with config: {config['settings']['a_calib']}"
             )
-            time.sleep(twait)
-            pos, counts = self.optimize_wvplt_scipy(
-                "Source", "Coinc", "a", 2.0
-            )
+            pos = optimize("a")
         elif party == "bob":
             self.set_polarization(config, "b_calib")
             self.logger.debug(
                 f"Setting polarization for Bob with config: {config['settings']['b_calib']}"
             )
-            time.sleep(twait)
-            pos, counts = self.optimize_wvplt_scipy(
-                "Source", "Coinc", "b", 2.0
-            )
+            pos = optimize("b")
         elif party == "source":
             self.set_polarization(config, "2")
             self.logger.debug(
                 f"Setting polarization for Source with config: {config['settings']['2']}"
             )
-            time.sleep(twait)
             source_pow = float(self.config["source"]["source_power_angle"])
             self.set_power(0.0, source_pow)
             self.logger.debug(
                 f"Setting source power to 0 with angle: {source_pow}"
             )
-            time.sleep(twait)
-            pos, counts = self.optimize_wvplt_scipy(
-                "Source", "Coinc", "sp", 2.0
-            )
+            pos = optimize("sp")
         else:
             self.logger.warning(
                 f"Invalid party: {party}. Must be one of: 'alice', 'bob', 'source'."
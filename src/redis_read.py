@@ -6,10 +6,13 @@ Created on Fri Oct 22 15:42:44 2021
 """
 
 import redis 
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
 import json
 import time
 import numpy as np 
 import yaml
+import threading
 
 
 CHANNELCOUNTS = 'monitor:counts'
@@ -18,6 +21,20 @@ CHANNELSTATS = 'monitor:stats'
 LASTTIMESTAMP = '0-0'
 CHANNELVIOLATION = 'monitor:violationstats'
 
+# connection pools, one per (host, port, db)
+_pools = {}
+# server used when no host is given, see configure
+_default = {'host': None, 'port': 6379, 'db': 0}
+# last stream ID read per (host, port, db) and channel
+_offsets = {}
+_offsets_lock = threading.Lock()
+
+# idle connections are pinged before reuse after this many seconds
+HEALTH_CHECK_INTERVAL = 30
+# commands that fail on a dropped connection are retried on a new one
+RETRIES = 3
+BACKOFF = ExponentialBackoff(cap=2.0, base=0.05)
+
 
 
 
@@ -37,10 +54,10 @@ def redis_config(fname, ip, port=6379):
 
     
 def get_latest_data(r, channel):
-    ret = r.xrevrange(channel, count=1)[0]
+    ret = r.xrevrange(channel, count=1)
     if not ret:
         return None
-    ret = decode_dict(ret[1])
+    ret = decode_dict(ret[0][1])
     return ret
 
 def get_last_timestamp(r, channel, count=1):
@@ -52,28 +69,75 @@ def get_last_timestamp(r, channel, count=1):
     return ret
 
 
-def decode_data(rawdata):  
-    retChannel = rawdata[0]
+def parse_array(shape, dtype=float):
+    '''Parser of a JSON list of numbers (any nesting) straight into a
+    numpy array of the given shape, without building Python lists.'''
+    def parse(raw):
+        flat = np.fromstring(raw.translate(None, b'[] ').decode(), sep=',')
+        return flat.astype(dtype, copy=False).reshape(shape)
+    return parse
+
+# Parsers of the fields of each stream, by field name. Fields missing from
+# a schema are decoded as JSON if they look like JSON, else as strings.
+SCHEMAS = {
+    CHANNELCOUNTS: {
+        'isTrim': int,
+        'integrationTime': float,
+        'VV': json.loads,
+        'VV_PC': json.loads,
+        'VV_Background': json.loads,
+    },
+    CHANNELVIOLATION: {
+        'isTrim': int,
+        'integrationTime': float,
+        'VV': parse_array((4, 4), np.int64),
+    },
+}
+
+_JSON_START = frozenset(b'{["-0123456789tfn')
+
+def _guess(raw):
+    if raw[:1] and raw[0] in _JSON_START:
+        try:
+            return json.loads(raw)
+        except ValueError:
+            pass
+    return raw.decode()
+
+def _decoder(schema=None, fields=None):
+    '''({field as bytes: (field, parser)}, whether to decode the other
+    fields too) for decode_dict.'''
+    schema = schema or {}
+    names = schema if fields is None else fields
+    parsers = {name.encode(): (name, schema.get(name, _guess)) for name in names}
+    return parsers, fields is None
+
+def decode_data(rawdata, schema=None, fields=None):
+    '''List of (id, data) of an XREAD/XRANGE reply for one stream. See
+    decode_dict for schema and fields.'''
     encodedData = rawdata[1]
-
-    msgDecode = []
-    for m in encodedData:
-        timeStamp = m[0].decode()
-        data = decode_dict(m[1])
-        msgDecode.append((timeStamp,data))
-    return msgDecode
-
-def decode_dict(dict):
+    decoder = _decoder(schema, fields)
+    return [(m[0].decode(), decode_dict(m[1], decoder=decoder))
+            for m in encodedData]
+
+def decode_dict(dict, schema=None, fields=None, decoder=None):
+    '''Decode the fields of a stream entry. Without a schema every field
+    is decoded as JSON if possible, else as a string. A schema ({field:
+    parser}, e.g. SCHEMAS[channel]) gives the parser of each field, and
+    with fields (names) only those fields are decoded, which skips the
+    payloads the caller never reads.'''
+    parsers, keep_rest = decoder or _decoder(schema, fields)
     retDict = {}
-    for key in dict.keys():
-        val = dict[key].decode()
-        try: 
-            val = json.loads(val)
-        except:
-            val = dict[key].decode()
-        key = key.decode()
-        retDict[key] = val
-    return retDict 
+    if keep_rest:
+        for key, val in dict.items():
+            name, parse = parsers.get(key) or (key.decode(), _guess)
+            retDict[name] = parse(val)
+        return retDict
+    for key, (name, parse) in parsers.items():
+        val = dict.get(key)
+        if val is not None:
+            retDict[name] = parse(val)
+    return retDict
 
 def get_data(r, channel, lastTimeStamp):
     stream = {}
@@ -84,99 +148,176 @@ def get_data(r, channel, lastTimeStamp):
     msgDecode = decode_data(msg[0])
     return msgDecode
 
-def connect_to_redis(host, port, db=0):
-    r = redis.Redis(host=host, port=port, db=db)
+def configure(host, port=None, db=0):
+    '''Set the Redis server (config_setup.redis_host/redis_port) that
+    connect_to_redis and the functions here use when no host is given.'''
+    _default.update(host=host, port=port or 6379, db=db)
+
+def server_key(host=None, port=None, db=None):
+    '''(host, port, db), filled in from the configured server.'''
+    if host is None:
+        host, port, db = _default['host'], _default['port'], _default['db']
+    if host is None:
+        raise ValueError("No Redis server configured")
+    return host, port or 6379, db or 0
+
+def connect_to_redis(host=None, port=None, db=None):
+    '''A client on the process-wide connection pool for (host, port, db)
+    (default the configured server), so repeated calls reuse open
+    connections. Idle connections are health-checked before reuse, and
+    commands that hit a dropped connection reconnect with exponential
+    backoff.'''
+    key = server_key(host, port, db)
+    if key not in _pools:
+        _pools[key] = redis.ConnectionPool(
+            host=key[0], port=key[1], db=key[2],
+            health_check_interval=HEALTH_CHECK_INTERVAL,
+            socket_keepalive=True,
+            retry=Retry(BACKOFF, RETRIES),
+            retry_on_error=[redis.ConnectionError, redis.TimeoutError],
+        )
+    r = redis.Redis(connection_pool=_pools[key])
     return r
 
-
-def get_power_pockels(int_time, ip, port=6379):
-    LASTTIMESTAMP = '0-0'
-    CHANNELVIOLATION = 'monitor:violationstats'
-    CHANNELCOUNTS = 'monitor:counts'
-    # ip = 'bellamd1.campus.nist.gov'
-    # port = 6379
-    r = connect_to_redis(ip, port)  
-    trial = get_data(r,CHANNELVIOLATION, LASTTIMESTAMP)[-1][-1]
+def health(host=None, port=None, db=None):
+    '''Ping a Redis server (default the configured one).'''
+    try:
+        key = server_key(host, port, db)
+        t0 = time.time()
+        connect_to_redis(*key).ping()
+    except Exception as e:
+        return {'ok': False, 'error': str(e)}
+    return {'ok': True, 'server': f"{key[0]}:{key[1]}/{key[2]}",
+            'latency_ms': 1000*(time.time() - t0)}
+
+def stream_offsets(host=None, port=None, db=None):
+    '''{channel: last stream ID read} on a server (default the
+    configured one).'''
+    with _offsets_lock:
+        return dict(_offsets.get(server_key(host, port, db), {}))
+
+def _record_offset(r, channel, last_id):
+    kw = r.connection_pool.connection_kwargs
+    key = (kw.get('host'), kw.get('port'), kw.get('db', 0))
+    with _offsets_lock:
+        _offsets.setdefault(key, {})[channel] = last_id
+
+def follow_stream(r, channel, last_id='$', count=100, block=1000,
+                  timeout=None, stop=None, fields=None):
+    '''Yield (id, data) for every entry added to a stream after last_id
+    ('$' for entries added from now on), oldest first. XREAD blocks for up
+    to `block` ms at a time, so waiting costs neither CPU nor Redis load.
+    Entries are decoded with the schema of the channel, keeping only
+    `fields` if given.
+    The last ID read is kept for stream_offsets.
+    Raises TimeoutError when no entry arrives for `timeout` seconds, and
+    returns once the threading.Event `stop` is set.'''
+    if last_id == '$':
+        # pin '$' to an ID so nothing added between two reads is missed
+        last = r.xrevrange(channel, count=1)
+        last_id = last[0][0].decode() if last else '0-0'
+    schema = SCHEMAS.get(channel, {})
+    idle_since = time.time()
+    while stop is None or not stop.is_set():
+        msg = r.xread({channel: last_id}, count=count, block=block)
+        if not msg:
+            if timeout is not None and time.time() - idle_since > timeout:
+                raise TimeoutError(f"No new entries on {channel} for {timeout} s")
+            continue
+        entries = decode_data(msg[0], schema, fields)
+        _record_offset(r, channel, entries[-1][0])
+        for timeStamp, data in entries:
+            last_id = timeStamp
+            yield timeStamp, data
+        idle_since = time.time()
+
+def stream_timeout(integration_time):
+    # generous, but a stalled monitor does not hang the caller forever
+    return max(10., 5*integration_time)
+
+def redis_clock_offset(r):
+    '''Seconds to add to local time to get the clock of the Redis server,
+    which is what stamps the stream IDs.'''
+    t0 = time.time()
+    sec, usec = r.time()
+    t1 = time.time()
+    return sec + usec*1e-6 - 0.5*(t0 + t1)
+
+def stream_id_at(r, t):
+    '''Stream ID for local time t. Reading from it returns only entries
+    added after t.'''
+    return f"{int((t + redis_clock_offset(r))*1000)}-0"
+
+def first_id_after(r, since, integration_time):
+    '''Each sample covers the integration time before its stream ID, so
+    only samples stamped integration_time after `since` were measured
+    entirely after it.'''
+    return stream_id_at(r, since + integration_time)
+
+
+def get_power_pockels(int_time, ip=None, port=None, since=None):
+    '''Sum the violation counts over int_time seconds. With `since` (a
+    time.time() value, e.g. when the motors settled) only samples measured
+    after it are used, otherwise only samples that arrive from now on.'''
+    r = connect_to_redis(ip, port)
+    trial = get_latest_data(r, CHANNELVIOLATION)
     num_queries = int(np.ceil(int_time//trial['integrationTime'] ))
     print("integration time in software is :" , trial['integrationTime'])
-    ret_dict = {'VV': [[0,0,0,0],
-                       [0,0,0,0],
-                       [0,0,0,0],
-                       [0,0,0,0]]} 
+    last_id = '$'
+    if since is not None:
+        last_id = first_id_after(r, since, trial['integrationTime'])
+    vv = np.zeros((4, 4), dtype=np.int64)
 
-    msgCounts = None
-    ret = {'isTrim':0}
     k = 0
-    start = time.time()
-    while k <= num_queries:
-        while msgCounts is None or (ret['isTrim'] == 0):
-            msgCounts = get_data(r,CHANNELVIOLATION, LASTTIMESTAMP)
-            #print(msgCounts)
-            if msgCounts is not None:
-                ret['VV'] = (msgCounts[-1][1])['VV']
-                ret['isTrim'] = msgCounts[-1][-1]['isTrim']
-                if ret['isTrim'] == 1 and LASTTIMESTAMP < msgCounts[-1][0]:
-                    LASTTIMESTAMP = msgCounts[-1][0]
-                    #print(ret['VV']['As'])
-                    for i in range(len(ret['VV'])):
-                        for j in range(len((ret['VV'])[i])):
-                            (ret_dict['VV'][i])[j] += ((ret['VV'])[i])[j]
-                    k += 1
-                else:
-                    pass
-        #print(i < num_queries)
-        msgCounts = None
-    end = time.time()
-    # print(end - start, 'time \n')
-    r.close()
-    return ret_dict    
-
-
-
-
-
-def get_power(int_time, ip, port=6379):
-    LASTTIMESTAMP = '0-0'
-
-    CHANNELCOUNTS = 'monitor:counts'
-    # ip = 'bellamd1.campus.nist.gov'
-    # port = 6379
-    r = connect_to_redis(ip, port)  
-    trial = get_data(r,CHANNELCOUNTS, LASTTIMESTAMP)[-1][-1]
+    for timeStamp, ret in follow_stream(
+            r, CHANNELVIOLATION, last_id,
+            timeout=stream_timeout(trial['integrationTime']),
+            fields=('isTrim', 'VV')):
+        if ret['isTrim'] != 1:
+            continue
+        vv += np.asarray(ret['VV'], dtype=np.int64)
+        k += 1
+        if k > num_queries:
+            break
+    return {'VV': vv.tolist()}
+
+
+
+
+
+def get_power(int_time, ip=None, port=None, since=None):
+    '''Sum the counts over int_time seconds. With `since` (a time.time()
+    value, e.g. when the motors settled) only samples measured after it
+    are used, otherwise only samples that arrive from now on, so there is
+    no need to sleep before calling this.'''
+    r = connect_to_redis(ip, port)
+    trial = get_latest_data(r, CHANNELCOUNTS)
     num_queries = int(np.ceil(int_time//trial['integrationTime'] ))
+    last_id = '$'
+    if since is not None:
+        last_id = first_id_after(r, since, trial['integrationTime'])
 
     ret_dict = {'isTrim': 0, 'integrationTime': 0,
                 'VV': {'As': 0, 'Bs': 0, 'C': 0}, 
                 'VV_PC': {'As': 0, 'Bs': 0, 'C': 0}, 
                 'VV_Background': {'As': 0, 'Bs': 0, 'C': 0}} 
 
-    msgCounts = None
-    ret = {'isTrim':0}
     i = 0
-    start = time.time()
-    while i <= num_queries:
-        while msgCounts is None or (ret['isTrim'] == 0):
-            msgCounts = get_data(r,CHANNELCOUNTS, LASTTIMESTAMP)
-            #print(msgCounts)
-            if msgCounts is not None:
-                ret = msgCounts[-1][1]
-                if ret['isTrim'] == 1 and LASTTIMESTAMP < msgCounts[-1][0]:
-                    LASTTIMESTAMP = msgCounts[-1][0]
-                    #print(ret['VV']['As'])
-                    for key_1, value_1 in ret.items():
-                        if type(ret[key_1]) is dict:
-                            for key_2, value_2 in ret[key_1].items():
-                                ret_dict[key_1][key_2] += value_2
-                        else:
-                            ret_dict[key_1] += value_1
-                    i += 1
-                else:
-                    pass
-        #print(i < num_queries)
-        ret = {'isTrim':0}
-        msgCounts = None
-    end = time.time()
-    # print(end - start, 'time \n')
+    for timeStamp, ret in follow_stream(
+            r, CHANNELCOUNTS, last_id,
+            timeout=stream_timeout(trial['integrationTime']),
+            fields=list(ret_dict)):
+        if ret['isTrim'] != 1:
+            continue
+        for key_1, value_1 in ret.items():
+            if type(ret[key_1]) is dict:
+                for key_2, value_2 in ret[key_1].items():
+                    ret_dict[key_1][key_2] += value_2
+            else:
+                ret_dict[key_1] += value_1
+        i += 1
+        if i > num_queries:
+            break
     try:
         ret_dict['VV']['effA'] = ret_dict['VV']['C']/ret_dict['VV']['Bs']
         ret_dict['VV']['effB'] = ret_dict['VV']['C']/ret_dict['VV']['As']
@@ -196,21 +337,17 @@ def get_power(int_time, ip, port=6379):
         ret_dict['VV_PC']['effB'] = np.inf
         ret_dict['VV_PC']['effAB'] = np.inf
         
-    r.close()
     return ret_dict
     
 def main():
-    global CHANNELCOUNTS, LASTTIMESTAMP
     ip = 'bellamd1.campus.nist.gov'
     port = 6379
 
     r = connect_to_redis(ip, port)
 
-    msgCounts = get_data(r,CHANNELVIOLATION, LASTTIMESTAMP)
-    if msgCounts is not None:
-        LASTTIMESTAMP = msgCounts[-1][0]
-        counts = msgCounts[-1][1]
-        print(msgCounts[-1][1])
+    counts = get_latest_data(r, CHANNELVIOLATION)
+    if counts is not None:
+        print(counts)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,128 @@
+"""
+Stand-in for a Thorlabs APT motor server, for tests and for trying the
+client without hardware. It answers the same line commands as the real
+server over a ZMQ REP socket and keeps the motor positions in memory.
+With batch=True it also understands the batched "multi" requests of
+thorlabs_apt_motor_controller.
+
+Usage:
+    python stub_motor_server.py PORT [--names alice_HWP_1,alice_QWP_1,...] [--no-batch]
+"""
+
+import argparse
+import threading
+import time
+
+import zmq
+
+from thorlabs_apt_motor_controller import BATCH_PREFIX, BATCH_SEP
+
+DEFAULT_NAMES = (
+    "alice_HWP_1", "alice_QWP_1", "alice_HWP_2",
+    "bob_HWP_1", "bob_QWP_1", "bob_HWP_2",
+)
+
+
+class StubMotorServer(threading.Thread):
+    """
+    Serve the motor protocol on tcp://127.0.0.1:port (a free port if port
+    is 0) in a background thread. Every request is recorded in
+    self.requests, so tests can count round trips. move_time is how long
+    each single goto or home takes. With start_delay, a goto is answered
+    at once and its motor only reaches the target start_delay seconds
+    later, like a non-blocking move that has not started yet.
+    readback_offset is added to every position that is read back, e.g.
+    360 for a controller that reports another turn than was commanded.
+    """
+
+    def __init__(self, port=0, names=DEFAULT_NAMES, batch=True, move_time=0.0,
+                 start_delay=0.0, readback_offset=0.0):
+        super().__init__(daemon=True)
+        self.names = list(names)
+        self.positions = [0.0] * len(self.names)
+        self.batch = batch
+        self.move_time = move_time
+        self.start_delay = start_delay
+        self.readback_offset = readback_offset
+        self.requests = []
+        self._stop_event = threading.Event()
+        self._socket = zmq.Context.instance().socket(zmq.REP)
+        if port == 0:
+            port = self._socket.bind_to_random_port("tcp://127.0.0.1")
+        else:
+            self._socket.bind(f"tcp://127.0.0.1:{port}")
+        self.port = port
+
+    def handle(self, line):
+        parts = line.split()
+        if not parts:
+            return "Unknown command"
+        cmd, args = parts[0], parts[1:]
+        try:
+            if cmd == "apt":
+                return ",".join(self.names) + ","
+            if cmd in ("getpos", "getapos"):
+                return str(self.positions[int(args[0])] + self.readback_offset)
+            if cmd == "goto":
+                idx, target = int(args[1]), float(args[0])
+                if self.start_delay:
+                    threading.Timer(self.start_delay, self.positions.__setitem__,
+                                    (idx, target)).start()
+                    return str(self.positions[idx])
+                time.sleep(self.move_time)
+                self.positions[idx] = target
+                return str(self.positions[idx])
+            if cmd in ("for", "back"):
+                sign = 1 if cmd == "for" else -1
+                self.positions[int(args[1])] += sign * float(args[0])
+                return str(self.positions[int(args[1])])
+            if cmd == "home":
+                time.sleep(self.move_time)
+                self.positions[int(args[0])] = 0.0
+                return "0.0"
+        except (IndexError, ValueError):
+            return "Bad arguments"
+        return "Unknown command"
+
+    def respond(self, message):
+        self.requests.append(message)
+        message = message.strip()
+        if self.batch and message.startswith(BATCH_PREFIX):
+            cmds = message[len(BATCH_PREFIX):].split(BATCH_SEP)
+            # a real server moves the motors at the same time
+            return BATCH_PREFIX + BATCH_SEP.join(self.handle(c) for c in cmds)
+        return self.handle(message)
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        while not self._stop_event.is_set():
+            if poller.poll(100):
+                message = self._socket.recv().decode()
+                self._socket.send(self.respond(message).encode())
+        self._socket.close(linger=0)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a stub motor server.")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--names", default=",".join(DEFAULT_NAMES))
+    parser.add_argument("--no-batch", action="store_true")
+    args = parser.parse_args()
+    server = StubMotorServer(args.port, args.names.split(","),
+                             batch=not args.no_batch)
+    print(f"Stub motor server listening on port {server.port}")
+    server.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+import multiprocessing
+import threading
+import time
+from concurrent import futures
+
+import numpy as np
+import pytest
+
+import beacon_bridge_optimizations as bc_opt
+
+toRad = bc_opt.toRad
+hwp, qwp, rot = bc_opt.hwp, bc_opt.qwp, bc_opt.rot
+
+PARTIES = [
+    (bc_opt.jones_avg_alice_static, bc_opt.pc_rot_alice),
+    (bc_opt.jones_avg_bob_static, bc_opt.pc_rot_bob),
+]
+
+
+def what_angles_reference(parameters, pc_static_jones,
+                          theor_angles, pc_rot, off_state_only=False):
+    '''The original one-vector-at-a-time cost function, built from the
+    scalar hwp()/qwp()/rot() matrices.'''
+    hwp_1 = parameters[0]*toRad
+    qwp_1 = parameters[1]*toRad
+    hwp_2 = parameters[2]*toRad
+    for param in parameters:
+        if np.abs(param) > 90.:
+            return 1e10
+
+    def orth(x): return np.array([x[1], -1*x[0]])
+
+    if off_state_only:
+        a_1 = ([0, 1] @ hwp(hwp_2) @ pc_static_jones @
+               qwp(qwp_1) @ hwp(hwp_1) @ hwp(theor_angles[0]*toRad) @ [1, 0])
+        return np.abs(a_1)*5e-1
+
+    volt = parameters[3]
+    theor_a_orth = orth(hwp(theor_angles[0]*toRad) @ [0, 1])
+    theor_b_orth = orth(hwp(theor_angles[1]*toRad) @ [0, 1])
+    a_1 = hwp(hwp_1) @ qwp(qwp_1) @ pc_static_jones @ hwp(hwp_2) @ [0, 1]
+    b_1 = (hwp(hwp_1) @ qwp(qwp_1) @ rot(pc_rot) @
+           [[1, 0], [0, np.exp(-1j*np.pi/2 * volt)]] @
+           rot(-pc_rot) @ hwp(hwp_2) @ [0, 1])
+    return (np.abs(np.dot(theor_a_orth, a_1)) +
+            np.abs(np.dot(theor_b_orth, b_1)))
+
+
+def random_parameters(n, off_state_only, seed=0):
+    rng = np.random.default_rng(seed)
+    params = rng.uniform(-100, 100, (n, 3 if off_state_only else 4))
+    if not off_state_only:
+        params[:, 3] = rng.uniform(-1, 3, n)
+    return params
+
+
+def test_batch_jones_matrices_match_scalar():
+    thetas = np.linspace(-np.pi, np.pi, 37)
+    for f_batch, f in ((bc_opt.hwp_batch, hwp), (bc_opt.qwp_batch, qwp),
+                       (bc_opt.rot_batch, rot)):
+        stack = f_batch(thetas)
+        for theta, jones in zip(thetas, stack):
+            np.testing.assert_allclose(jones, f(theta), atol=1e-12)
+
+
+def test_what_angles_batch_matches_scalar():
+    theor_angles = [22.5, -14.0]
+    for off_state_only in (True, False):
+        params = random_parameters(200, off_state_only)
+        for jones, pc_rot in PARTIES:
+            expected = [what_angles_reference(p, jones, theor_angles,
+                                              pc_rot, off_state_only)
+                        for p in params]
+            batch = bc_opt.what_angles_batch(params, jones, theor_angles,
+                                             pc_rot, off_state_only)
+            scalar = [bc_opt.what_angles(p, jones, theor_angles,
+                                         pc_rot, off_state_only)
+                      for p in params]
+            np.testing.assert_allclose(batch, expected, rtol=0, atol=1e-12)
+            np.testing.assert_allclose(scalar, expected, rtol=0, atol=1e-12)
+
+
+def test_what_angles_sq_gradient_matches_finite_differences():
+    theor_angles = [22.5, -14.0]
+    eps = 1e-6
+    for off_state_only in (True, False):
+        params = random_parameters(20, off_state_only, seed=1)
+        params[:, :3] = np.clip(params[:, :3], -85, 85)
+        for jones, pc_rot in PARTIES:
+            args = (jones, theor_angles, pc_rot, off_state_only)
+            _, grad = bc_opt.what_angles_sq_batch(params, *args)
+            for k in range(params.shape[1]):
+                step = np.zeros(params.shape[1])
+                step[k] = eps
+                numeric = (bc_opt.what_angles_sq_batch(params + step, *args)[0] -
+                           bc_opt.what_angles_sq_batch(params - step, *args)[0])/(2*eps)
+                np.testing.assert_allclose(grad[:, k], numeric, atol=1e-8)
+
+
+def test_minimize_bridge_reaches_tolerance():
+    res = bc_opt.minimize_bridge(np.array([3.0, -2.0, 5.0]),
+                                 bc_opt.jones_avg_alice_static, [22.5, 0],
+                                 bc_opt.pc_rot_alice, off_state_only=True)
+    assert res.fun < bc_opt.opt_tol_a*1e-1
+
+
+def test_solve_bridge_off_state_is_exact():
+    for jones, pc_rot in PARTIES:
+        for hwp_ang in np.linspace(-90, 90, 73):
+            angles = bc_opt.solve_bridge_off_state(hwp_ang, jones)
+            assert np.all(np.abs(angles) <= 90.)
+            cost = bc_opt.what_angles(angles, jones, [hwp_ang, 0], pc_rot,
+                                      off_state_only=True)
+            assert cost < 1e-12
+
+
+def test_multistart_bridge_is_deterministic():
+    args = (bc_opt.jones_avg_bob_static, [22.5, 0], bc_opt.pc_rot_bob)
+    first = bc_opt.multistart_bridge(*args, n_starts=4, n_workers=0)
+    second = bc_opt.multistart_bridge(*args, n_starts=4, n_workers=0)
+    np.testing.assert_array_equal(first.x, second.x)
+    assert first.n_starts == 4
+    assert first.nfev > 4
+
+
+def test_multistart_bridge_raises_when_nothing_converges():
+    args = (bc_opt.jones_avg_bob_static, [22.5, 0], bc_opt.pc_rot_bob)
+    try:
+        bc_opt.multistart_bridge(*args, opt_tol=0., n_starts=2, n_workers=0)
+    except bc_opt.BridgeOptimizationError:
+        pass
+    else:
+        raise AssertionError("expected BridgeOptimizationError")
+
+
+def test_multistart_bridge_stops_at_the_time_budget():
+    args = (bc_opt.jones_avg_bob_static, [22.5, 0], bc_opt.pc_rot_bob)
+    for n_workers in (0, 2):
+        start = time.monotonic()
+        try:
+            res = bc_opt.multistart_bridge(*args, n_starts=2000,
+                                           time_budget=0.2, n_workers=n_workers)
+        except bc_opt.BridgeOptimizationError:
+            pass
+        else:
+            assert res.n_starts < 2000
+        assert time.monotonic() - start < 1.5
+
+
+def test_bounded_bell_multistart_keeps_voltage_in_range():
+    res = bc_opt.multistart_bridge(
+        bc_opt.jones_avg_alice_static, [41.6383456, 59.62867712],
+        bc_opt.pc_rot_alice, opt_tol=bc_opt.opt_tol_a, n_starts=8,
+        n_workers=0, bounds=bc_opt.bell_bounds)
+    assert 0. <= res.x[3] <= 2.
+    assert np.all(np.abs(res.x[:3]) <= 90.)
+
+
+def test_bridge_table_lookup(tmp_path, monkeypatch):
+    monkeypatch.setattr(bc_opt, 'multistart_workers', 0)
+    monkeypatch.setattr(bc_opt, '_bridge_table', None)
+    fname = str(tmp_path / 'bridge_table.npz')
+    table = bc_opt.build_bridge_table(step=2., fname=fname)
+    assert table['alice'].shape == (91, 4)
+    for hwp_ang in (-87.6, -22.5, 3.3, 41.7):
+        for alice in (True, False):
+            res = bc_opt.lookup_bridge(hwp_ang, alice)
+            assert res is not None
+            assert res.fun < bc_opt.opt_tol_a*1e-1
+            assert np.all(np.abs(res.x[:3]) <= 90.)
+
+
+def test_sweep_bell_angles_fills_table(tmp_path, monkeypatch):
+    fname = str(tmp_path / 'bell_angle_table.npz')
+    monkeypatch.setattr(bc_opt, 'bell_table_file', fname)
+    monkeypatch.setattr(bc_opt, '_bell_table', None)
+    summary = bc_opt.sweep_bell_angles([[41.6383456, 59.62867712], [35., 55.]],
+                                       n_starts=8, n_workers=0)
+    assert summary['solved'] == 2 and summary['entries'] == 2
+    alice, bob = bc_opt.lookup_bell_table([35., 55.])
+    assert 0. <= alice[3] <= 2. and 0. <= bob[3] <= 2.
+    assert bc_opt.lookup_bell_table([36., 55.]) is None
+
+
+def test_file_cache_memory_tier(tmp_path, monkeypatch):
+    monkeypatch.setattr(bc_opt, 'memory_cache_size', 2)
+    calls = []
+
+    def square(x):
+        calls.append(x)
+        return x*x
+
+    cached = bc_opt.file_cache(square, cache_dir=str(tmp_path))
+    assert cached(3) == 9
+
+    def no_disk(cache_dir):
+        raise AssertionError("memory hit touched the disk store")
+
+    with monkeypatch.context() as m:
+        m.setattr(bc_opt, 'get_cache_store', no_disk)
+        assert cached(3) == 9
+    assert calls == [3]
+    cached(4)
+    cached(5)
+    info = cached.cache_info()
+    assert info['hits'] == 1 and info['misses'] == 3
+    assert info['evictions'] == 1 and info['size'] == 2
+    # bypassing the cache recomputes without touching the memory tier
+    assert cached(5, use_cache=False) == 25
+    assert calls == [3, 4, 5, 5]
+    assert cached.cache_info()['size'] == 2
+
+
+def test_file_cache_returns_copies(tmp_path):
+    cached = bc_opt.file_cache(lambda x: (np.full(2, x), [x]),
+                               cache_dir=str(tmp_path))
+    arr, lst = cached(1.)
+    arr[0] = lst[0] = -1.
+    arr, lst = cached(1.)
+    np.testing.assert_array_equal(arr, [1., 1.])
+    assert lst == [1.]
+    assert cached.cache_info()['hits'] == 1
+
+
+def test_cache_keys_follow_the_pockels_model(tmp_path, monkeypatch):
+    pockels_cell = {
+        party: {'jones_avg_static': [[str(v) for v in row] for row in jones],
+                'pc_rot': pc_rot/toRad, 'quarter_wave_voltage': 600.}
+        for party, (jones, pc_rot) in zip(('alice', 'bob'), PARTIES)
+    }
+    builtin = bc_opt.pockels_model_id
+    for name in ('jones_avg_alice_static', 'jones_avg_bob_static',
+                 'pc_rot_alice', 'pc_rot_bob', 'quarter_wave_alice',
+                 'quarter_wave_bob', 'pockels_model_id'):
+        monkeypatch.setattr(bc_opt, name, getattr(bc_opt, name))
+    assert bc_opt.set_pockels_model(pockels_cell) == builtin
+
+    calls = []
+
+    def model_rot(x):
+        calls.append(x)
+        return bc_opt.pc_rot_alice
+
+    cached = bc_opt.file_cache(model_rot, cache_dir=str(tmp_path))
+    assert cached(1) == bc_opt.pc_rot_alice
+    pockels_cell['alice']['pc_rot'] = -44.
+    assert bc_opt.set_pockels_model(pockels_cell) != builtin
+    assert cached(1) == -44.*toRad
+    assert calls == [1, 1]
+
+
+def test_spawned_workers_use_the_current_model(monkeypatch):
+    for name in bc_opt._MODEL_STATE + ('_bridge_table', '_bell_table'):
+        monkeypatch.setattr(bc_opt, name, getattr(bc_opt, name))
+    pockels_cell = {
+        party: {'jones_avg_static': [[str(v) for v in row] for row in jones],
+                'pc_rot': -44., 'quarter_wave_voltage': 600.}
+        for party, (jones, pc_rot) in zip(('alice', 'bob'), PARTIES)
+    }
+    model = bc_opt.set_pockels_model(pockels_cell)
+    # a spawned worker imports the module with the built-in model
+    ctx = multiprocessing.get_context('spawn')
+    with futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        _, pc_rot, _ = pool.submit(bc_opt._with_model, bc_opt._model_state(),
+                                   bc_opt._party_model, True).result()
+        state = pool.submit(bc_opt._with_model, bc_opt._model_state(),
+                            bc_opt._model_state).result()
+    assert state['pockels_model_id'] == model
+    assert pc_rot == -44.*toRad
+
+
+def test_migrate_cache_resolves_entries_for_new_model(tmp_path, monkeypatch):
+    for name in ('jones_avg_alice_static', 'jones_avg_bob_static',
+                 'pc_rot_alice', 'pc_rot_bob', 'quarter_wave_alice',
+                 'quarter_wave_bob', 'pockels_model_id', '_bridge_table',
+                 '_bell_table'):
+        monkeypatch.setattr(bc_opt, name, getattr(bc_opt, name))
+    monkeypatch.setattr(bc_opt, 'bridge_table_file',
+                        str(tmp_path / 'bridge_{model}.npz'))
+    monkeypatch.setattr(bc_opt, 'bell_table_file',
+                        str(tmp_path / 'bell_{model}.npz'))
+    old_model = bc_opt.pockels_model_id
+    store = bc_opt.get_cache_store(str(tmp_path))
+    calls = [((22.5,), {'alice': True, 'off_state_only': True}),
+             ((-30.,), {'alice': False, 'off_state_only': False})]
+    for i, (args, kwargs) in enumerate(calls):
+        value = bc_opt.set_bridge_to_hwp.__wrapped__(*args, **kwargs)
+        store.put('set_bridge_to_hwp', f'{old_model}:{i}', value,
+                  args=bc_opt.json.dumps([list(args), kwargs]))
+    store.put('set_bridge_to_hwp', f'{old_model}:legacy', np.zeros(3))
+
+    pockels_cell = {
+        party: {'jones_avg_static': [[str(v) for v in row] for row in jones],
+                'pc_rot': pc_rot/toRad + 0.5, 'quarter_wave_voltage': 600.}
+        for party, (jones, pc_rot) in zip(('alice', 'bob'), PARTIES)
+    }
+    new_model = bc_opt.set_pockels_model(pockels_cell)
+    report = bc_opt.migrate_cache(cache_dir=str(tmp_path), n_workers=0)
+    assert report['from_model'] == old_model
+    assert report['to_model'] == new_model
+    assert len(report['migrated']) == 2 and not report['failed']
+    assert len(report['skipped']) == 1
+    for i, (args, kwargs) in enumerate(calls):
+        found, value = store.get('set_bridge_to_hwp', f'{new_model}:{i}')
+        assert found
+        jones, pc_rot = ((bc_opt.jones_avg_alice_static, bc_opt.pc_rot_alice)
+                         if kwargs['alice'] else
+                         (bc_opt.jones_avg_bob_static, bc_opt.pc_rot_bob))
+        theor = [args[0], 0]
+        if kwargs['off_state_only']:
+            cost = bc_opt.what_angles(value, jones, theor, pc_rot, True)
+        else:
+            # only the angles are cached, the voltage is re-derived
+            seed = bc_opt._voltage_seed(value, jones, theor, pc_rot)
+            cost = bc_opt.minimize_bridge(seed, jones, theor, pc_rot).fun
+        assert cost < bc_opt.opt_tol_a
+
+
+def test_migrate_cache_falls_back_to_multistart_in_the_pool(tmp_path,
+                                                           monkeypatch):
+    for name in ('jones_avg_alice_static', 'jones_avg_bob_static',
+                 'pc_rot_alice', 'pc_rot_bob', 'quarter_wave_alice',
+                 'quarter_wave_bob', 'pockels_model_id', '_bridge_table',
+                 '_bell_table'):
+        monkeypatch.setattr(bc_opt, name, getattr(bc_opt, name))
+    monkeypatch.setattr(bc_opt, 'bridge_table_file',
+                        str(tmp_path / 'bridge_{model}.npz'))
+    monkeypatch.setattr(bc_opt, 'bell_table_file',
+                        str(tmp_path / 'bell_{model}.npz'))
+    old_model = bc_opt.pockels_model_id
+    store = bc_opt.get_cache_store(str(tmp_path))
+    kwargs = {'alice': False, 'off_state_only': False, 'n_starts': 4}
+    # a seed the warm-started solve cannot recover from
+    store.put('set_bridge_to_hwp', f'{old_model}:0', np.full(3, 90.),
+              args=bc_opt.json.dumps([[-30.], kwargs]))
+    pockels_cell = {
+        party: {'jones_avg_static': [[str(v) for v in row] for row in jones],
+                'pc_rot': pc_rot/toRad + 0.5, 'quarter_wave_voltage': 600.}
+        for party, (jones, pc_rot) in zip(('alice', 'bob'), PARTIES)
+    }
+    new_model = bc_opt.set_pockels_model(pockels_cell)
+    jones, pc_rot, _ = bc_opt._party_model(False)
+    seed = bc_opt._voltage_seed(np.full(3, 90.), jones, [-30., 0], pc_rot)
+    assert (bc_opt.minimize_bridge(seed, jones, [-30., 0], pc_rot).fun >=
+            bc_opt.opt_tol_a*1e-1)
+
+    reports = []
+    worker = threading.Thread(daemon=True, target=lambda: reports.append(
+        bc_opt.migrate_cache(cache_dir=str(tmp_path), n_workers=2)))
+    worker.start()
+    worker.join(timeout=60.)
+    assert not worker.is_alive(), "migrate_cache hung in the pool"
+    assert len(reports[0]['migrated']) == 1 and not reports[0]['failed']
+    found, value = store.get('set_bridge_to_hwp', f'{new_model}:0')
+    assert found
+    seed = bc_opt._voltage_seed(value, jones, [-30., 0], pc_rot)
+    assert (bc_opt.minimize_bridge(seed, jones, [-30., 0], pc_rot).fun <
+            bc_opt.opt_tol_a)
+
+
+def test_prewarm_solves_only_missing_entries(tmp_path, monkeypatch):
+    store = bc_opt.CacheStore(str(tmp_path / 'cache.sqlite'))
+    monkeypatch.setattr(bc_opt, 'get_cache_store', lambda cache_dir: store)
+    monkeypatch.setattr(bc_opt, 'bell_table_file',
+                        str(tmp_path / 'bell_{model}.npz'))
+    monkeypatch.setattr(bc_opt, '_bell_table', None)
+    bc_opt.set_bridge_to_hwp.cache_clear()
+    bc_opt.set_bridge_to_hwp(0., alice=True, off_state_only=True)
+    progress = []
+    summary = bc_opt.prewarm([(0., True), (45.25, False)],
+                             [[35., 55.]], n_workers=0,
+                             progress=lambda *p: progress.append(p))
+    assert summary == {'cached': 1, 'solved': 2, 'failed': 0}
+    assert progress[0] == (1, 3) and progress[-1] == (3, 3)
+    assert bc_opt.set_bridge_to_hwp.cache_contains(45.25, alice=False,
+                                                   off_state_only=True)
+    assert bc_opt.lookup_bell_table([35., 55.]) is not None
+    bc_opt.set_bridge_to_hwp.cache_clear()
+
+
+def test_prewarm_builds_a_missing_bridge_table(tmp_path, monkeypatch):
+    monkeypatch.setattr(bc_opt, 'bridge_table_file',
+                        str(tmp_path / 'bridge_{model}.npz'))
+    monkeypatch.setattr(bc_opt, '_bridge_table', None)
+    built = []
+    monkeypatch.setattr(bc_opt, 'build_bridge_table',
+                        lambda: built.append(bc_opt.pockels_model_id))
+    bc_opt.prewarm(n_workers=0)
+    assert built == []
+    bc_opt.prewarm(n_workers=0, bridge_table=True)
+    assert built == [bc_opt.pockels_model_id]
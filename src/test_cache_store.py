@@ -0,0 +1,37 @@
+import pickle
+import sqlite3
+
+from cache_store import CacheStore
+
+
+def test_put_get_and_prune(tmp_path):
+    store = CacheStore(str(tmp_path / "cache.sqlite"))
+    assert store.get("f", "abc") == (False, None)
+    store.put("f", "abc", [1.0, 2.0], args="((1,), {})")
+    store.put("g", "def", 3)
+    assert store.get("f", "abc") == (True, [1.0, 2.0])
+    assert [row[:2] for row in store.entries("f")] == [("f", "abc")]
+    assert store.prune(func="g") == 1
+    assert store.get("g", "def") == (False, None)
+
+
+def test_corrupted_entry_is_a_miss(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    store = CacheStore(path)
+    store.put("f", "abc", {"x": 1})
+    con = sqlite3.connect(path)
+    with con:
+        con.execute("UPDATE entries SET value=? WHERE key='abc'",
+                    (pickle.dumps({"x": 2}),))
+    con.close()
+    assert store.get("f", "abc") == (False, None)
+    assert store.entries() == []
+
+
+def test_import_legacy_pickles(tmp_path):
+    with open(tmp_path / "set_bridge_to_hwp_0123abcd.pkl", "wb") as f:
+        pickle.dump([1, 2, 3], f)
+    (tmp_path / "angles_bell_test_ffff.pkl").write_bytes(b"\x80truncated")
+    store = CacheStore(str(tmp_path / "cache.sqlite"))
+    assert store.import_pickles(str(tmp_path)) == 1
+    assert store.get("set_bridge_to_hwp", "0123abcd") == (True, [1, 2, 3])
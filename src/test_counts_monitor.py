@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from counts_monitor import CountsBuffer, ViolationBuffer, ch_statistic
+
+
+def sample(a, b, c):
+    return {"isTrim": 1, "integrationTime": 1.0,
+            "VV": {"As": a, "Bs": b, "C": c},
+            "VV_PC": {"As": 2 * a, "Bs": 2 * b, "C": 2 * c}}
+
+
+def test_window_sums_samples_inside():
+    buf = CountsBuffer(capacity=4)
+    for i in range(6):
+        buf.append(100.0 + i, 1.0, sample(100, 400, 10 * i))
+    # the first two samples were overwritten
+    assert buf.status()["samples"] == 4
+    counts = buf.window(101.5, 104.0)
+    # only the samples covering [102, 103] and [103, 104] are entirely inside
+    assert counts["samples"] == 2
+    assert counts["integrationTime"] == 2.0
+    assert counts["VV"] == pytest.approx(
+        {"As": 200, "Bs": 800, "C": 70, "effA": 70 / 800, "effB": 70 / 200,
+         "effAB": 70 / np.sqrt(200 * 800)})
+    assert counts["VV_PC"]["C"] == 140
+    assert counts["VV_Background"]["C"] == 0
+    assert buf.window(200.0, 300.0)["VV"]["effAB"] == np.inf
+
+
+def test_wait_until():
+    buf = CountsBuffer()
+    assert not buf.wait_until(1.0, timeout=0.01)
+    buf.append(2.0, 1.0, sample(1, 1, 1))
+    assert buf.wait_until(2.5, timeout=0.01)
+    # a sample ending at 3 could still arrive
+    assert not buf.wait_until(3.0, timeout=0.01)
+
+
+def test_ch_statistic():
+    # rows 00, 01, 10, 11: trials, Alice, Bob, coincidences
+    vv = [[1000, 30, 30, 20],
+          [1000, 30, 25, 18],
+          [1000, 25, 30, 18],
+          [1000, 25, 25, 1]]
+    J, sigma = ch_statistic(vv)
+    assert J == pytest.approx((20 - 12 - 12 - 1) / 1000)
+    assert sigma == pytest.approx(np.sqrt(20 + 12 + 12 + 1) / 1000)
+    assert np.isnan(ch_statistic(np.zeros((4, 4)))[0])
+
+
+def test_violation_window():
+    buf = ViolationBuffer()
+    vv = np.array([[100, 3, 3, 3], [100, 1, 3, 1],
+                   [100, 3, 1, 1], [100, 2, 2, 0]])
+    for i in range(3):
+        buf.append(10.0 + i, 1.0, {"isTrim": 1, "VV": vv.tolist()})
+    stats = buf.window(9.0, 12.0)
+    assert stats["samples"] == 3
+    assert stats["VV"] == (3 * vv).tolist()
+    assert stats["J"] == pytest.approx(0.03)
+    assert stats["violation"] == pytest.approx(0.03 / stats["sigma"])
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+import fiber_tomography as ft
+from beacon_bridge_optimizations import hwp_batch, qwp_batch
+
+
+def random_su2(rng):
+    q = rng.normal(size=4)
+    q /= np.linalg.norm(q)
+    a, b = q[0] + 1j * q[1], q[2] + 1j * q[3]
+    return np.array([[a, -np.conj(b)], [b, np.conj(a)]])
+
+
+def through_fiber(fiber, hwp_angle, qwp_angle):
+    plates = qwp_batch(np.deg2rad(qwp_angle)) @ hwp_batch(np.deg2rad(hwp_angle))
+    return ft.stokes(fiber @ plates[:, 0])
+
+
+@pytest.mark.parametrize("order", ft.ORDERS)
+def test_prepare_angles_closed_form(order):
+    rng = np.random.default_rng(0)
+    targets = rng.normal(size=(50, 3))
+    targets /= np.linalg.norm(targets, axis=1)[:, None]
+    for t in list(targets) + [np.array(p) for p in ft.PROBES.values()]:
+        h, q = ft.prepare_angles(t, order)
+        np.testing.assert_allclose(ft.compensator_output(h, q, order), t, atol=1e-9)
+
+
+def test_estimate_and_compensate_fiber():
+    rng = np.random.default_rng(1)
+    fiber = random_su2(rng)
+    probes = np.array(list(ft.PROBES.values()))
+    angles = [ft.prepare_angles(p) for p in probes]
+    analyzers = ft.analyzer_stokes([45.0, 67.5])
+    counts = np.array([
+        [5000 * (1 + s @ through_fiber(fiber, h, q)) for s in analyzers]
+        for h, q in angles
+    ])
+    result = ft.estimate(probes, analyzers, counts)
+    assert result["determined"]
+    np.testing.assert_allclose(result["visibility"], 1.0, atol=1e-9)
+    np.testing.assert_allclose(result["residuals"], 0.0, atol=1e-6)
+    # the fitted rotation is the fiber's, for every state
+    for p, (h, q) in zip(probes, angles):
+        np.testing.assert_allclose(result["rotation"] @ p,
+                                   through_fiber(fiber, h, q), atol=1e-9)
+    h, q = ft.compensation(result, analyzers[0])
+    assert analyzers[0] @ through_fiber(fiber, h, q) == pytest.approx(-1.0)
+
+
+def test_axis_angle():
+    rotation = np.array([[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+    axis, angle = ft.axis_angle(rotation)
+    np.testing.assert_allclose(axis, [0.0, 0.0, 1.0])
+    assert angle == pytest.approx(90.0)
+    assert ft.axis_angle(np.eye(3))[1] == pytest.approx(0.0)
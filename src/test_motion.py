@@ -0,0 +1,66 @@
+import pytest
+
+import motion
+
+
+def test_nearest_equivalent():
+    assert motion.nearest_equivalent(10., 175.) == 190.
+    assert motion.nearest_equivalent(10., -100.) == -170.
+    assert motion.nearest_equivalent(-80., 95.) == 100.
+    assert motion.nearest_equivalent(10., 175., limits=(-180., 180.)) == 10.
+    assert motion.nearest_equivalent(0., 90.) in (0., 180.)
+
+
+def test_plan_moves_skips_and_shortens():
+    current = {"alice_HWP_1": 180.005, "alice_QWP_1": 10.,
+               "source_Power_1": 0.}
+    targets = {"alice_HWP_1": 0., "alice_QWP_1": -165.,
+               "source_Power_1": 180., "alice_HWP_2": 45.}
+    moves, skipped = motion.plan_moves(targets, current)
+    assert skipped == ["alice_HWP_1"]
+    # waveplates move to the equivalent angle nearest to where they are
+    assert moves["alice_QWP_1"] == pytest.approx(15.)
+    # other motors (and unknown positions) go where they are told
+    assert moves["source_Power_1"] == 180.
+    assert moves["alice_HWP_2"] == 45.
+
+
+def test_shadow_positions_expire_and_invalidate(monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(motion.time, "monotonic", lambda: now[0])
+    shadow = motion.ShadowPositions(max_age=10.)
+    shadow.update(("127.0.0.1", 55000), {"alice_HWP_1": 1., "alice_QWP_1": None})
+    assert shadow.get(("127.0.0.1", 55000)) == {"alice_HWP_1": 1.}
+    now[0] += 11.
+    assert shadow.get(("127.0.0.1", 55000)) == {}
+    shadow.update(("127.0.0.1", 55000), {"alice_HWP_1": 2.})
+    shadow.invalidate(("127.0.0.1", 55000), ["alice_HWP_1"])
+    assert shadow.get(("127.0.0.1", 55000)) == {}
+
+
+def test_order_for_travel():
+    steps = [{"alice_HWP_1": a} for a in (0., 60., 10., 50., 20.)]
+    order = motion.order_for_travel(steps, start={"alice_HWP_1": 0.})
+    assert order == [0, 2, 4, 3, 1]
+    # 170 and 0 are 10 degrees apart for a waveplate
+    steps = [{"bob_QWP_1": a} for a in (0., 90., 170.)]
+    assert motion.order_for_travel(steps, start={"bob_QWP_1": 0.}) == [0, 2, 1]
+    assert motion.travel({"bob_QWP_1": 0.}, {"bob_QWP_1": 170.}) == 10.
+
+
+def test_settled():
+    assert motion.settled({"a": 1.0, "b": 2.0}, {"a": 1.005, "b": 2.0})
+    assert not motion.settled({"a": 1.0}, {"a": 1.5})
+    assert not motion.settled({"a": None}, {"a": 1.0})
+
+
+def test_at_targets_uses_equivalent_angles():
+    targets = {"alice_HWP_1": 10.0, "alice_Power_1": 10.0}
+    assert motion.at_targets({"alice_HWP_1": 190.0, "alice_Power_1": 10.0}, targets)
+    assert not motion.at_targets({"alice_HWP_1": 190.0, "alice_Power_1": 190.0}, targets)
+    assert not motion.at_targets({"alice_HWP_1": 10.5, "alice_Power_1": 10.0}, targets)
+    assert not motion.at_targets({"alice_HWP_1": None, "alice_Power_1": 10.0}, targets)
+    # other mounts may read back another turn, and land within a tenth
+    assert motion.at_targets({"alice_HWP_1": 10.1, "alice_Power_1": 370.0}, targets)
+    assert not motion.at_targets({"alice_HWP_1": 10.1, "alice_Power_1": 10.0},
+                                 targets, tolerance=0.01)
@@ -0,0 +1,93 @@
+import pytest
+
+pytest.importorskip("zmq")
+pytest.importorskip("zmqhelper")
+
+import contextlib  # noqa: E402
+import json  # noqa: E402
+import logging  # noqa: E402
+
+import numpy as np  # noqa: E402
+import yaml  # noqa: E402
+
+import motion  # noqa: E402
+from polarization_server import PolarizationServer  # noqa: E402
+
+POWER_MINIMUM = 372.0
+
+
+class FakeMotors:
+    """Motor server whose moves only finish once they are waited for."""
+
+    def __init__(self):
+        self.pos = {"source_Power_1": 365.0, "source_HWP_1": 0.0}
+        self.id_dict = dict.fromkeys(self.pos)
+        self.moving = set()
+        self.calls = []
+
+    def goto_many(self, targets):
+        self.calls.append(("goto", set(targets)))
+        self.pos.update({k: float(v) for k, v in targets.items()})
+        self.moving |= set(targets)
+
+    def wait_settled(self, names=None, tolerance=None, targets=None, **kwargs):
+        names = list(targets) if names is None else names
+        self.calls.append(("settle", set(names)))
+        assert all(self.pos[n] == targets[n] for n in targets)
+        self.moving -= set(names)
+        return {n: self.pos[n] for n in names}
+
+    def get_many(self, names):
+        return {n: self.pos[n] for n in names}
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    config = {
+        "config_setup": {"name": "test", "description": "test"},
+        "motor_servers": {"source": {"ip": "127.0.0.1", "port": 1}},
+        "settings": {"2": {"AHWP1": 45, "BHWP1": 45, "PHWP": 0}},
+        "source": {"source_power_angle": 0.0},
+    }
+    fname = tmp_path / "polarization.yaml"
+    fname.write_text(yaml.dump(config))
+    srv = PolarizationServer.__new__(PolarizationServer)
+    srv.config = config
+    srv.configFName = str(fname)
+    srv.motorInfo = config["motor_servers"]
+    srv.logger = logging.getLogger("test")
+    srv.health_fail_threshold = 10
+    srv.shadow = motion.ShadowPositions()
+    srv.motors_fake = FakeMotors()
+    monkeypatch.setattr(srv, "start_prewarm", lambda: None, raising=False)
+    monkeypatch.setattr(srv, "set_polarization", lambda *a, **k: None, raising=False)
+    monkeypatch.setattr(srv, "set_power", lambda *a, **k: None, raising=False)
+    monkeypatch.setattr(
+        srv, "connect_to_motor",
+        lambda ip, port: contextlib.nullcontext(srv.motors_fake), raising=False,
+    )
+
+    def get_power(*args, **kwargs):
+        motors = srv.motors_fake
+        # counts taken while a motor is still moving would be garbage
+        assert not motors.moving
+        theta = np.deg2rad(4 * (motors.pos["source_Power_1"] - POWER_MINIMUM))
+        return 100 + 5000 * (1 - np.cos(theta))
+
+    monkeypatch.setattr(srv, "get_power", get_power, raising=False)
+    return srv
+
+
+def test_calibrate_source_with_fit(server):
+    resp = json.loads(server.handle_request(json.dumps(
+        {"cmd": "calibrate", "params": {"party": "source", "mode": "fit"}}
+    )))
+    assert "error" not in resp, resp
+    positions = resp["message"]["positions"]
+    assert positions["source_Power_1"] == pytest.approx(POWER_MINIMUM, abs=0.1)
+    with open(server.configFName) as f:
+        saved = yaml.safe_load(f)
+    assert saved["source"]["source_power_angle"] == pytest.approx(
+        POWER_MINIMUM - 360.0, abs=0.1
+    )
+    assert not server.motors_fake.moving
@@ -0,0 +1,42 @@
+import json
+
+import numpy as np
+import pytest
+
+import redis_read as r_read
+
+ENTRY = {
+    b"isTrim": b"1",
+    b"integrationTime": b"0.5",
+    b"VV": json.dumps([[10, 2, 3, 1]] * 4).encode(),
+    b"note": b"not json",
+}
+
+
+def test_decode_dict_generic():
+    data = r_read.decode_dict(ENTRY)
+    assert data == {"isTrim": 1, "integrationTime": 0.5,
+                    "VV": [[10, 2, 3, 1]] * 4, "note": "not json"}
+
+
+def test_decode_with_schema_and_fields():
+    schema = r_read.SCHEMAS[r_read.CHANNELVIOLATION]
+    data = r_read.decode_dict(ENTRY, schema)
+    assert isinstance(data["VV"], np.ndarray) and data["VV"].shape == (4, 4)
+    assert data["note"] == "not json"
+    reply = (b"monitor:violationstats", [(b"1-0", ENTRY), (b"2-0", ENTRY)])
+    decoded = r_read.decode_data(reply, schema, fields=("isTrim", "VV"))
+    assert [ts for ts, _ in decoded] == ["1-0", "2-0"]
+    assert set(decoded[0][1]) == {"isTrim", "VV"}
+    np.testing.assert_array_equal(decoded[1][1]["VV"], [[10, 2, 3, 1]] * 4)
+
+
+def test_configured_server(monkeypatch):
+    monkeypatch.setattr(r_read, "_default", dict(r_read._default, host=None))
+    with pytest.raises(ValueError):
+        r_read.server_key()
+    assert r_read.health()["ok"] is False
+    r_read.configure("redis.example", None)
+    assert r_read.server_key() == ("redis.example", 6379, 0)
+    assert r_read.server_key("other", 6380) == ("other", 6380, 0)
+    assert r_read.stream_offsets() == {}
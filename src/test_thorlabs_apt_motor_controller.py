@@ -0,0 +1,175 @@
+import pytest
+
+pytest.importorskip("zmq")
+pytest.importorskip("zmqhelper")
+
+import time  # noqa: E402
+
+import thorlabs_apt_motor_controller  # noqa: E402
+from stub_motor_server import DEFAULT_NAMES, StubMotorServer  # noqa: E402
+from thorlabs_apt_motor_controller import (  # noqa: E402
+    AsyncMotorHub, MotorController, MotorPool,
+)
+
+TARGETS = {name: 10.0 + i for i, name in enumerate(DEFAULT_NAMES)}
+
+
+@pytest.fixture(params=[True, False], ids=["batch", "fallback"])
+def server(request):
+    stub = StubMotorServer(batch=request.param)
+    stub.start()
+    yield stub
+    stub.stop()
+
+
+def test_batched_commands(server):
+    mc = MotorController("127.0.0.1", server.port)
+    try:
+        assert list(mc.id_dict) == list(DEFAULT_NAMES)
+        resp = mc.goto_many(dict(TARGETS, not_a_motor=1.0))
+        assert resp["not_a_motor"] == "Motor not connected"
+        assert mc.get_many() == TARGETS
+        assert mc.getAllPos() == TARGETS
+        mc.home_many(["alice_HWP_1", "bob_HWP_2"])
+        positions = mc.get_many(["alice_HWP_1", "bob_HWP_2", "alice_QWP_1"])
+        assert positions == {"alice_HWP_1": 0.0, "bob_HWP_2": 0.0,
+                             "alice_QWP_1": TARGETS["alice_QWP_1"]}
+    finally:
+        mc.close()
+    assert mc.batch is server.batch
+    if server.batch:
+        # name lookup, batch probe, then one request per call
+        assert len(server.requests) == 2 + 5
+
+
+def test_pool_reuses_names_and_batch_support(server):
+    pool = MotorPool()
+    with pool.connection("127.0.0.1", server.port) as mc:
+        mc.goto_many(TARGETS)
+    n_requests = len(server.requests)
+    with pool.connection("127.0.0.1", server.port) as mc:
+        assert mc.get_many() == TARGETS
+    pool.close()
+    if server.batch:
+        assert len(server.requests) == n_requests + 1
+    assert pool.refresh("127.0.0.1", server.port) == mc.id_dict
+
+
+def test_hub_fans_out_and_times_out_per_party():
+    stubs = [StubMotorServer(move_time=0.1),
+             StubMotorServer(batch=False, move_time=0.1)]
+    for stub in stubs:
+        stub.start()
+    # bound but never started, so it never answers
+    dead = StubMotorServer()
+    dead_port = dead.port
+    hub = AsyncMotorHub()
+    try:
+        calls = {
+            "alice": ("127.0.0.1", stubs[0].port, lambda mc: mc.goto_many(TARGETS)),
+            "bob": ("127.0.0.1", stubs[1].port, lambda mc: mc.goto_many(TARGETS)),
+            "source": ("127.0.0.1", dead_port, lambda mc: mc.get_many()),
+        }
+        start = time.monotonic()
+        results = hub.gather(calls, timeout=1.0)
+        elapsed = time.monotonic() - start
+        assert isinstance(results["source"], Exception)
+        for party in ("alice", "bob"):
+            assert set(results[party]) == set(TARGETS)
+        # the parties overlap instead of adding up
+        assert elapsed < 1.5
+        positions = hub.gather({
+            "alice": ("127.0.0.1", stubs[0].port, lambda mc: mc.get_many()),
+        })
+        assert positions["alice"] == TARGETS
+    finally:
+        hub.close()
+        for stub in stubs:
+            stub.stop()
+        dead._socket.close(linger=0)
+
+
+def test_wait_settled(server):
+    mc = MotorController("127.0.0.1", server.port)
+    try:
+        mc.goto_many(TARGETS)
+        assert mc.wait_settled(list(TARGETS), interval=0.01) == TARGETS
+    finally:
+        mc.close()
+
+
+def test_wait_settled_waits_for_targets():
+    # the motors report their old, steady positions until they start
+    stub = StubMotorServer(start_delay=0.3)
+    stub.start()
+    mc = MotorController("127.0.0.1", stub.port)
+    hub = AsyncMotorHub()
+    try:
+        mc.goto_many(TARGETS)
+        assert mc.wait_settled(targets=TARGETS, interval=0.01) == TARGETS
+        moved = {name: pos + 90.0 for name, pos in TARGETS.items()}
+        result = hub.gather({
+            "alice": ("127.0.0.1", stub.port, lambda c: c.goto_many(moved)),
+        })
+        assert not isinstance(result["alice"], Exception)
+        with pytest.raises(TimeoutError):
+            mc.wait_settled(targets=moved, interval=0.01, max_wait=0.1)
+        settled = hub.gather({"alice": (
+            "127.0.0.1", stub.port,
+            lambda c: c.wait_settled(targets=moved, interval=0.01),
+        )})
+        assert settled["alice"] == moved
+    finally:
+        hub.close()
+        mc.close()
+        stub.stop()
+
+
+def test_unanswered_batch_probe_is_cached(monkeypatch):
+    monkeypatch.setattr(thorlabs_apt_motor_controller, "BATCH_PROBE_TIMEOUT", 100)
+    # bound but never started, so it never answers
+    dead = StubMotorServer()
+    mc = MotorController("127.0.0.1", dead.port,
+                         id_dict={name: i for i, name in enumerate(DEFAULT_NAMES)})
+    try:
+        assert mc.supports_batch() is False
+        assert mc.batch is False
+        assert not mc.failed
+    finally:
+        mc.close()
+        dead._socket.close(linger=0)
+
+
+def test_async_batch_probe_times_out_once(monkeypatch):
+    monkeypatch.setattr(thorlabs_apt_motor_controller, "BATCH_PROBE_TIMEOUT", 100)
+    dead = StubMotorServer()
+    hub = AsyncMotorHub()
+    client = hub.client("127.0.0.1", dead.port)
+    client.id_dict = {name: i for i, name in enumerate(DEFAULT_NAMES)}
+    try:
+        # requests wait indefinitely, but the probe gives up on its own
+        start = time.monotonic()
+        result = hub.gather({
+            "alice": ("127.0.0.1", dead.port, lambda c: c.supports_batch()),
+        }, timeout=5.0)
+        assert result["alice"] is False
+        assert time.monotonic() - start < 1.0
+        assert client.batch is False
+    finally:
+        hub.close()
+        dead._socket.close(linger=0)
+
+
+def test_wait_settled_accepts_another_turn():
+    # like the source power mount, which reads back 360 degrees above
+    stub = StubMotorServer(names=["source_Power_1"], readback_offset=360.0)
+    stub.start()
+    mc = MotorController("127.0.0.1", stub.port)
+    try:
+        mc.goto_many({"source_Power_1": -69.19})
+        settled = mc.wait_settled(targets={"source_Power_1": -69.19},
+                                  interval=0.01, max_wait=1.0)
+        assert settled["source_Power_1"] == pytest.approx(290.81)
+    finally:
+        mc.close()
+        stub.stop()
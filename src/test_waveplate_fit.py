@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+import waveplate_fit
+
+
+def malus_hwp(theta, offset=17.0):
+    # counts behind a polarizer, minimal where 4 (theta - offset) = 180
+    return 1000 + 900 * np.cos(np.deg2rad(4 * (theta - offset)))
+
+
+def test_hwp_fit_finds_minimum():
+    center = 55.0
+    angles = center + waveplate_fit.DEFAULT_OFFSETS["HWP"]
+    counts = np.random.default_rng(0).poisson(malus_hwp(angles))
+    result = waveplate_fit.fit(angles, counts, "HWP", poisson=True)
+    best, predicted = waveplate_fit.extremum(result, center)
+    assert best == pytest.approx(17.0 + 45.0, abs=1.5)
+    assert predicted == pytest.approx(100, abs=100)
+    assert result["r2"] > 0.99
+    assert result["chi2_red"] < 5
+    assert waveplate_fit.good_fit(result, waveplate_fit.DEFAULT_OFFSETS["HWP"], center, best)
+    # the same curve seen from far away: the extremum is extrapolated
+    far = 100.0
+    result = waveplate_fit.fit(far + waveplate_fit.DEFAULT_OFFSETS["HWP"],
+                               malus_hwp(far + waveplate_fit.DEFAULT_OFFSETS["HWP"]), "HWP")
+    best, _ = waveplate_fit.extremum(result, far)
+    assert best == pytest.approx(62.0, abs=0.1)
+    assert not waveplate_fit.good_fit(result, waveplate_fit.DEFAULT_OFFSETS["HWP"], far, best)
+
+
+def test_qwp_fit_and_maximum():
+    coeffs = np.array([500., 120., -80., 200., 60.])
+    angles = 10.0 + waveplate_fit.DEFAULT_OFFSETS["QWP"]
+    counts = waveplate_fit.model(coeffs, angles, "QWP")
+    result = waveplate_fit.fit(angles, counts, "QWP")
+    np.testing.assert_allclose(result["coeffs"], coeffs, atol=1e-8)
+    grid = np.arange(-80.0, 100.0, 0.01)
+    best, value = waveplate_fit.extremum(result, 10.0, maximize=True)
+    assert value == pytest.approx(waveplate_fit.model(coeffs, grid, "QWP").max(), rel=1e-5)
+    assert waveplate_fit.kind_of("alice_QWP_1") == "QWP"
+    assert waveplate_fit.kind_of("source_Power_1") == "HWP"
@@ -1,20 +1,70 @@
 # motor_controller.py
-from threading import Thread
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock, Thread
+import zmq
+import zmq.asyncio
 from zmqhelper import Client
+import motion
+
+# Protocol extension for batched commands: "multi <cmd>;<cmd>;..." is
+# answered with "multi <resp>;<resp>;..." in the same order. Servers that
+# do not know it answer anything else, which the client detects once.
+BATCH_PREFIX = "multi "
+BATCH_SEP = ";"
+# ms to wait for the answer to the batch probe; servers that do not know
+# batches may drop the request instead of answering it
+BATCH_PROBE_TIMEOUT = 2000
+
+
+def batch_request(cmds: list) -> str:
+    return BATCH_PREFIX + BATCH_SEP.join(cmds)
+
+
+def parse_batch(resp: str, names: list) -> dict:
+    """{name: response} from a batched reply; missing parts count as timeouts."""
+    if resp == "Timeout":
+        return {name: "Timeout" for name in names}
+    parts = resp[len(BATCH_PREFIX):].rstrip("\n").split(BATCH_SEP)
+    results = {name: "Timeout" for name in names}
+    results.update(zip(names, parts))
+    return results
+
+
+def to_positions(responses: dict) -> dict:
+    positions = {}
+    for name, pos in responses.items():
+        try:
+            positions[name] = float(pos)
+        except (ValueError, TypeError):
+            positions[name] = None
+    return positions
+
 
 class MotorController(Thread):
     """
     A threaded motor-control client that sends commands
     via a ZMQ REQ/REP socket with built-in timeouts.
     """
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, id_dict=None, batch=None):
         super().__init__()
+        self.ip = ip
+        self.port = port
+        self.failed = False  # set once a request times out
+        self.batch = batch  # whether the server takes batches, None = unknown
         self.client = Client(ip, port)
-        # build name→ID map
+        self._lanes = []  # extra connections for the unbatched fallback
+        # build name→ID map, unless it is already known
         self.id_dict = {}
+        if id_dict is not None:
+            self.id_dict = dict(id_dict)
+            return
         try:
             self.get_name(timeout=2000)
         except RuntimeError as e:
+            self.client.close()
             raise ConnectionError(f"Could not connect to motor {ip}:{port}: {e}")
         # self.get_name(timeout=2000)  # uses default timeout
 
@@ -25,9 +75,12 @@ class MotorController(Thread):
         """
         # append newline and forward the timeout
         if timeout is None:
-            return self.client.send_message(cmd + "\n")
+            resp = self.client.send_message(cmd + "\n")
         else:
-            return self.client.send_message(cmd + "\n", timeout)
+            resp = self.client.send_message(cmd + "\n", timeout)
+        if resp == "Timeout":
+            self.failed = True
+        return resp
 
     def get_name(self, timeout: int = None) -> dict:
         """Populate `self.id_dict` from the 'apt' command."""
@@ -97,18 +150,122 @@ class MotorController(Thread):
         return self._send_and_recv(cmd, timeout)
 
     def getAllPos(self, timeout: int = None) -> dict:
+        """Query every motor’s position in one batched request."""
+        return self.get_many(timeout=timeout)
+
+    def supports_batch(self, timeout: int = None) -> bool:
+        """Whether the server understands batched commands. Probed once
+        with a side-effect free position query, on its own connection so
+        that a server which drops the probe does not mark this controller
+        as failed; no answer counts as no batching."""
+        if self.batch is None and self.id_dict:
+            idx = next(iter(self.id_dict.values()))
+            if timeout is None or timeout > BATCH_PROBE_TIMEOUT:
+                timeout = BATCH_PROBE_TIMEOUT
+            probe = Client(self.ip, self.port)
+            try:
+                resp = probe.send_message(f"{BATCH_PREFIX}getpos {idx}\n", timeout)
+            finally:
+                probe.close()
+            self.batch = resp.startswith(BATCH_PREFIX)
+        return bool(self.batch)
+
+    def _send_many(self, cmds: dict, timeout: int = None) -> dict:
         """
-        Query every motor’s position in turn, using the same timeout
-        for each sub-request.
+        Send {name: cmd} in one batched round trip, or as concurrent single
+        commands if the server cannot batch. Returns {name: response}.
         """
-        positions = {}
-        for name in self.id_dict:
-            pos = self.getPos(name, timeout)
-            try:
-                positions[name] = float(pos)
-            except (ValueError, TypeError):
-                positions[name] = None
-        return positions
+        cmds = dict(cmds)
+        if not cmds:
+            return {}
+        names = list(cmds)
+        if self.supports_batch(timeout):
+            resp = self._send_and_recv(
+                batch_request([cmds[n] for n in names]), timeout
+            )
+            return parse_batch(resp, names)
+        return self._send_pipelined(names, cmds, timeout)
+
+    def _send_pipelined(self, names, cmds, timeout=None) -> dict:
+        # A REQ socket allows one outstanding request, so the commands go
+        # out at once over extra connections that are kept for reuse.
+        while len(self._lanes) < len(names) - 1:
+            self._lanes.append(Client(self.ip, self.port))
+        lanes = [self.client] + self._lanes
+
+        def send(i):
+            cmd = cmds[names[i]] + "\n"
+            if timeout is None:
+                return lanes[i].send_message(cmd)
+            return lanes[i].send_message(cmd, timeout)
+
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            responses = list(pool.map(send, range(len(names))))
+        for i, resp in enumerate(responses):
+            if resp == "Timeout":
+                if i == 0:
+                    self.failed = True
+                else:  # the connection is stuck waiting for a reply
+                    self._lanes[i - 1].close()
+                    self._lanes[i - 1] = Client(self.ip, self.port)
+        return dict(zip(names, responses))
+
+    def _many(self, template: str, args: dict, timeout: int = None) -> dict:
+        # unknown motors are reported like the single commands do
+        results = {n: "Motor not connected" for n in args if n not in self.id_dict}
+        cmds = {
+            n: template.format(arg=a, idx=self.id_dict[n])
+            for n, a in args.items() if n in self.id_dict
+        }
+        results.update(self._send_many(cmds, timeout))
+        return results
+
+    def goto_many(self, positions: dict, timeout: int = None) -> dict:
+        """Move several motors, {name: pos}, in one round trip."""
+        return self._many("goto {arg} {idx}", positions, timeout)
+
+    def home_many(self, names=None, timeout: int = None) -> dict:
+        """Home several (by default all) motors in one round trip."""
+        names = list(self.id_dict) if names is None else names
+        return self._many("home {idx}", dict.fromkeys(names), timeout)
+
+    def get_many(self, names=None, timeout: int = None) -> dict:
+        """Positions of several (by default all) motors in one round trip,
+        as floats (None where the query failed)."""
+        names = list(self.id_dict) if names is None else names
+        return to_positions(
+            self._many("getpos {idx}", dict.fromkeys(names), timeout)
+        )
+
+    def wait_settled(self, names=None, tolerance: float = motion.DEFAULT_TOLERANCE,
+                     interval: float = 0.05, max_wait: float = 30.0,
+                     targets: dict = None,
+                     target_tolerance: float = motion.DEFAULT_SETTLE_TOLERANCE) -> dict:
+        """
+        Poll the positions of `names` (default the motors in `targets`, or
+        all motors) until they are within `target_tolerance` degrees of
+        `targets` ({name: commanded position}, as passed to goto_many) and
+        two reads `interval` seconds apart agree within `tolerance`.
+        Without targets only the second condition applies, which a motor
+        that has not started moving yet also meets. Returns the settled
+        positions; raises TimeoutError after `max_wait` seconds.
+        """
+        if names is None and targets is not None:
+            names = list(targets)
+        deadline = time.time() + max_wait
+        previous = self.get_many(names)
+        while True:
+            time.sleep(interval)
+            current = self.get_many(names)
+            if motion.settled(previous, current, tolerance) and (
+                    targets is None
+                    or motion.at_targets(current, targets, target_tolerance)):
+                return current
+            if time.time() > deadline:
+                raise TimeoutError(
+                    f"Motors at {self.ip}:{self.port} did not settle: {current}"
+                )
+            previous = current
 
     def getYaml(self, timeout: int = None) -> str:
         """Retrieve the YAML configuration from the server."""
@@ -117,4 +274,300 @@ class MotorController(Thread):
     def close(self):
         """Tear down the ZMQ client cleanly."""
         self.client.close()
+        for lane in self._lanes:
+            lane.close()
+        self._lanes = []
         print("Closed connection to motor server.")
+
+
+class MotorPool:
+    """
+    Long-lived MotorControllers keyed by (ip, port), shared by the server's
+    worker threads. A ZMQ REQ socket must only be used by one thread at a
+    time, so connection() lends a controller to a single caller and takes
+    it back afterwards; concurrent callers for the same server get separate
+    controllers. Each server's name→ID map is looked up once and handed to
+    every new controller until refresh() is called. A controller that timed
+    out or raised is closed rather than reused, so the next caller
+    reconnects.
+    """
+    def __init__(self, max_idle: int = 8):
+        self.max_idle = max_idle
+        self._lock = Lock()
+        self._idle = {}      # (ip, port) -> [MotorController]
+        self._id_dicts = {}  # (ip, port) -> name→ID map
+        self._batch = {}     # (ip, port) -> whether the server batches
+
+    def _acquire(self, ip, port) -> MotorController:
+        key = (ip, port)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+            id_dict = self._id_dicts.get(key)
+            batch = self._batch.get(key)
+        mc = MotorController(ip, port, id_dict=id_dict, batch=batch)
+        with self._lock:
+            self._id_dicts.setdefault(key, dict(mc.id_dict))
+        return mc
+
+    def _release(self, mc: MotorController, ok: bool = True):
+        if mc.batch is not None:
+            with self._lock:
+                self._batch[(mc.ip, mc.port)] = mc.batch
+        if ok and not mc.failed:
+            with self._lock:
+                idle = self._idle.setdefault((mc.ip, mc.port), [])
+                if (len(idle) < self.max_idle and
+                        mc.id_dict == self._id_dicts.get((mc.ip, mc.port))):
+                    idle.append(mc)
+                    return
+        mc.close()
+
+    @contextmanager
+    def connection(self, ip, port):
+        """Borrow a controller for (ip, port): `with pool.connection(ip, port) as mc:`"""
+        mc = self._acquire(ip, port)
+        try:
+            yield mc
+        except BaseException:
+            self._release(mc, ok=False)
+            raise
+        self._release(mc)
+
+    def id_dict(self, ip, port, refresh: bool = False) -> dict:
+        """The cached name→ID map of a motor server, optionally re-read."""
+        if refresh:
+            return self.refresh(ip, port)
+        with self._lock:
+            id_dict = self._id_dicts.get((ip, port))
+        if id_dict is None:
+            with self.connection(ip, port) as mc:
+                id_dict = mc.id_dict
+        return dict(id_dict)
+
+    def refresh(self, ip, port) -> dict:
+        """Re-read the name→ID map of a motor server, e.g. after motors were
+        added or re-plugged, and hand it to the idle controllers."""
+        with self.connection(ip, port) as mc:
+            id_dict = mc.get_name(timeout=2000)
+            with self._lock:
+                self._id_dicts[(ip, port)] = dict(id_dict)
+                for idle in self._idle.get((ip, port), []):
+                    idle.id_dict = dict(id_dict)
+        return dict(id_dict)
+
+    def close(self):
+        """Close every idle controller."""
+        with self._lock:
+            idle = [mc for mcs in self._idle.values() for mc in mcs]
+            self._idle.clear()
+        for mc in idle:
+            mc.close()
+
+
+class AsyncMotorClient:
+    """
+    asyncio counterpart of MotorController for one motor server, with the
+    same commands as coroutines. Timeouts are in ms, like MotorController's,
+    and default to self.timeout (None waits, e.g. for long moves); a request that times out or is cancelled drops its socket (a REQ socket
+    cannot send again before it has its reply) and the next one reconnects.
+    Requests on one client are serialized, requests to different servers
+    run concurrently.
+    """
+    def __init__(self, ip, port, id_dict=None, batch=None, timeout: int = None):
+        self.ip = ip
+        self.port = port
+        self.id_dict = {} if id_dict is None else dict(id_dict)
+        self.batch = batch
+        self.timeout = timeout
+        self._socket = None
+        self._lock = asyncio.Lock()
+
+    def _open(self):
+        ctx = zmq.asyncio.Context.instance()
+        socket = ctx.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(f"tcp://{self.ip}:{self.port}")
+        return socket
+
+    def _reset(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    async def _send_and_recv(self, cmd: str, timeout: int = None) -> str:
+        """Send `cmd`, return the response or 'Timeout'."""
+        timeout = self.timeout if timeout is None else timeout
+        async with self._lock:
+            if self._socket is None:
+                self._socket = self._open()
+            try:
+                await self._socket.send_string(cmd + "\n")
+                return await asyncio.wait_for(
+                    self._socket.recv_string(),
+                    None if timeout is None else timeout / 1000
+                )
+            except asyncio.TimeoutError:
+                self._reset()
+                return "Timeout"
+            except asyncio.CancelledError:
+                self._reset()
+                raise
+
+    async def connect(self, timeout: int = None) -> dict:
+        """Look up the motor names unless they are already known."""
+        if not self.id_dict:
+            await self.get_name(timeout)
+        return self.id_dict
+
+    async def get_name(self, timeout: int = None) -> dict:
+        resp = await self._send_and_recv("apt", timeout)
+        if resp == "Timeout":
+            raise ConnectionError(
+                f"Could not connect to motor {self.ip}:{self.port}: "
+                "failed to get motor names (timeout)"
+            )
+        names = resp.rstrip(",\n").split(",")
+        self.id_dict = {name: idx for idx, name in enumerate(names)}
+        return self.id_dict
+
+    async def supports_batch(self, timeout: int = None) -> bool:
+        """Like MotorController.supports_batch: probed once, with at most
+        BATCH_PROBE_TIMEOUT ms even if requests may wait indefinitely."""
+        if self.batch is None and self.id_dict:
+            idx = next(iter(self.id_dict.values()))
+            timeout = self.timeout if timeout is None else timeout
+            if timeout is None or timeout > BATCH_PROBE_TIMEOUT:
+                timeout = BATCH_PROBE_TIMEOUT
+            resp = await self._send_and_recv(f"{BATCH_PREFIX}getpos {idx}", timeout)
+            self.batch = resp.startswith(BATCH_PREFIX)
+        return bool(self.batch)
+
+    async def _many(self, template: str, args: dict, timeout: int = None) -> dict:
+        await self.connect(timeout)
+        results = {n: "Motor not connected" for n in args if n not in self.id_dict}
+        cmds = {
+            n: template.format(arg=a, idx=self.id_dict[n])
+            for n, a in args.items() if n in self.id_dict
+        }
+        if not cmds:
+            return results
+        names = list(cmds)
+        if await self.supports_batch(timeout):
+            resp = await self._send_and_recv(
+                batch_request([cmds[n] for n in names]), timeout
+            )
+            results.update(parse_batch(resp, names))
+        else:
+            # one request at a time per socket, so use a socket per motor
+            lanes = [AsyncMotorClient(self.ip, self.port, self.id_dict,
+                                      timeout=self.timeout) for _ in names]
+            try:
+                responses = await asyncio.gather(*(
+                    lane._send_and_recv(cmds[n], timeout)
+                    for lane, n in zip(lanes, names)
+                ))
+            finally:
+                for lane in lanes:
+                    lane.close()
+            results.update(zip(names, responses))
+        return results
+
+    async def goto(self, name: str, pos, timeout: int = None) -> str:
+        return (await self._many("goto {arg} {idx}", {name: pos}, timeout))[name]
+
+    async def getPos(self, name: str, timeout: int = None) -> str:
+        return (await self._many("getpos {idx}", {name: None}, timeout))[name]
+
+    async def goto_many(self, positions: dict, timeout: int = None) -> dict:
+        return await self._many("goto {arg} {idx}", positions, timeout)
+
+    async def home_many(self, names=None, timeout: int = None) -> dict:
+        await self.connect(timeout)
+        names = list(self.id_dict) if names is None else names
+        return await self._many("home {idx}", dict.fromkeys(names), timeout)
+
+    async def get_many(self, names=None, timeout: int = None) -> dict:
+        await self.connect(timeout)
+        names = list(self.id_dict) if names is None else names
+        return to_positions(
+            await self._many("getpos {idx}", dict.fromkeys(names), timeout)
+        )
+
+    async def wait_settled(self, names=None,
+                           tolerance: float = motion.DEFAULT_TOLERANCE,
+                           interval: float = 0.05, max_wait: float = 30.0,
+                           targets: dict = None,
+                           target_tolerance: float = motion.DEFAULT_SETTLE_TOLERANCE) -> dict:
+        """Like MotorController.wait_settled, without blocking the loop."""
+        if names is None and targets is not None:
+            names = list(targets)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + max_wait
+        previous = await self.get_many(names)
+        while True:
+            await asyncio.sleep(interval)
+            current = await self.get_many(names)
+            if motion.settled(previous, current, tolerance) and (
+                    targets is None
+                    or motion.at_targets(current, targets, target_tolerance)):
+                return current
+            if loop.time() > deadline:
+                raise TimeoutError(
+                    f"Motors at {self.ip}:{self.port} did not settle: {current}"
+                )
+            previous = current
+
+    def close(self):
+        self._reset()
+
+
+class AsyncMotorHub:
+    """
+    Keeps AsyncMotorClients on one event loop in a background thread, so
+    synchronous code can send requests to several motor servers at once.
+    The latency of a fan-out is that of the slowest server, and a server
+    that does not answer times out on its own without holding up the rest.
+    """
+    def __init__(self, timeout: int = None):
+        self.timeout = timeout
+        self._clients = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def client(self, ip, port) -> AsyncMotorClient:
+        """The persistent client for (ip, port); use it on the hub's loop."""
+        key = (ip, port)
+        if key not in self._clients:
+            self._clients[key] = AsyncMotorClient(ip, port, timeout=self.timeout)
+        return self._clients[key]
+
+    def gather(self, calls: dict, timeout: float = None) -> dict:
+        """
+        Run {key: (ip, port, fn)} concurrently, where fn(client) returns a
+        coroutine, and wait for all of them. Each call is cancelled after
+        timeout seconds (None waits). Returns {key: result}, with the
+        exception as the result of a call that failed or timed out.
+        """
+        async def one(ip, port, fn):
+            return await asyncio.wait_for(fn(self.client(ip, port)), timeout)
+
+        async def run_all():
+            return await asyncio.gather(
+                *(one(*call) for call in calls.values()), return_exceptions=True
+            )
+
+        results = asyncio.run_coroutine_threadsafe(run_all(), self._loop).result()
+        return dict(zip(calls, results))
+
+    def close(self):
+        async def close_all():
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+        asyncio.run_coroutine_threadsafe(close_all(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
@@ -0,0 +1,87 @@
+"""
+Model-based waveplate calibration.
+
+Behind a fixed polarizer, the counts as a function of the angle theta of a
+single waveplate follow Malus' law through the waveplate's retardance:
+
+    HWP:  a0 + a4 cos(4 theta) + b4 sin(4 theta)
+    QWP:  a0 + a2 cos(2 theta) + b2 sin(2 theta)
+             + a4 cos(4 theta) + b4 sin(4 theta)
+
+Both are linear in the coefficients, so a handful of samples around the
+current angle give the whole curve by linear least squares, and the
+waveplate can go straight to the fitted extremum instead of being searched
+for blindly. Motors that are not quarter-wave plates are treated as
+half-wave plates.
+"""
+
+import numpy as np
+
+# Samples (offsets in degrees from the current angle) for each kind of
+# waveplate, spanning half a period of the slowest term
+DEFAULT_OFFSETS = {
+    "HWP": np.linspace(-22.5, 22.5, 5),
+    "QWP": np.linspace(-45.0, 45.0, 7),
+}
+PERIOD = {"HWP": 90.0, "QWP": 180.0}
+HARMONICS = {"HWP": (4,), "QWP": (2, 4)}
+# fits with a lower coefficient of determination call for another round
+DEFAULT_MIN_R2 = 0.9
+
+
+def kind_of(name):
+    return "QWP" if "QWP" in name else "HWP"
+
+
+def design_matrix(angles, kind):
+    """Columns 1, cos(k theta), sin(k theta) for the harmonics k of kind."""
+    theta = np.deg2rad(np.asarray(angles, dtype=float))
+    columns = [np.ones_like(theta)]
+    for k in HARMONICS[kind]:
+        columns += [np.cos(k * theta), np.sin(k * theta)]
+    return np.stack(columns, axis=-1)
+
+
+def model(coeffs, angles, kind):
+    return design_matrix(angles, kind) @ coeffs
+
+
+def fit(angles, counts, kind, poisson=False):
+    """
+    Least-squares fit of the Malus-law curve of kind to counts measured
+    at angles (degrees). Returns a dict with the coefficients, the
+    residuals, the coefficient of determination r2 and, for raw counts
+    (poisson=True), the reduced chi-square with Poisson errors.
+    """
+    angles = np.asarray(angles, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    A = design_matrix(angles, kind)
+    coeffs = np.linalg.lstsq(A, counts, rcond=None)[0]
+    residuals = counts - A @ coeffs
+    ss_tot = np.sum((counts - counts.mean()) ** 2)
+    r2 = 1.0 - np.sum(residuals**2) / ss_tot if ss_tot > 0 else 0.0
+    ret = {"kind": kind, "coeffs": coeffs, "residuals": residuals,
+           "r2": float(r2)}
+    dof = len(counts) - A.shape[1]
+    if poisson and dof > 0:
+        ret["chi2_red"] = float(
+            np.sum(residuals**2 / np.maximum(counts, 1.0)) / dof
+        )
+    return ret
+
+
+def extremum(result, center, maximize=False, resolution=0.05):
+    """Angle of the fitted minimum (or maximum) within one period centered
+    on center, found on a grid with the given resolution in degrees."""
+    half = PERIOD[result["kind"]] / 2
+    grid = np.arange(center - half, center + half + resolution, resolution)
+    values = model(result["coeffs"], grid, result["kind"])
+    i = np.argmax(values) if maximize else np.argmin(values)
+    return float(grid[i]), float(values[i])
+
+
+def good_fit(result, offsets, center, best, min_r2=DEFAULT_MIN_R2):
+    """Whether a fit can be trusted as final: it explains the samples and
+    its extremum lies within the sampled span, not extrapolated."""
+    inside = np.min(offsets) <= best - center <= np.max(offsets)
+    return bool(result["r2"] >= min_r2 and inside)